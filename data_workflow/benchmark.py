@@ -0,0 +1,115 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import gfsworkflow
+import nomads_standin
+
+
+# The workflow settings each benchmark configuration runs with
+CONFIGS = {
+    'serial': {'connections': 1, 'workers': 1},
+    'parallel': {'connections': 4, 'workers': 4},
+    'lowmemory': {'connections': 4, 'workers': 4, 'memory': 1000},
+    'stream': {'connections': 4, 'workers': 4, 'stream': True},
+    'compressed': {'connections': 4, 'workers': 4, 'ncoptions': gfsworkflow.netcdf_options()},
+    'packed': {'connections': 4, 'workers': 4, 'ncoptions': gfsworkflow.netcdf_options(pack=True)},
+    'consolidated': {'connections': 4, 'workers': 4, 'ncoptions': gfsworkflow.netcdf_options(), 'consolidate': True},
+    'zarr': {'connections': 4, 'workers': 4, 'zarroptions': gfsworkflow.zarr_options()},
+    'selection': {'connections': 4, 'workers': 4,
+                  'selection': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'selection.json')},
+    'domains': {'connections': 4, 'workers': 4, 'ncoptions': gfsworkflow.netcdf_options(),
+                'domains': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'domains.json')},
+    'cubes': {'connections': 4, 'workers': 4, 'ncoptions': gfsworkflow.netcdf_options(), 'cubes': True},
+}
+ALL_STEPS = list(gfsworkflow.FC_STEPS)
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, dirs, files in os.walk(path) for file in files)
+
+
+def run_benchmark(name, steps=4, keep=False):
+    """
+    Runs the whole workflow with one of the CONFIGS in a new temporary folder against whatever GFS_NOMADS_URL (or
+    gfsworkflow.NOMADS) points at. Returns the time of each stage and the throughput of the download and convert
+    stages, read from the workflow's journal.json and metrics.jsonl.
+    """
+    threddspath = tempfile.mkdtemp(prefix='gfs_benchmark_' + name + '_')
+    gfsworkflow.FC_STEPS[:] = ALL_STEPS[:steps]
+    # keep the app's bounds.js out of it
+    gfsworkflow.BOUNDS_FILE = os.path.join(threddspath, 'bounds.js')
+    # the workflow logs to the folder it runs in, drop the handler left from the last run
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+
+    start = time.time()
+    message = gfsworkflow.workflow(threddspath=threddspath, **CONFIGS[name])
+    seconds = time.time() - start
+
+    with open(os.path.join(threddspath, 'journal.json'), 'r') as f:
+        journal = json.loads(f.read())
+    with open(os.path.join(threddspath, 'metrics.jsonl'), 'r') as f:
+        summary = [json.loads(line) for line in f if '"kind": "run"' in line][-1]
+    stages = {stage: record.get('seconds', 0) for stage, record in journal['stages'].items()}
+    cycle = gfsworkflow.current_cycle(threddspath)
+    result = {
+        'config': name,
+        'message': message,
+        'steps': steps,
+        'seconds': round(seconds, 2),
+        'stages': stages,
+        'bytes': summary['bytes'],
+        'download_mb_per_second': round(summary['bytes'] / 1e6 / max(stages['download'], 1e-3), 2),
+        'steps_per_second': round(summary['steps_converted'] / max(stages['convert'], 1e-3), 3),
+        'messages_per_second': round(summary['messages'] / max(stages['convert'], 1e-3), 2),
+        'peak_rss_mb': round(summary['peak_rss_bytes'] / 1e6),
+        'output_mb': round(folder_size(os.path.join(threddspath, cycle)) / 1e6, 1) if cycle else 0,
+    }
+    if keep:
+        result['path'] = threddspath
+    else:
+        shutil.rmtree(threddspath)
+    return result
+
+
+def print_results(results):
+    columns = ['config', 'seconds', 'download', 'download_mb_per_second', 'convert', 'steps_per_second',
+               'messages_per_second', 'publish', 'peak_rss_mb', 'output_mb']
+    print(' '.join(column.rjust(12) for column in columns))
+    for result in results:
+        row = dict(result, **result['stages'])
+        print(' '.join(str(row[column]).rjust(12) for column in columns))
+        if not result['message'].startswith('GFS Workflow Completed'):
+            print('  ' + result['config'] + ': ' + result['message'])
+    return
+
+
+# run this script to compare workflow configurations against a local stand-in for nomads, e.g.
+# python benchmark.py --configs serial,parallel,stream --steps 8 --bandwidth 20e6
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the GFS workflow against a local stand-in for nomads')
+    parser.add_argument('--configs', default=','.join(CONFIGS), help='comma separated names from CONFIGS')
+    parser.add_argument('--steps', type=int, default=4, help='how many forecast steps to run, up to 28')
+    parser.add_argument('--latency', type=float, default=0, help='seconds before the server answers a request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second per connection')
+    parser.add_argument('--error-rate', type=float, default=0, help='the chance a request gets a 500 error')
+    parser.add_argument('--keep', action='store_true', help='keep the output folders')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    server = nomads_standin.serve(latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate)
+    gfsworkflow.NOMADS = server.url
+    results = []
+    for config in args.configs.split(','):
+        results.append(run_benchmark(config, steps=args.steps, keep=args.keep))
+    server.shutdown()
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(json.dumps(results, indent=2))
@@ -1,384 +1,2656 @@
+import argparse
+import concurrent.futures
 import datetime
+import fcntl
+import hashlib
 import logging
 import os
+import queue
+import re
+import resource
 import shutil
-import sys
+import socket
+import threading
 import time
 
 import netCDF4
 import numpy
 import pygrib
 import requests
+import requests.adapters
 import json
 
 
-def solve_environment(threddspath):
-    logging.info('\nSetting the Environment for the GFS Workflow')
-    # determine the most day and hour of the day timestamp of the most recent GFS forecast
-    now = datetime.datetime.utcnow() - datetime.timedelta(hours=6)
-    if now.hour >= 18:
-        timestamp = now.strftime("%Y%m%d") + '18'
-    elif now.hour >= 12:
-        timestamp = now.strftime("%Y%m%d") + '12'
-    elif now.hour >= 6:
-        timestamp = now.strftime("%Y%m%d") + '06'
-    else:  # now.hour >= 0:
-        timestamp = now.strftime("%Y%m%d") + '00'
-    logging.info('determined the timestamp to download: ' + timestamp)
+# This is the List of forecast timesteps for 7 days (6-hr increments)
+FC_STEPS = ['006', '012', '018', '024', '030', '036', '042', '048', '054', '060', '066', '072', '078', '084',
+            '090', '096', '102', '108', '114', '120', '126', '132', '138', '144', '150', '156', '162', '168']
+
+# The types of level that get a netcdf (and an ncml) of their own
+FORECAST_LEVELS = ['atmosphere', 'depthBelowLandLayer', 'heightAboveGround', 'heightAboveGroundLayer',
+                   'heightAboveSea', 'hybrid', 'isothermZero', 'isobaricInPa', 'isobaricInhPa', 'maxWind', 'meanSea',
+                   'nominalTop', 'potentialVorticity', 'pressureFromGroundLayer', 'sigma', 'sigmaLayer', 'surface',
+                   'tropopause', 'unknown']
+
+# The types of level where a variable can come at several levels. Those variables get a vertical dimension named for
+# the type: its name, units, and direction, and the factor from the grib's fixed surfaces to those units. See
+# vertical_levels
+VERTICAL_LEVELS = {
+    'isobaricInhPa': ('pressure', 'hPa', 'down', .01),
+    'isobaricInPa': ('pressure', 'Pa', 'down', 1),
+    'pressureFromGroundLayer': ('pressure_difference', 'hPa', 'up', .01),
+    'heightAboveGround': ('height', 'm', 'up', 1),
+    'heightAboveGroundLayer': ('height', 'm', 'up', 1),
+    'heightAboveSea': ('height', 'm', 'up', 1),
+    'depthBelowLandLayer': ('depth', 'm', 'down', 1),
+    'sigma': ('sigma', '1', 'down', 1),
+    'sigmaLayer': ('sigma', '1', 'down', 1),
+    'hybrid': ('hybrid', '1', 'up', 1),
+    'potentialVorticity': ('potential_vorticity', 'K m2 kg-1 s-1', 'up', 1),
+}
+
+# The types of level in VERTICAL_LEVELS whose messages are layers between two fixed surfaces. Several layers can share
+# a surface, e.g. sigma 0.44-1 and 0.44-0.72, so a layer is known by both. Its coordinate is the middle of the layer
+# and its surfaces are in a bounds variable (see new_vertical_dimension)
+LAYERS = ('depthBelowLandLayer', 'heightAboveGroundLayer', 'pressureFromGroundLayer', 'sigmaLayer')
+
+# The GFS 0.25 degree grid as it is written, south to north and -180 to 180 (see reorder_message)
+LATITUDES = numpy.arange(721, dtype='f4') * .25 - 90
+LONGITUDES = numpy.arange(1440, dtype='f4') * .25 - 180
+
+# The peak memory in MB of a conversion process, used to fit the processes under a memory ceiling until one has been
+# measured (see conversion_workers)
+WORKER_MEMORY = 400
+
+# How many times the workers try a step before the coordinator gives up on the cycle (see coordinate)
+UNIT_ATTEMPTS = 3
 
-    # perform a redundancy check, if the last timestamp is the same as current, abort the workflow
+# The size in bytes of the header at the start of a cube file, which is padded so the values start page aligned
+CUBE_HEADER = 4096
+
+# Each process reuses one grid sized buffer for every message it converts (see reorder_message)
+BUFFER = {}
+
+# Where the gribs are downloaded from. Set GFS_NOMADS_URL to use a mirror or a local stand-in (see nomads_standin.py)
+NOMADS = os.environ.get('GFS_NOMADS_URL', 'https://nomads.ncep.noaa.gov')
+# Seconds to wait for the rest of a detected cycle that nomads is still posting, it takes about an hour and a half to
+# post every step
+POSTING_WAIT = 7200
+
+# The app's file of WMS color bounds which write_wmsbounds replaces
+BOUNDS_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tethysapp', 'gfs', 'public', 'js', 'bounds.js')
+
+
+def staging_path(threddspath, timestamp):
+    # cycles are built here and moved next to the ncml files in one rename when they are published
+    return os.path.join(threddspath, 'staging', timestamp)
+
+
+def current_cycle(threddspath):
+    """
+    The timestamp of the published cycle, read from the current symlink (or last_run.txt for older installs)
+    """
+    pointer = os.path.join(threddspath, 'current')
+    if os.path.islink(pointer):
+        return os.path.basename(os.readlink(pointer))
     timefile = os.path.join(threddspath, 'last_run.txt')
-    try:
+    if os.path.exists(timefile):
         with open(timefile, 'r') as file:
-            lasttime = file.readline()
-            if lasttime == timestamp:
-                # use the redundant check to skip the function because its already been run
-                redundant = True
-                logging.info('The last recorded timestamp is the timestamp we determined, aborting workflow')
-                return timestamp, redundant
-            elif lasttime == 'clobbered':
-                # if you marked clobber is true, dont check for old folders from partially completed workflows
-                redundant = False
-            else:
-                # check to see if there are remnants of partially completed runs and dont destroy old folders
-                redundant = False
-                test = os.path.join(threddspath, timestamp, 'netcdfs')
-                if os.path.exists(test):
-                    logging.info('There are directories for this timestep but the workflow wasn\'t finished. '
-                                 'Attempting to resume...')
-                    return timestamp, redundant
-    except:
-        redundant = False
-
-    # find folders from partially completed runs that were never resumed
-    for file in os.listdir(threddspath):
-        path = os.path.join(threddspath, file)
-        if os.path.isdir(path) and file != timestamp:
-            shutil.rmtree(path)
+            return file.readline().strip()
+    return None
+
+
+def acquire_lock(threddspath):
+    """
+    Takes the workflow lock, an fcntl lock on workflow.lock. The kernel releases it when the process exits, however
+    it exits, so a crashed run can't block the next one. Returns the open lock file or None if another run holds it.
+    """
+    lockfile = open(os.path.join(threddspath, 'workflow.lock'), 'a+')
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lockfile.close()
+        return None
+    lockfile.seek(0)
+    lockfile.truncate()
+    lockfile.write(json.dumps({'pid': os.getpid(), 'host': socket.gethostname()}))
+    lockfile.flush()
+    return lockfile
+
+
+def release_lock(lockfile):
+    # the file is left in place, deleting it could let two runs lock different files with the same name
+    fcntl.flock(lockfile, fcntl.LOCK_UN)
+    lockfile.close()
+    return
+
+
+def utc_stamp():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Journal:
+    """
+    The workflow's progress, saved to journal.json in the thredds path: the status of the run, of each stage, and of
+    each step in the download and convert stages. It is rewritten atomically on every change and on a heartbeat while
+    the workflow runs, so the app can tell a running workflow from one that died. The steps are kept when the same
+    cycle is run again so the journal shows what an earlier attempt finished and what had to be redone.
+    Safe to update from the download threads.
+    """
+    stages = ('environment', 'download', 'convert', 'publish', 'cleanup')
+
+    def __init__(self, threddspath, interval=30):
+        self.path = os.path.join(threddspath, 'journal.json')
+        self.interval = interval
+        self.stage_times = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.state = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.state = json.loads(f.read())
+
+    def start(self):
+        with self.lock:
+            if self.state.get('status') == 'running':
+                logging.info('The last run of ' + str(self.state.get('timestamp')) + ' stopped without finishing')
+            stages = self.state.get('stages', {})
+            self.state.update({'status': 'running', 'pid': os.getpid(), 'host': socket.gethostname(),
+                               'started': utc_stamp(), 'finished': None, 'heartbeat': utc_stamp(),
+                               'interval': self.interval, 'message': None})
+            self.state['stages'] = {stage: {'status': 'pending', 'steps': stages.get(stage, {}).get('steps', {})}
+                                    for stage in self.stages}
+            self.save()
+        threading.Thread(target=self.beat, daemon=True).start()
+        return
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                self.state['heartbeat'] = utc_stamp()
+                self.save()
+        return
+
+    def cycle(self, timestamp):
+        # the step records only describe the cycle they were made for
+        with self.lock:
+            if self.state.get('timestamp') != timestamp:
+                for stage in self.state['stages'].values():
+                    stage['steps'] = {}
+            self.state['timestamp'] = timestamp
+            self.save()
+        return
+
+    def stage(self, name, status):
+        with self.lock:
+            self.state['stages'][name]['status'] = status
+            self.state['stages'][name]['started' if status == 'running' else 'finished'] = utc_stamp()
+            if status == 'running':
+                self.stage_times[name] = time.time()
+            elif name in self.stage_times:
+                self.state['stages'][name]['seconds'] = round(time.time() - self.stage_times.pop(name), 3)
+            self.save()
+        return
+
+    def step(self, stage, step, status, error=None):
+        with self.lock:
+            record = {'status': status, 'time': utc_stamp()}
+            if error:
+                record['error'] = error
+            self.state['stages'][stage]['steps'][step] = record
+            self.save()
+        return
+
+    def finish(self, status, message):
+        self.stopped.set()
+        with self.lock:
+            self.state.update({'status': status, 'finished': utc_stamp(), 'message': message})
+            self.save()
+        return
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(json.dumps(self.state, indent=1))
+        os.replace(self.path + '.tmp', self.path)
+        os.chmod(self.path, 0o777)
+        return
+
+
+def peak_rss():
+    # the most memory this process or any of its finished children used, in bytes. ru_maxrss is in kilobytes on linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def measured_worker_memory(threddspath, tail=262144):
+    """
+    The largest peak memory in bytes of a converted step in the most recent measurements in metrics.jsonl, or None if
+    there aren't any. Only the end of the file is read since it keeps every run
+    """
+    path = os.path.join(threddspath, 'metrics.jsonl')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        offset = max(0, os.path.getsize(path) - tail)
+        f.seek(offset)
+        lines = f.read().decode(errors='ignore').splitlines()
+    # the first line is only cut off if the read started partway through the file
+    if offset > 0:
+        lines = lines[1:]
+    measured = []
+    for line in lines:
+        if '"kind": "convert"' in line:
+            measured.append(json.loads(line)['rss'])
+    return max(measured) if measured else None
+
+
+def conversion_workers(threddspath, workers, memory):
+    """
+    The number of conversion processes, at most workers, that fit in memory megabytes along with this process. Each
+    process is expected to use as much as the most any conversion used recently, or WORKER_MEMORY before there are
+    measurements. At least 1 process is always used.
+    """
+    per_worker = measured_worker_memory(threddspath) or WORKER_MEMORY * 1e6
+    available = memory * 1e6 - resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    fits = max(1, min(workers, int(available // per_worker)))
+    if fits < workers:
+        logging.info('using ' + str(fits) + ' conversion processes instead of ' + str(workers) + ' to stay under ' +
+                     str(memory) + ' MB (' + str(round(per_worker / 1e6)) + ' MB each)')
+    return fits
+
+
+class Metrics:
+    """
+    Measurements of a workflow run: the bytes and throughput of each download, the decode and write times of each
+    file by level, the messages skipped, and the peak memory. Each measurement is appended to metrics.jsonl as a
+    line of json. That file is kept from run to run so cycles can be compared. When the run ends a summary line is
+    added and the run is written to gfs_workflow.prom for the prometheus node_exporter textfile collector.
+    Safe to use from the download threads.
+
+    promfile: where to write the prometheus file, usually in the textfile collector's directory
+    """
+    def __init__(self, threddspath, promfile=None):
+        self.path = os.path.join(threddspath, 'metrics.jsonl')
+        self.promfile = promfile or os.path.join(threddspath, 'gfs_workflow.prom')
+        self.lock = threading.Lock()
+        self.run = utc_stamp()
+        self.start_time = time.time()
+        self.timestamp = None
+        self.downloads = {}
+        self.conversions = {}
+
+    def record(self, kind, **fields):
+        line = dict(fields, kind=kind, run=self.run, cycle=self.timestamp, time=utc_stamp())
+        with self.lock:
+            if kind == 'download':
+                self.downloads[fields['step']] = fields
+            elif kind == 'convert':
+                self.conversions[fields['step']] = fields
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(line) + '\n')
+        return
+
+    def finish(self, status):
+        """
+        Adds the summary of the run to metrics.jsonl and writes the prometheus file
+        """
+        downloads = list(self.downloads.values())
+        conversions = list(self.conversions.values())
+        decode = {}
+        write = {}
+        for conversion in conversions:
+            for level, seconds in conversion['decode'].items():
+                decode[level] = decode.get(level, 0) + seconds
+            for level, seconds in conversion['write'].items():
+                write[level] = write.get(level, 0) + seconds
+        summary = {
+            'status': status,
+            'seconds': round(time.time() - self.start_time, 3),
+            'bytes': sum(download['bytes'] for download in downloads),
+            'download_seconds': round(sum(download['seconds'] for download in downloads), 3),
+            'steps_downloaded': len(downloads),
+            'steps_converted': len(conversions),
+            'decode_seconds': round(sum(decode.values()), 3),
+            'write_seconds': round(sum(write.values()), 3),
+            'messages': sum(conversion['messages'] for conversion in conversions),
+            'messages_skipped': sum(conversion['skipped'] for conversion in conversions),
+            'peak_rss_bytes': max([peak_rss()] + [conversion['rss'] for conversion in conversions]),
+        }
+        self.record('run', **summary)
+
+        def gauge(name, description, values):
+            lines.append('# HELP gfs_workflow_' + name + ' ' + description)
+            lines.append('# TYPE gfs_workflow_' + name + ' gauge')
+            for labels, value in values:
+                lines.append('gfs_workflow_' + name + labels + ' ' + str(value))
+
+        lines = []
+        gauge('success', '1 if the last run finished normally', [('', int(status == 'complete'))])
+        gauge('last_run_timestamp_seconds', 'When the last run ended', [('', round(time.time()))])
+        gauge('cycle', 'The cycle (YYYYMMDDHH) the last run worked on', [('', self.timestamp or 0)])
+        gauge('duration_seconds', 'How long the last run took', [('', summary['seconds'])])
+        gauge('downloaded_bytes', 'Bytes downloaded by the last run', [('', summary['bytes'])])
+        gauge('download_throughput_bytes_per_second', 'Download throughput of each step in the last run',
+              [('{step="' + download['step'] + '"}', round(download['bytes'] / max(download['seconds'], 1e-6)))
+               for download in sorted(downloads, key=lambda download: download['step'])])
+        gauge('decode_seconds', 'Seconds spent decoding grib messages by level in the last run',
+              [('{level="' + level + '"}', round(seconds, 3)) for level, seconds in sorted(decode.items())])
+        gauge('write_seconds', 'Seconds spent writing the converted data by level in the last run',
+              [('{level="' + level + '"}', round(seconds, 3)) for level, seconds in sorted(write.items())])
+        gauge('steps_converted', 'Forecast steps converted by the last run', [('', summary['steps_converted'])])
+        gauge('messages_converted', 'Grib messages converted by the last run', [('', summary['messages'])])
+        gauge('messages_skipped', 'Grib messages skipped because of an error in the last run',
+              [('', summary['messages_skipped'])])
+        gauge('peak_rss_bytes', 'Peak resident memory of the workflow processes in the last run',
+              [('', summary['peak_rss_bytes'])])
+        # the collector reads every .prom file in its directory so the file must appear in one rename
+        with open(self.promfile + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.promfile + '.tmp', self.promfile)
+        return summary
+
+
+def step_posted(session, timestamp, step):
+    # nomads writes the .idx after the grib, so if the .idx is there the step can be downloaded
+    try:
+        r = session.head(gfs_file_url(timestamp, step) + '.idx', timeout=(10, 30), allow_redirects=True)
+        return r.status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def detect_cycle(lookback=4, session=None):
+    """
+    Finds the newest cycle that nomads has started posting by checking for the .idx of its first step, starting at
+    the current synoptic hour and going back lookback cycles. Returns the timestamp and the steps posted so far, or
+    None and an empty list if nothing was found.
+    """
+    session = session or requests.Session()
+    now = datetime.datetime.utcnow()
+    cycle = now.replace(hour=now.hour - now.hour % 6, minute=0, second=0, microsecond=0)
+    for i in range(lookback + 1):
+        timestamp = (cycle - datetime.timedelta(hours=6 * i)).strftime("%Y%m%d%H")
+        if not step_posted(session, timestamp, FC_STEPS[0]):
+            continue
+        # steps are posted in order so stop at the first one that is missing
+        posted = []
+        for step in FC_STEPS:
+            if not step_posted(session, timestamp, step):
+                break
+            posted.append(step)
+        return timestamp, posted
+    return None, []
+
+
+def solve_environment(threddspath, clobber=False, detect=True):
+    """
+    Picks the cycle to run and makes its staging folders. Returns the timestamp, whether that cycle is already
+    published, and the steps nomads has posted if the cycle was detected (see detect_cycle) or None if it wasn't
+    """
+    logging.info('\nSetting the Environment for the GFS Workflow')
+    timestamp = None
+    posted = None
+    if detect:
+        # ask nomads which cycle is posted instead of guessing from the clock
+        timestamp, posted = detect_cycle()
+        if timestamp:
+            logging.info('nomads has posted ' + str(len(posted)) + ' of ' + str(len(FC_STEPS)) + ' steps for ' +
+                         timestamp)
+        else:
+            logging.info('Could not find a posted cycle on nomads, using the most recent expected cycle instead')
+            posted = None
+    if not timestamp:
+        # determine the most day and hour of the day timestamp of the most recent GFS forecast
+        now = datetime.datetime.utcnow() - datetime.timedelta(hours=6)
+        if now.hour >= 18:
+            timestamp = now.strftime("%Y%m%d") + '18'
+        elif now.hour >= 12:
+            timestamp = now.strftime("%Y%m%d") + '12'
+        elif now.hour >= 6:
+            timestamp = now.strftime("%Y%m%d") + '06'
+        else:  # now.hour >= 0:
+            timestamp = now.strftime("%Y%m%d") + '00'
+    logging.info('determined the timestamp to download: ' + timestamp)
+
+    # perform a redundancy check, if the published timestamp is the same as current, abort the workflow
+    if current_cycle(threddspath) == timestamp and not clobber:
+        logging.info('The last recorded timestamp is the timestamp we determined, aborting workflow')
+        return timestamp, True, posted
+
+    # get rid of staged cycles from partially completed runs that were never resumed, and the partial ncml files that
+    # pointed into them. published cycles are left for cleanup to retire so the app can keep reading them
+    remove_partial(threddspath)
+    staging = os.path.join(threddspath, 'staging')
+    if not os.path.exists(staging):
+        os.mkdir(staging)
+        os.chmod(staging, 0o777)
+    for file in os.listdir(staging):
+        if file != timestamp:
+            shutil.rmtree(os.path.join(staging, file))
 
     # create the file structure and their permissions for the new data
-    logging.info('Creating THREDDS file structure')
-    new_dir = os.path.join(threddspath, timestamp)
-    if os.path.exists(new_dir):
+    new_dir = staging_path(threddspath, timestamp)
+    if os.path.exists(new_dir) and clobber:
+        logging.info('You chose the clobber option, deleting the staged data for this timestamp')
         shutil.rmtree(new_dir)
-    os.mkdir(new_dir)
-    os.chmod(new_dir, 0o777)
-    for filetype in ('gribs', 'netcdfs'):
-        new_dir = os.path.join(threddspath, timestamp, filetype)
-        if os.path.exists(new_dir):
-            shutil.rmtree(new_dir)
+    if os.path.exists(new_dir):
+        # keep the gribs and netcdfs from the earlier attempt, the download and conversion verify what they need
+        logging.info('There are directories for this timestep but the workflow wasn\'t finished. Attempting to resume')
+    else:
+        logging.info('Creating THREDDS file structure')
         os.mkdir(new_dir)
         os.chmod(new_dir, 0o777)
+    for filetype in ('gribs', 'netcdfs'):
+        new_dir = os.path.join(staging_path(threddspath, timestamp), filetype)
+        if not os.path.exists(new_dir):
+            os.mkdir(new_dir)
+            os.chmod(new_dir, 0o777)
 
-    open(os.path.join(threddspath, 'running.txt'), 'w')
-    logging.info('Created folders, wrote running warning, beginning gfs workflow functions')
-    return timestamp, redundant
+    logging.info('Created folders, beginning gfs workflow functions')
+    return timestamp, False, posted
 
 
-def download_gfs(threddspath, timestamp):
-    logging.info('\nStarting GFS grib Downloads')
-    # set filepaths
-    gribsdir = os.path.join(threddspath, timestamp, 'gribs')
+def posting_wait(posted, wait):
+    # the seconds to wait for steps that aren't posted yet. unless told otherwise, a cycle nomads is still posting is
+    # waited for since its later steps would fail
+    if wait is not None:
+        return wait
+    if posted is not None and len(posted) < len(FC_STEPS):
+        logging.info('waiting up to ' + str(POSTING_WAIT) + ' seconds for the steps nomads has not posted yet')
+        return POSTING_WAIT
+    return 0
 
-    # This is the List of forecast timesteps for 7 days (6-hr increments)
-    fc_steps = ['006', '012', '018', '024', '030', '036', '042', '048', '054', '060', '066', '072', '078', '084',
-                '090', '096', '102', '108', '114', '120', '126', '132', '138', '144', '150', '156', '162', '168']
 
-    # if you already have a folder with data for this timestep, quit this function (you dont need to download it)
-    if not os.path.exists(gribsdir):
-        logging.info('There is no download folder, you must have already processed them. Skipping download stage.')
-        return True
-    elif len(os.listdir(gribsdir)) >= len(fc_steps):
-        logging.info('There is already gfs data here. Skipping download stage.')
-        return True
-    # otherwise, remove anything in the folder before starting (in case there was a partial download)
-    else:
-        shutil.rmtree(gribsdir)
-        os.mkdir(gribsdir)
-        os.chmod(gribsdir, 0o777)
+def gfs_url(timestamp, step):
+    # get the parts of the timestamp to put into the url
+    fc_hour = datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%H")
+    fc_date = datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%Y%m%d")
+    return NOMADS + '/cgi-bin/filter_gfs_0p25.pl?file=gfs.t' + fc_hour + 'z.pgrb2.0p25.f' + \
+           step + '&all_lev=on&all_var=on&dir=%2Fgfs.' + fc_date + '%2F' + fc_hour
+
 
-    # # get the parts of the timestamp to put into the url
+def gfs_file_url(timestamp, step):
+    # the raw grib on the nomads file server, this is the file the .idx inventory describes
     fc_hour = datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%H")
     fc_date = datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%Y%m%d")
+    return NOMADS + '/pub/data/nccf/com/gfs/prod/gfs.' + fc_date + '/' + fc_hour + \
+           '/atmos/gfs.t' + fc_hour + 'z.pgrb2.0p25.f' + step
 
-    for step in fc_steps:
-        url = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl?file=gfs.t' + fc_hour + 'z.pgrb2.0p25.f' + \
-              step + '&all_lev=on&all_var=on&dir=%2Fgfs.' + fc_date + '%2F' + fc_hour
 
-        file_timestep = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
-        file_timestep = file_timestep + datetime.timedelta(hours=int(step))
-        file_timestep = file_timestep.strftime("%Y%m%d%H")
-        filename = file_timestep + '.grb'
+def grib_filename(timestamp, step):
+    file_timestep = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
+    file_timestep = file_timestep + datetime.timedelta(hours=int(step))
+    return file_timestep.strftime("%Y%m%d%H") + '.grb'
 
-        logging.info('downloading ' + filename + ' (step ' + step + ' of ' + fc_steps[-1] + ')')
-        filepath = os.path.join(gribsdir, filename)
-        start = time.time()
+
+def new_session(connections):
+    # one pooled session shared by every download thread so tcp/tls connections to nomads get reused
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def file_checksum(path, chunk_size=1048576):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_manifest(gribsdir):
+    path = os.path.join(gribsdir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.loads(f.read())
+    except ValueError:
+        logging.info('The download manifest was unreadable, every step will be verified against the server again')
+        return {}
+
+
+def write_manifest(gribsdir, manifest):
+    # write then rename so a crash mid-write never leaves a corrupt manifest behind
+    path = os.path.join(gribsdir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(path + '.tmp', path)
+
+
+def verify_step(gribsdir, entry, mode='all'):
+    """
+    True if the file recorded by a manifest entry is on disk, complete, matches the recorded checksum, and was
+    downloaded with the same selection of variables and levels (mode) that is being requested now
+    """
+    if not entry or entry.get('status') != 'complete' or entry.get('mode', 'all') != mode:
+        return False
+    path = os.path.join(gribsdir, entry['filename'])
+    if not os.path.isfile(path):
+        return False
+    if entry.get('size') is not None and os.path.getsize(path) != entry['size']:
+        return False
+    return file_checksum(path) == entry['sha256']
+
+
+def retry_or_raise(error, filepath, attempt, retries, backoff, waited, wait, poll):
+    """
+    Sleeps before the next download attempt or raises the error. A 404 means the step isn't posted yet, those are
+    checked again every poll seconds for up to wait seconds and don't use up the retries. Other errors are retried
+    with exponential backoff. Returns the new attempt count and time spent waiting for the step to be posted.
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code == 404:
+        if waited + poll > wait:
+            raise error
+        logging.info('  ' + os.path.basename(filepath) + ' is not posted yet, checking again in ' + str(poll) + 's')
+        time.sleep(poll)
+        return attempt, waited + poll
+    if attempt >= retries:
+        raise error
+    delay = backoff * (2 ** attempt)
+    logging.info('  retrying ' + os.path.basename(filepath) + ' in ' + str(delay) + 's after: ' + str(error))
+    time.sleep(delay)
+    return attempt + 1, waited
+
+
+def download_step(session, url, filepath, retries=3, backoff=5, chunk_size=1048576, wait=0, poll=60):
+    """
+    Downloads one forecast step to filepath, retrying with exponential backoff. Raises the last error if every
+    attempt fails. Writes to a .part file first so a half written grib is never mistaken for a finished one. If a
+    .part file is left from an earlier attempt, the rest of it is requested with an http Range header.
+    Returns the expected size (None if the server didn't say) and the sha256 of the finished file.
+    wait is how many seconds to keep checking for a step that isn't posted yet (see retry_or_raise).
+    """
+    partpath = filepath + '.part'
+    attempt = waited = 0
+    while True:
         try:
-            with requests.get(url, stream=True) as r:
+            have = os.path.getsize(partpath) if os.path.exists(partpath) else 0
+            headers = {'Range': 'bytes=' + str(have) + '-'} if have else {}
+            with session.get(url, headers=headers, stream=True, timeout=(30, 300)) as r:
+                if r.status_code == 416:
+                    # the range starts past the end of the file, the part file is bad so start over
+                    os.remove(partpath)
+                    raise requests.HTTPError('Range not satisfiable, restarting the download', response=r)
                 r.raise_for_status()
-                with open(filepath, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=10240):
+                if r.status_code == 206:
+                    # partial content, keep what we have and append. the total is after the / in Content-Range
+                    mode = 'ab'
+                    total = r.headers.get('Content-Range', '').split('/')[-1]
+                    size = int(total) if total.isdigit() else None
+                else:
+                    # the server ignored the range (the filter script often does) so rewrite the whole file
+                    mode = 'wb'
+                    length = r.headers.get('Content-Length')
+                    size = int(length) if length and length.isdigit() else None
+                with open(partpath, mode, buffering=chunk_size) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
                         if chunk:  # filter out keep-alive new chunks
                             f.write(chunk)
-        except requests.HTTPError as e:
-            errorcode = e.response.status_code
-            logging.info('\nHTTPError ' + str(errorcode) + ' downloading ' + filename + ' from\n' + url)
-            if errorcode == 404:
-                logging.info('The file was not found on the server, trying an older forecast time')
-                logging.info(url)
-            elif errorcode == 500:
-                logging.info('Probably a problem with the URL. Check the log and try the link')
-                logging.info(url)
-            return False
-        logging.info('  Download took ' + str(round(time.time() - start, 2)))
+            if size is not None and os.path.getsize(partpath) != size:
+                raise requests.ConnectionError('Connection closed after ' + str(os.path.getsize(partpath)) +
+                                               ' of ' + str(size) + ' bytes')
+            checksum = file_checksum(partpath)
+            os.replace(partpath, filepath)
+            return size, checksum
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            attempt, waited = retry_or_raise(e, filepath, attempt, retries, backoff, waited, wait, poll)
+
+
+def read_selection(path):
+    """
+    Reads a json file mapping the grib2 variable abbreviations used in nomads .idx files (e.g. TMP, UGRD) to a list
+    of regular expressions for the levels to keep (e.g. "2 m above ground", "\\d+ mb"). Returns the selection and a
+    short hash of it which is recorded in the download manifest.
+    """
+    with open(path, 'r') as f:
+        selection = json.loads(f.read())
+    mode = hashlib.sha256(json.dumps(selection, sort_keys=True).encode()).hexdigest()[:12]
+    selection = {var: [re.compile(level) for level in levels] for var, levels in selection.items()}
+    return selection, mode
+
+
+def read_idx(session, url):
+    """
+    Downloads and parses a .idx inventory. Each line looks like 1:0:d=2020020100:PRMSL:mean sea level:6 hour fcst:
+    Returns a list of dictionaries with the message's variable, level, and first and last byte (None for the last
+    message because it runs to the end of the file)
+    """
+    r = session.get(url, timeout=(30, 60))
+    r.raise_for_status()
+    inventory = []
+    for line in r.text.splitlines():
+        parts = line.split(':')
+        if len(parts) < 6:
+            continue
+        inventory.append({'start': int(parts[1]), 'end': None, 'var': parts[3], 'level': parts[4]})
+    for message, following in zip(inventory[:-1], inventory[1:]):
+        message['end'] = following['start'] - 1
+    return inventory
+
+
+def select_ranges(inventory, selection):
+    """
+    Picks the messages in the inventory that are in the selection and merges neighbors into contiguous byte ranges
+    """
+    ranges = []
+    for message in inventory:
+        levels = selection.get(message['var'])
+        if not levels or not any(level.fullmatch(message['level']) for level in levels):
+            continue
+        if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 == message['start']:
+            ranges[-1][1] = message['end']
+        else:
+            ranges.append([message['start'], message['end']])
+    return ranges
+
+
+def split_multipart(response):
+    """
+    Splits a multipart/byteranges response body into a list of (first byte, data) tuples sorted by first byte
+    """
+    boundary = response.headers['Content-Type'].split('boundary=')[-1].strip().strip('"').encode()
+    parts = []
+    for part in response.content.split(b'--' + boundary):
+        if b'\r\n\r\n' not in part:
+            continue
+        head, data = part.split(b'\r\n\r\n', 1)
+        content_range = [h for h in head.decode('latin-1').split('\r\n') if h.lower().startswith('content-range')]
+        if not content_range:
+            continue
+        first = int(content_range[0].split(' ')[-1].split('-')[0])
+        # every part is followed by the crlf that comes before the next boundary
+        if data.endswith(b'\r\n'):
+            data = data[:-2]
+        parts.append((first, data))
+    parts.sort(key=lambda x: x[0])
+    return parts
+
+
+def download_subset(session, url, filepath, selection, ranges_per_request=32, retries=3, backoff=5, wait=0,
+                    poll=60):
+    """
+    Downloads only the grib messages in the selection by reading the file's .idx inventory and requesting the byte
+    ranges of the chosen messages, several ranges per http request. Grib messages are self contained so the pieces
+    can be concatenated into a valid (smaller) grib file. Returns the size and sha256 of the finished file.
+    """
+    partpath = filepath + '.part'
+    attempt = waited = 0
+    while True:
+        try:
+            ranges = select_ranges(read_idx(session, url + '.idx'), selection)
+            size = 0
+            with open(partpath, 'wb', buffering=1048576) as f:
+                for i in range(0, len(ranges), ranges_per_request):
+                    batch = ranges[i:i + ranges_per_request]
+                    spec = ','.join(str(a) + '-' + ('' if b is None else str(b)) for a, b in batch)
+                    r = session.get(url, headers={'Range': 'bytes=' + spec}, timeout=(30, 300))
+                    r.raise_for_status()
+                    if r.status_code == 206 and r.headers.get('Content-Type', '').startswith('multipart/byteranges'):
+                        pieces = [data for first, data in split_multipart(r)]
+                    elif r.status_code == 206:
+                        # only one range was asked for (or the server merged them) so the body is the data
+                        pieces = [r.content]
+                    else:
+                        # the server ignored the range header and sent the whole file, cut the messages out of it
+                        pieces = [r.content[a:None if b is None else b + 1] for a, b in batch]
+                    for piece in pieces:
+                        f.write(piece)
+                        size += len(piece)
+            checksum = file_checksum(partpath)
+            os.replace(partpath, filepath)
+            return size, checksum
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+            attempt, waited = retry_or_raise(e, filepath, attempt, retries, backoff, waited, wait, poll)
+
+
+def download_gfs(threddspath, timestamp, connections=4, retries=3, backoff=5, selection=None, on_download=None,
+                 wait=0, journal=None, metrics=None):
+    """
+    Downloads the forecast steps to the gribs folder. If selection is the path to a selection json file (see
+    read_selection) only those variables and levels are downloaded, otherwise every field is downloaded.
+    on_download is called with the step (e.g. '006') of every grib that is ready, including ones that were already
+    downloaded, from the download threads. Steps that stream_gfs already converted are skipped.
+    wait is how many seconds to wait for steps nomads hasn't posted yet before giving up on them.
+    journal: a Journal to record the status of each step in
+    metrics: a Metrics to record the size and speed of each download in
+    """
+    logging.info('\nStarting GFS grib Downloads')
+    # set filepaths
+    gribsdir = os.path.join(staging_path(threddspath, timestamp), 'gribs')
+
+    # if you already have a folder with data for this timestep, quit this function (you dont need to download it)
+    if not os.path.exists(gribsdir):
+        logging.info('There is no download folder, you must have already processed them. Skipping download stage.')
+        return True
+
+    if selection:
+        selection, mode = read_selection(selection)
+        logging.info('Downloading only the ' + str(len(selection)) + ' variables in the selection (' + mode + ')')
+        url_for = gfs_file_url
+    else:
+        mode = 'all'
+        url_for = gfs_url
+
+    # check every step against the manifest, keep the verified files and only download what is missing
+    manifest = read_manifest(gribsdir)
+    converted = read_converted(gribsdir)
+    missing = []
+    for step in FC_STEPS:
+        if step in converted:
+            continue
+        if verify_step(gribsdir, manifest.get(step), mode):
+            if journal:
+                journal.step('download', step, 'complete')
+            if on_download:
+                on_download(step)
+            continue
+        # a finished file that fails verification is corrupt, delete it. .part files are kept to be resumed
+        filepath = os.path.join(gribsdir, grib_filename(timestamp, step))
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        # a selective download can't be resumed from the middle so throw away its partial file
+        if mode != 'all' and os.path.exists(filepath + '.part'):
+            os.remove(filepath + '.part')
+        manifest[step] = {'filename': grib_filename(timestamp, step), 'url': url_for(timestamp, step),
+                          'status': 'pending', 'mode': mode, 'size': None, 'sha256': None}
+        if journal:
+            journal.step('download', step, 'pending')
+        missing.append(step)
+    write_manifest(gribsdir, manifest)
+    if not missing:
+        logging.info('There is already gfs data here. Skipping download stage.')
+        return True
+    logging.info(str(len(FC_STEPS) - len(missing)) + ' steps were already downloaded or converted, ' +
+                 str(len(missing)) + ' steps to download')
+    lock = threading.Lock()
+
+    def fetch(step):
+        url = url_for(timestamp, step)
+        filename = grib_filename(timestamp, step)
+        logging.info('downloading ' + filename + ' (step ' + step + ' of ' + FC_STEPS[-1] + ')')
+        start = time.time()
+        if mode == 'all':
+            size, checksum = download_step(
+                session, url, os.path.join(gribsdir, filename), retries=retries, backoff=backoff, wait=wait)
+        else:
+            size, checksum = download_subset(
+                session, url, os.path.join(gribsdir, filename), selection, retries=retries, backoff=backoff,
+                wait=wait)
+        with lock:
+            manifest[step].update({'status': 'complete', 'size': size, 'sha256': checksum})
+            write_manifest(gribsdir, manifest)
+        seconds = time.time() - start
+        logging.info('  Download of ' + filename + ' took ' + str(round(seconds, 2)))
+        if metrics:
+            nbytes = os.path.getsize(os.path.join(gribsdir, filename))
+            metrics.record('download', step=step, bytes=nbytes, seconds=round(seconds, 3),
+                           throughput=round(nbytes / max(seconds, 1e-6)))
+        if journal:
+            journal.step('download', step, 'complete')
+        if on_download:
+            on_download(step)
+
+    # a bounded pool of threads sharing one connection pool, downloads are io bound so threads are enough
+    session = new_session(connections)
+    succeeded = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as pool:
+        futures = {pool.submit(fetch, step): step for step in missing}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except concurrent.futures.CancelledError:
+                # cancelled after another step failed, it stays pending for the next run
+                continue
+            except requests.HTTPError as e:
+                url = url_for(timestamp, futures[future])
+                errorcode = e.response.status_code
+                logging.info('\nHTTPError ' + str(errorcode) + ' downloading step ' + futures[future] + ' from\n' + url)
+                if errorcode == 404:
+                    logging.info('The file was not found on the server, trying an older forecast time')
+                elif errorcode == 500:
+                    logging.info('Probably a problem with the URL. Check the log and try the link')
+                if journal:
+                    journal.step('download', futures[future], 'failed', 'HTTPError ' + str(errorcode))
+                succeeded = False
+            except requests.RequestException as e:
+                logging.info('\nError downloading step ' + futures[future] + ': ' + str(e))
+                if journal:
+                    journal.step('download', futures[future], 'failed', str(e))
+                succeeded = False
+            # stop queued steps from starting once any step has failed
+            if not succeeded:
+                for pending in futures:
+                    pending.cancel()
+    session.close()
+    if not succeeded:
+        return False
     logging.info('Finished Downloads')
     return True
 
 
-def set_wmsbounds(threddspath, timestamp):
+def sigfigs(number):
+    # 5 significant figures keeps tiny values like mixing ratios from being rounded to 0
+    return float('%.5g' % number)
+
+
+def message_bounds(data):
+    """
+    The minimum, maximum, and 2nd and 98th percentiles of a decoded grib message, ignoring masked cells
+    """
+    if numpy.ma.isMaskedArray(data):
+        data = data.compressed()
+    if data.size == 0:
+        return None
+    p2, p98 = numpy.percentile(data, (2, 98))
+    return {'min': sigfigs(data.min()), 'max': sigfigs(data.max()), 'p2': sigfigs(p2), 'p98': sigfigs(p98)}
+
+
+def merge_bounds(first, second):
+    # the bounds of two messages together, used for the levels of a variable with a vertical dimension
+    if not first:
+        return second
+    return {'min': min(first['min'], second['min']), 'max': max(first['max'], second['max']),
+            'p2': min(first['p2'], second['p2']), 'p98': max(first['p98'], second['p98'])}
+
+
+def write_wmsbounds(bounds):
+    """
+    Writes the bounds collected while converting to the app's bounds.js. bounds is a dictionary of
+    {(shortName, level): {forecast hour: message_bounds}}.
+
+    bounds.js defines two objects: bounds, the min,max of each variable across every level and time (what the app
+    has always used) and levelbounds, which has an entry per variable and level with the min,max range, a robust
+    range made from the smallest 2nd and largest 98th percentiles of any time step, and the range at each time step.
+    """
     logging.info('\nSetting new WMS bounds')
-    # setting the environment file paths
-    gribs = os.path.join(threddspath, timestamp, 'gribs')
-    allgrbs = os.listdir(gribs)
-    db = {}
-
-    for grib in allgrbs:
-        path = os.path.join(gribs, grib)
-        file = pygrib.open(path)
-        file.seek(0)
-        for data in file:
-            minimum = int(data.minimum)
-            maximum = int(data.maximum)
-            shortname = data.shortName
-            if shortname not in db:
-                db[shortname] = [minimum, maximum]
-            else:
-                newmin = min(db[shortname][0], minimum)
-                newmax = max(db[shortname][1], maximum)
-                db[shortname] = [newmin, newmax]
+    legacy = {}
+    levelbounds = {}
+    for (short, level), steps in sorted(bounds.items()):
+        minimum = min(step['min'] for step in steps.values())
+        maximum = max(step['max'] for step in steps.values())
+        levelbounds.setdefault(short, {})[level] = {
+            'range': str(minimum) + ',' + str(maximum),
+            'robust': str(min(step['p2'] for step in steps.values())) + ',' +
+                      str(max(step['p98'] for step in steps.values())),
+            'steps': {str(hour): str(steps[hour]['min']) + ',' + str(steps[hour]['max']) for hour in sorted(steps)},
+        }
+        if short in legacy:
+            legacy[short] = [min(legacy[short][0], minimum), max(legacy[short][1], maximum)]
+        else:
+            legacy[short] = [minimum, maximum]
 
     formatted = {}
-    for var in db:
-        formatted[var] = str(db[var][0]) + ',' + str(db[var][1])
+    for var in legacy:
+        formatted[var] = str(int(legacy[var][0])) + ',' + str(int(legacy[var][1]))
 
-    boundsfile = os.path.join(
-        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tethysapp', 'gfs', 'public', 'js', 'bounds.js')
+    boundsfile = BOUNDS_FILE
     with open(boundsfile, 'w') as file:
-        file.write('const bounds = ' + json.dumps(formatted, ensure_ascii=True) + ';')
+        file.write('const bounds = ' + json.dumps(formatted, ensure_ascii=True) + ';\n')
+        file.write('const levelbounds = ' + json.dumps(levelbounds, ensure_ascii=True) + ';')
     logging.info('Wrote boundaries to ' + boundsfile)
     return
 
 
-def grib_to_netcdf(threddspath, timestamp, forecastlevels):
+def read_domains(path):
+    """
+    Reads a json file of the regional domains to write next to the global files, like domains.json. Each domain is
+    named with its [west, east, south, north] in degrees. Domains can't cross the antimeridian.
+    """
+    with open(path, 'r') as f:
+        domains = json.loads(f.read())
+    for name, (west, east, south, north) in domains.items():
+        if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+            raise ValueError('The domain ' + name + ' must be [west, east, south, north] in degrees')
+    return domains
+
+
+def domain_slices(bounds):
+    # the rows and columns of the global grid (see LATITUDES and LONGITUDES) that cover a [west, east, south, north]
+    west, east, south, north = bounds
+    rows = slice(int(numpy.floor((south + 90) / .25)), min(int(numpy.ceil((north + 90) / .25)) + 1, 721))
+    columns = slice(int(numpy.floor((west + 180) / .25)), min(int(numpy.ceil((east + 180) / .25)) + 1, 1440))
+    return rows, columns
+
+
+def new_domains(cyclepath, domains, clean=True):
+    """
+    Makes a folder in the cycle's domains folder for each domain and writes domains.json, which the app reads to find
+    them. It has the [west, east, south, north] of the cells each domain actually has.
+    """
+    domainspath = os.path.join(cyclepath, 'domains')
+    if clean and os.path.exists(domainspath):
+        shutil.rmtree(domainspath)
+    extents = {}
+    for name, domain in domains.items():
+        os.makedirs(os.path.join(domainspath, name), exist_ok=True)
+        rows, columns = domain_slices(domain)
+        extents[name] = [float(LONGITUDES[columns][0]), float(LONGITUDES[columns][-1]),
+                         float(LATITUDES[rows][0]), float(LATITUDES[rows][-1])]
+    with open(os.path.join(domainspath, 'domains.json'), 'w') as f:
+        f.write(json.dumps(extents))
+    logging.info('writing the domains ' + ', '.join(sorted(domains)))
+    return
+
+
+def forecast_hour(timestamp, file):
+    # the grib files are named for their valid time, so the forecast hour comes from the name not the listing order
+    file_dt = datetime.datetime.strptime(os.path.basename(file).split('.')[0].split('_')[-1], "%Y%m%d%H")
+    return int((file_dt - datetime.datetime.strptime(timestamp, "%Y%m%d%H")).total_seconds() // 3600)
+
+
+def new_level_netcdf(ncpath, level, hour, data_time, latitudes, longitudes):
+    """
+    Creates the netcdf for one level of one forecast step with its time, lat, and lon variables filled in
+    """
+    new_nc = netCDF4.Dataset(ncpath, 'w', clobber=True, format='NETCDF4', diskless=False)
+    new_nc.createDimension('time', 1)
+    new_nc.createDimension('lat', len(latitudes))
+    new_nc.createDimension('lon', len(longitudes))
+
+    new_nc.createVariable(varname='time', datatype='f4', dimensions='time')
+    new_nc['time'].axis = 'T'
+    new_nc['time'].begin_date = data_time
+    new_nc.createVariable(varname='lat', datatype='f4', dimensions='lat')
+    new_nc['lat'].axis = 'lat'
+    new_nc.createVariable(varname='lon', datatype='f4', dimensions='lon')
+    new_nc['lon'].axis = 'lon'
+
+    new_nc['time'][:] = [hour]
+    new_nc['lat'][:] = latitudes
+    new_nc['lon'][:] = longitudes
+    new_nc.gfs_level = level
+    return new_nc
+
+
+def fixed_surface(message, which):
+    # the message's First or Second fixed surface in the units of its vertical dimension. pygrib's level is an integer
+    # so it can't be used for sigma levels or soil depths
+    scaled = message['scaledValueOf' + which + 'FixedSurface']
+    value = scaled * 10.0 ** -message['scaleFactorOf' + which + 'FixedSurface']
+    return round(value * VERTICAL_LEVELS[message.typeOfLevel][3], 6)
+
+
+def vertical_value(message):
+    # the message's level: its fixed surface, or for a layer its (first, second) fixed surfaces
+    first = fixed_surface(message, 'First')
+    if message.typeOfLevel not in LAYERS:
+        return first
+    if message['typeOfSecondFixedSurface'] == 255:
+        # a layer without a second surface has no thickness
+        return first, first
+    return first, fixed_surface(message, 'Second')
+
+
+def vertical_coordinate(value):
+    # the coordinate of a level from vertical_value, the middle of a layer
+    return round((value[0] + value[1]) / 2, 6) if isinstance(value, tuple) else value
+
+
+def read_vertical_values(dataset, name):
+    # the levels of an open netcdf's vertical dimension the way vertical_value gives them
+    if name + '_bounds' in dataset.variables:
+        return [tuple(bounds) for bounds in dataset[name + '_bounds'][:].tolist()]
+    return dataset[name][:].tolist()
+
+
+def message_names(message):
+    # the names a message goes by in an inventory: its shortName and, for a total or average over a period, also its
+    # shortName with the period's hours like tp_6h so DERIVED_VARIABLES can ask for a particular period
+    names = [message.shortName]
+    if message['stepType'] in ('accum', 'avg', 'max', 'min'):
+        names.append(message.shortName + '_' + str(message['endStep'] - message['startStep']) + 'h')
+    return names
+
+
+def grib_inventory(gribfile, forecastlevels):
+    """
+    Reads the headers of every message in an open grib without decoding any values. Returns {typeOfLevel: {name:
+    set of levels}} with the names from message_names and the levels from vertical_value, or None for the types of
+    level not in VERTICAL_LEVELS.
+    """
+    inventory = {}
+    for message in gribfile:
+        level = message.typeOfLevel
+        if level not in forecastlevels:
+            continue
+        value = vertical_value(message) if level in VERTICAL_LEVELS else None
+        for name in message_names(message):
+            inventory.setdefault(level, {}).setdefault(name, set()).add(value)
+    return inventory
+
+
+def vertical_levels(inventory):
+    """
+    Finds the variables in a grib_inventory that come at more than one level of a type in VERTICAL_LEVELS. Returns
+    {typeOfLevel: {'variables': set of names, 'values': every level of those variables in ascending order of their
+    coordinates}}. Variables found at only one level keep their (time, lat, lon) shape.
+    """
+    verticals = {}
+    for level, variables in inventory.items():
+        several = {name: values for name, values in variables.items() if len(values) > 1}
+        if level in VERTICAL_LEVELS and several:
+            values = sorted(set().union(*several.values()), key=lambda value: (vertical_coordinate(value), value))
+            verticals[level] = {'variables': set(several), 'values': values}
+    return verticals
+
+
+def new_vertical_dimension(new_nc, level, values):
+    """
+    Adds the vertical dimension and coordinate variable for a type of level to a netcdf, values are its levels from
+    vertical_value. The LAYERS also get a name_bounds variable with the two surfaces of each layer.
+    """
+    name, units, positive, factor = VERTICAL_LEVELS[level]
+    new_nc.createDimension(name, len(values))
+    new_nc.createVariable(varname=name, datatype='f4', dimensions=name)
+    new_nc[name].axis = 'Z'
+    new_nc[name].units = units
+    new_nc[name].positive = positive
+    new_nc[name][:] = [vertical_coordinate(value) for value in values]
+    if level in LAYERS:
+        new_nc.createDimension('nv', 2)
+        new_nc.createVariable(varname=name + '_bounds', datatype='f4', dimensions=(name, 'nv'))
+        new_nc[name + '_bounds'][:] = values
+        new_nc[name].bounds = name + '_bounds'
+    return name
+
+
+def check_vertical_levels(netcdfs, forecastlevels):
+    """
+    Checks that the netcdfs of every step of a level have the same vertical levels, which they need to be aggregated
+    along time. Raises ValueError naming the first step that is different.
+    """
+    for level in forecastlevels:
+        vertical = VERTICAL_LEVELS.get(level, ('',))[0]
+        files = sorted(nc for nc in os.listdir(netcdfs) if nc.startswith(level + '_') and nc.endswith('.nc'))
+        expected = None
+        for position, nc in enumerate(files):
+            with netCDF4.Dataset(os.path.join(netcdfs, nc), 'r') as dataset:
+                values = read_vertical_values(dataset, vertical) if vertical in dataset.dimensions else None
+            if not position:
+                expected = values
+            elif values != expected:
+                raise ValueError('The ' + level + ' levels of ' + nc + ' (' + str(values) + ') are not the levels of ' +
+                                 files[0] + ' (' + str(expected) + '). Steps with different levels can\'t be joined')
+    return
+
+
+def netcdf_options(compress=True, chunks=(1, 90, 180), complevel=4, pack=False):
+    """
+    Settings for how the data variables are written. chunks is a (time, lat, lon) tuple or a string like '1,90,180'.
+    Small spatial chunks mean a point or small area time series only has to read and decompress a few chunks from
+    each file. pack stores the data as int16 with a scale_factor and add_offset, half the size of float32.
+    """
+    if isinstance(chunks, str):
+        chunks = tuple(int(i) for i in chunks.split(','))
+    return {'compress': compress, 'chunks': chunks, 'complevel': complevel, 'pack': pack}
+
+
+def new_data_variable(new_nc, name, dimensions, data, ncoptions=None):
+    """
+    Creates a data variable using the compression, chunking, and packing in ncoptions (see netcdf_options). data is
+    only used to choose the scale_factor and add_offset when packing. A (time, vertical, lat, lon) variable is always
+    chunked, with vertical_chunk levels per chunk (1 unless ncoptions says otherwise), so each message only touches
+    its own chunks and the levels a variable doesn't have are never stored. They aren't packed because the range of
+    the levels after the first isn't known when the variable is created.
+    """
+    ncoptions = ncoptions or {}
+    kwargs = {}
+    if ncoptions.get('compress'):
+        kwargs.update(zlib=True, shuffle=True, complevel=ncoptions.get('complevel', 4))
+    chunks = ncoptions.get('chunks')
+    if len(dimensions) == 4:
+        chunks = chunks or (1, 721, 1440)
+        chunks = (chunks[0], ncoptions.get('vertical_chunk', 1)) + tuple(chunks[1:])
+    if chunks:
+        sizes = [len(new_nc.dimensions[dim]) or 1 for dim in dimensions]
+        kwargs['chunksizes'] = tuple(max(1, min(chunk, size)) for chunk, size in zip(chunks, sizes))
+    if not ncoptions.get('pack') or len(dimensions) == 4:
+        return new_nc.createVariable(varname=name, datatype='f4', dimensions=dimensions, **kwargs)
+
+    # map the data's range onto -32766 to 32766, leaving -32768 for missing values
+    var = new_nc.createVariable(varname=name, datatype='i2', dimensions=dimensions, fill_value=-32768, **kwargs)
+    values = data.compressed() if numpy.ma.isMaskedArray(data) else numpy.asarray(data)
+    minimum, maximum = (float(values.min()), float(values.max())) if values.size else (0.0, 0.0)
+    var.scale_factor = (maximum - minimum) / 65532 if maximum > minimum else 1.0
+    var.add_offset = (maximum + minimum) / 2
+    return var
+
+
+def zarr_options(chunks=(1, 180, 360), cname='zstd', clevel=3):
+    """
+    Settings for the zarr copy of the cycle. chunks is a (time, lat, lon) tuple or a string like '1,180,360'. With a
+    time chunk of 1 every process writes its own chunks, larger time chunks make the processes share chunks so the
+    writes go through a file based ProcessSynchronizer.
+    """
+    if isinstance(chunks, str):
+        chunks = tuple(int(i) for i in chunks.split(','))
+    return {'chunks': chunks, 'cname': cname, 'clevel': clevel}
+
+
+def new_zarr_store(path, timestamp, forecastlevels, hours):
+    """
+    Creates the zarr store for a cycle with a group per level holding the time, lat, and lon coordinates. The data
+    arrays are created by the conversion processes as they find variables. Needs zarr 2.
+    """
+    import zarr
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    root = zarr.open_group(path, mode='w')
+    units = 'hours since ' + datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%Y-%m-%d %H:00:00")
+    for level in forecastlevels:
+        group = root.create_group(level)
+        group.attrs['gfs_level'] = level
+        coords = {
+            'time': numpy.array(hours, dtype='i4'),
+            'lat': LATITUDES,
+            'lon': LONGITUDES,
+        }
+        for name, values in coords.items():
+            array = group.array(name, values, chunks=values.shape)
+            # xarray reads the dimension names from this attribute
+            array.attrs['_ARRAY_DIMENSIONS'] = [name]
+        group['time'].attrs['units'] = units
+    return
+
+
+def write_zarr(zarroptions, level, name, data, attrs, vertical=None):
+    """
+    Writes one time step of a variable into the cycle's zarr store, creating the array if this is the first process
+    to see the variable. zarroptions is from zarr_options plus the path of the store and the step's time index.
+    For a variable with a vertical dimension, vertical is (the dimension's name, every level, the index of this
+    message's level) and the array gets one level per chunk.
+    """
+    import numcodecs
+    import zarr
+    path = zarroptions['path']
+    ntimes = zarroptions['ntimes']
+    shape = (ntimes, 721, 1440)
+    chunks = tuple(min(c, n) for c, n in zip(zarroptions['chunks'], shape))
+    dimensions = ['time', 'lat', 'lon']
+    index = zarroptions['index']
+    if vertical:
+        dimension, values, position = vertical
+        shape = (ntimes, len(values), 721, 1440)
+        chunks = (chunks[0], 1) + chunks[1:]
+        dimensions = ['time', dimension, 'lat', 'lon']
+        index = (index, position)
+    synchronizer = zarr.ProcessSynchronizer(path + '.sync') if chunks[0] > 1 else None
+    group = zarr.open_group(path, mode='a', synchronizer=synchronizer)[level]
+    if name not in group:
+        # several processes can find a new variable at the same time so creating arrays is done under a lock
+        with open(os.path.join(path, '.create.lock'), 'w') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            if vertical and dimension not in group:
+                coordinates = [vertical_coordinate(value) for value in values]
+                array = group.array(dimension, numpy.array(coordinates, dtype='f4'), chunks=(len(values),))
+                array.attrs['_ARRAY_DIMENSIONS'] = [dimension]
+                array.attrs.update(zip(('units', 'positive'), VERTICAL_LEVELS[level][1:3]))
+                if level in LAYERS:
+                    array.attrs['bounds'] = dimension + '_bounds'
+                    array = group.array(dimension + '_bounds', numpy.array(values, dtype='f4'), chunks=(len(values), 2))
+                    array.attrs['_ARRAY_DIMENSIONS'] = [dimension, 'nv']
+            compressor = numcodecs.Blosc(
+                cname=zarroptions['cname'], clevel=zarroptions['clevel'], shuffle=numcodecs.Blosc.SHUFFLE)
+            array = group.require_dataset(name, shape=shape, chunks=chunks, dtype='f4',
+                                          compressor=compressor, fill_value=numpy.nan)
+            array.attrs.update(attrs)
+            array.attrs['_ARRAY_DIMENSIONS'] = dimensions
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+    group[name][index] = numpy.ma.filled(data.astype('f4', copy=False), numpy.nan)
+    return
+
+
+def reorder_message(values):
+    """
+    Copies a decoded message into this process's reusable float32 buffer, flipping it to go south to north and
+    swapping its halves to go from 0-360 to -180-180 degrees longitude in a single strided copy. No new arrays are made
+    for the message unless it has a mask, which gets a reusable buffer of its own. The returned array is overwritten
+    by the next message so it has to be written out before the next message is reordered.
+    """
+    if 'data' not in BUFFER:
+        BUFFER['data'] = numpy.empty((721, 1440), dtype='f4')
+    data = BUFFER['data']
+    # viewing each row as (west half, east half) lets one copy reverse the rows and swap the halves
+    numpy.copyto(data.reshape(721, 2, 720), numpy.ma.getdata(values)[::-1].reshape(721, 2, 720)[:, ::-1])
+    if not numpy.ma.is_masked(values):
+        return data
+    if 'mask' not in BUFFER:
+        BUFFER['mask'] = numpy.empty((721, 1440), dtype=bool)
+    numpy.copyto(BUFFER['mask'].reshape(721, 2, 720), numpy.ma.getmaskarray(values)[::-1].reshape(721, 2, 720)[:, ::-1])
+    return numpy.ma.masked_array(data, mask=BUFFER['mask'], copy=False)
+
+
+def wind_speed(u, v, level=None):
+    return numpy.hypot(u, v)
+
+
+def wind_direction(u, v, level=None):
+    # the direction the wind blows from in degrees clockwise from north
+    return numpy.mod(180 + numpy.degrees(numpy.arctan2(u, v)), 360)
+
+
+def period_total(total, level=None):
+    # a message that is already the total for the period the derived variable asks for
+    return total
+
+
+def relative_humidity(q, t, pres, level=None):
+    """
+    Relative humidity in % from specific humidity (kg/kg), temperature (K), and pressure (Pa) using the saturation
+    vapor pressure over water from Bolton (1980)
+    """
+    vapor = q * pres / (0.622 + 0.378 * q)
+    saturation = 611.2 * numpy.exp(17.67 * (t - 273.15) / (t - 29.65))
+    return numpy.maximum(100 * vapor / saturation, 0)
+
+
+def isobaric_relative_humidity(q, t, level=None):
+    # on isobaric levels the pressure is the level, in hPa
+    return relative_humidity(q, t, level * 100)
+
+
+# Variables computed from the grib's messages while converting and written next to them, in the netcdf for the level
+# of their inputs. Each is computed at every level where the grib has all of its inputs, unless the grib already has a
+# variable with its name there. inputs are shortNames, or a shortName and a period like tp_6h (see message_names),
+# passed to function in order along with the level. levels limits the types of level it is computed for. Add
+# anything computed here to the app's options.gfs_variables and variable_levels
+DERIVED_VARIABLES = [
+    {'name': '10si', 'inputs': ('10u', '10v'), 'function': wind_speed,
+     'units': 'm s**-1', 'long_name': '10 metre wind speed'},
+    {'name': '10wdir', 'inputs': ('10u', '10v'), 'function': wind_direction,
+     'units': 'Degree true', 'long_name': '10 metre wind direction'},
+    {'name': '100si', 'inputs': ('100u', '100v'), 'function': wind_speed,
+     'units': 'm s**-1', 'long_name': '100 metre wind speed'},
+    {'name': '100wdir', 'inputs': ('100u', '100v'), 'function': wind_direction,
+     'units': 'Degree true', 'long_name': '100 metre wind direction'},
+    {'name': 'ws', 'inputs': ('u', 'v'), 'function': wind_speed,
+     'units': 'm s**-1', 'long_name': 'Wind speed'},
+    {'name': 'wdir', 'inputs': ('u', 'v'), 'function': wind_direction,
+     'units': 'Degree true', 'long_name': 'Wind direction'},
+    {'name': 'tp6', 'inputs': ('tp_6h',), 'function': period_total,
+     'units': 'kg m**-2', 'long_name': '6 hour total precipitation'},
+    {'name': 'r', 'inputs': ('q', 't'), 'function': isobaric_relative_humidity, 'levels': ('isobaricInhPa',),
+     'units': '%', 'long_name': 'Relative humidity'},
+    {'name': 'r', 'inputs': ('q', 't', 'pres'), 'function': relative_humidity,
+     'units': '%', 'long_name': 'Relative humidity'},
+]
+
+
+def derived_variables(inventory):
+    """
+    Finds the DERIVED_VARIABLES that can be computed from the messages in a grib_inventory. Returns {typeOfLevel:
+    {name: (the DERIVED_VARIABLES entry, the set of levels where the grib has every input)}}
+    """
+    derived = {}
+    for level, names in inventory.items():
+        for entry in DERIVED_VARIABLES:
+            if entry['name'] in names or entry['name'] in derived.get(level, {}):
+                continue
+            if level not in entry.get('levels', (level,)) or not all(name in names for name in entry['inputs']):
+                continue
+            values = set.intersection(*(names[name] for name in entry['inputs']))
+            if values:
+                derived.setdefault(level, {})[entry['name']] = (entry, values)
+    return derived
+
+
+def convert_grib(gribpath, netcdfs, timestamp, forecastlevels, ncoptions=None, zarroptions=None, domains=None):
+    """
+    Converts one grib file to a netcdf for each forecast level. The grib's headers are read once to find the
+    variables with several levels (see vertical_levels), then each message is decoded once and written to the netcdf
+    for its typeOfLevel which all stay open until the whole grib has been read. The DERIVED_VARIABLES are computed as
+    soon as all of their inputs have been decoded, only those inputs are kept in memory until then.
+    If zarroptions is given (see write_zarr) each message is also written to the cycle's zarr store.
+    domains is {name: [west, east, south, north]} (see read_domains), every level of each is also written to its own
+    folder in the cycle's domains folder, with the same file names.
+    Returns a list of messages describing grib messages that could not be converted, the bounds of every variable
+    that was, keyed by (shortName, level) and covering all its levels, and timings: the seconds spent decoding and
+    writing each level, the number of messages converted and skipped, and the peak memory of the process. This runs
+    in worker processes so it reports back instead of logging.
+    """
+    errors = []
+    bounds = {}
+    timings = {'decode': {}, 'write': {}, 'messages': 0, 'skipped': 0, 'derived': 0}
+    file = os.path.basename(gribpath)
+    hour = forecast_hour(timestamp, file)
+    data_time = file.replace('.grb', '')
+
+    # one open writer per level for this forecast step, and one per level of each domain with the rows and columns
+    # of the grid that it covers
+    writers = {}
+    outputs = {}
+    for level in forecastlevels:
+        ncpath = os.path.join(netcdfs, level + '_' + file.replace('.grb', '.nc'))
+        writers[level] = new_level_netcdf(ncpath, level, hour, data_time, LATITUDES, LONGITUDES)
+        outputs[level] = [(writers[level], slice(None), slice(None))]
+    for name, domain in (domains or {}).items():
+        rows, columns = domain_slices(domain)
+        for level in forecastlevels:
+            ncpath = os.path.join(os.path.dirname(netcdfs), 'domains', name, level + '_' + file.replace('.grb', '.nc'))
+            writers[(name, level)] = new_level_netcdf(
+                ncpath, level, hour, data_time, LATITUDES[rows], LONGITUDES[columns])
+            outputs[level].append((writers[(name, level)], rows, columns))
+
+    def write(level, name, value, data, attrs):
+        # writes a decoded message or a derived variable, a variable at several levels fills in one of its levels
+        vertical = verticals[level] if name in verticals.get(level, {}).get('variables', ()) else None
+        position = vertical['values'].index(value) if vertical else None
+        for new_nc, rows, columns in outputs[level]:
+            area = data[rows, columns]
+            if name not in new_nc.variables:
+                dimensions = ('time', vertical['dimension'], 'lat', 'lon') if vertical else ('time', 'lat', 'lon')
+                new_data_variable(new_nc, name, dimensions, area, ncoptions)
+                for attr, attr_value in attrs.items():
+                    new_nc[name].setncattr(attr, attr_value)
+                new_nc[name].gfs_level = level
+                new_nc[name].begin_date = data_time
+                new_nc[name].axis = 'lat lon'
+                if value is not None and not vertical:
+                    # the level of a variable found at only one level, e.g. height = 2 for 2t
+                    new_nc[name].setncattr(VERTICAL_LEVELS[level][0], vertical_coordinate(value))
+                    if level in LAYERS:
+                        new_nc[name].setncattr(VERTICAL_LEVELS[level][0] + '_bounds', list(value))
+            if vertical:
+                new_nc[name][0, position] = area
+            else:
+                new_nc[name][:] = area
+        if zarroptions:
+            write_zarr(zarroptions, level, name, data, dict(attrs, gfs_level=level),
+                       (vertical['dimension'], vertical['values'], position) if vertical else None)
+        stats = message_bounds(data)
+        if stats:
+            bounds[(name, level)] = merge_bounds(bounds.get((name, level)), stats)
+        return
+
+    try:
+        gribfile = pygrib.open(gribpath)
+        inventory = grib_inventory(gribfile, forecastlevels)
+        derived = derived_variables(inventory)
+        # the derived variables get a vertical dimension the same way as the grib's own
+        for level, entries in derived.items():
+            for name, (entry, values) in entries.items():
+                inventory[level][name] = values
+        verticals = vertical_levels(inventory)
+        for level, vertical in verticals.items():
+            for new_nc, rows, columns in outputs[level]:
+                vertical['dimension'] = new_vertical_dimension(new_nc, level, vertical['values'])
+
+        # how many derived variables still need each (level, name, value) message, and the copies kept for them
+        needed = {}
+        for level, entries in derived.items():
+            for name, (entry, values) in entries.items():
+                for value in values:
+                    for source in entry['inputs']:
+                        needed[(level, source, value)] = needed.get((level, source, value), 0) + 1
+        inputs = {}
+
+        gribfile.seek(0)
+        written = set()
+        for variable in gribfile:
+            level = variable.typeOfLevel
+            if level not in writers:
+                continue
+            short = variable.shortName
+            value = vertical_value(variable) if level in VERTICAL_LEVELS else None
+            # only the first message of a variable at a level is kept
+            keep = short not in ['time', 'lat', 'lon'] and (level, short, value) not in written
+            sources = [name for name in message_names(variable)
+                       if (level, name, value) in needed and (level, name, value) not in inputs]
+            if not keep and not sources:
+                continue
+            written.add((level, short, value))
+            try:
+                # decode the message into the buffer, flipped and shifted from 0-360 degrees to -180-180
+                start = time.time()
+                data = reorder_message(variable.values)
+                decoded = time.time()
+                timings['decode'][level] = timings['decode'].get(level, 0) + decoded - start
+                if keep:
+                    write(level, short, value, data, {'units': variable.units, 'long_name': variable.name})
+                    timings['messages'] += 1
+                # the buffer is reused by the next message so the derived variables get a copy
+                for name in sources:
+                    inputs[(level, name, value)] = data.copy()
+                for name, (entry, values) in derived.get(level, {}).items():
+                    keys = [(level, source, value) for source in entry['inputs']]
+                    if value not in values or not any(key[1] in sources for key in keys):
+                        continue
+                    if not all(key in inputs for key in keys):
+                        continue
+                    try:
+                        result = entry['function'](*(inputs[key] for key in keys), level=value)
+                        write(level, name, value, result, {'units': entry['units'], 'long_name': entry['long_name'],
+                                                           'derived_from': ' '.join(entry['inputs'])})
+                        timings['derived'] += 1
+                    except Exception as e:
+                        errors.append(file + ' ' + level + ' ' + name + ' (derived): ' + repr(e))
+                    for key in keys:
+                        needed[key] -= 1
+                        if not needed[key]:
+                            # keep the key so the message isn't copied again, drop the data
+                            inputs[key] = None
+                timings['write'][level] = timings['write'].get(level, 0) + time.time() - decoded
+            except Exception as e:
+                errors.append(file + ' ' + level + ' ' + short + ': ' + repr(e))
+                timings['skipped'] += 1
+        gribfile.close()
+    finally:
+        # close the files even if the grib can't be read so converting the step again can reopen them
+        for new_nc in writers.values():
+            new_nc.close()
+    timings['rss'] = peak_rss()
+    return errors, bounds, timings
+
+
+def append_step(folders, forecastlevels, steps, index, timestamp, ncoptions=None, remove=True):
+    """
+    Appends the netcdfs of steps[index] in each folder to the consolidated files of their levels and, if remove,
+    deletes them. A netcdf that is gone was appended by an earlier attempt, so an attempt that stopped partway
+    through can be run again. Used by GribConverter and coordinate.
+    """
+    hours = [forecast_hour(timestamp, grib_filename(timestamp, step)) for step in steps]
+    stepfile = grib_filename(timestamp, steps[index]).replace('.grb', '.nc')
+    for folder, level in ((folder, level) for folder in folders for level in forecastlevels):
+        steppath = os.path.join(folder, level + '_' + stepfile)
+        if os.path.exists(steppath):
+            append_to_consolidated(folder, level, steppath, index, hours, timestamp, ncoptions)
+            if remove:
+                os.remove(steppath)
+    return
+
+
+def append_to_consolidated(netcdfs, level, steppath, index, hours, timestamp, ncoptions=None):
+    """
+    Copies the data from one forecast step's netcdf into the level's consolidated netcdf (level.nc) at position
+    index of its time dimension, creating the file the first time. hours is the forecast hour of every time step.
+    The time dimension is unlimited and grows as steps are added, so when the steps are appended in order the file
+    only has the steps converted so far (see GribConverter).
+    Consolidated files are never packed because the range of later time steps isn't known yet. The grid is copied
+    from the step's netcdf so this works for the domains too.
+    """
+    path = os.path.join(netcdfs, level + '.nc')
+    step_nc = netCDF4.Dataset(steppath, 'r')
+    created = not os.path.exists(path)
+    if created:
+        new_nc = netCDF4.Dataset(path, 'w', format='NETCDF4')
+        new_nc.createDimension('time', None)
+        new_nc.createDimension('lat', len(step_nc.dimensions['lat']))
+        new_nc.createDimension('lon', len(step_nc.dimensions['lon']))
+        new_nc.createVariable(varname='time', datatype='i4', dimensions='time')
+        new_nc['time'].axis = 'T'
+        new_nc['time'].units = 'hours since ' + \
+                               datetime.datetime.strptime(timestamp, "%Y%m%d%H").strftime("%Y-%m-%d %H:00:00")
+        new_nc.createVariable(varname='lat', datatype='f4', dimensions='lat')
+        new_nc['lat'].axis = 'lat'
+        new_nc['lat'][:] = step_nc['lat'][:]
+        new_nc.createVariable(varname='lon', datatype='f4', dimensions='lon')
+        new_nc['lon'].axis = 'lon'
+        new_nc['lon'][:] = step_nc['lon'][:]
+        new_nc.gfs_level = level
+    else:
+        new_nc = netCDF4.Dataset(path, 'a')
+
+    # the steps are in one file so they have to have the same vertical levels
+    vertical = VERTICAL_LEVELS.get(level, ('',))[0]
+    values = read_vertical_values(step_nc, vertical) if vertical in step_nc.dimensions else None
+    if created and values:
+        new_vertical_dimension(new_nc, level, values)
+    elif not created:
+        existing = read_vertical_values(new_nc, vertical) if vertical in new_nc.dimensions else None
+        if values != existing:
+            step_nc.close()
+            new_nc.close()
+            raise ValueError('The ' + level + ' levels of ' + steppath + ' (' + str(values) + ') are not the levels ' +
+                             'of the steps already in ' + path + ' (' + str(existing) + ')')
+
+    new_nc['time'][index] = hours[index]
+    unpacked = dict(ncoptions or {}, pack=False)
+    # each step's levels are copied all at once, so with spatial chunks a chunk can hold the whole column which makes
+    # a vertical profile one chunk per time step
+    if values and unpacked.get('chunks'):
+        unpacked['vertical_chunk'] = len(values)
+    for name, variable in step_nc.variables.items():
+        if name in ('time', 'lat', 'lon', vertical, vertical + '_bounds'):
+            continue
+        if name not in new_nc.variables:
+            new_data_variable(new_nc, name, ('time',) + variable.dimensions[1:], None, unpacked)
+            for attr in ('units', 'long_name', 'gfs_level', 'axis', vertical, vertical + '_bounds'):
+                if attr in variable.ncattrs():
+                    new_nc[name].setncattr(attr, variable.getncattr(attr))
+        new_nc[name][index] = variable[0]
+    step_nc.close()
+    new_nc.close()
+    return
+
+
+def write_cube(path, values, header):
+    """
+    Writes a cube: a CUBE_HEADER byte header, b'GFSCUBE1' then json padded with spaces, followed by the float32
+    values of a variable in (vertical, lat, lon, time) order, time varying fastest. The timeseries of a cell is then
+    ntimes contiguous values found arithmetically from the regular grid described in the header, so it can be read
+    by memory mapping the file without any netcdf overhead. values yields a (lat, lon, time) array for each level.
+    """
+    text = b'GFSCUBE1' + json.dumps(header).encode()
+    if len(text) > CUBE_HEADER:
+        raise ValueError('The header of ' + path + ' is longer than ' + str(CUBE_HEADER) + ' bytes')
+    with open(path + '.tmp', 'wb') as f:
+        f.write(text.ljust(CUBE_HEADER))
+        for block in values:
+            block.astype('<f4', copy=False).tofile(f)
+    os.replace(path + '.tmp', path)
+    return
+
+
+def write_level_cubes(netcdfs, cubes, level, timestamp):
+    """
+    Writes a cube (see write_cube) for every variable of a level to cubes/level/name.cube, from the level's
+    consolidated netcdf or its netcdf for each step. Each level of a variable is collected as one (lat, lon, time)
+    array in memory so the cube is written in one sequential pass. Runs in worker processes so it returns the number
+    of cubes written instead of logging.
+    """
+    consolidated = os.path.join(netcdfs, level + '.nc')
+    if os.path.exists(consolidated):
+        datasets = [netCDF4.Dataset(consolidated, 'r')]
+        hours = [int(hour) for hour in datasets[0]['time'][:]]
+    else:
+        files = sorted(nc for nc in os.listdir(netcdfs) if nc.startswith(level + '_') and nc.endswith('.nc'))
+        datasets = [netCDF4.Dataset(os.path.join(netcdfs, nc), 'r') for nc in files]
+        hours = [forecast_hour(timestamp, nc) for nc in files]
+    written = 0
+    try:
+        if not datasets:
+            return written
+        folder = os.path.join(cubes, level)
+        first = datasets[0]
+        vertical = VERTICAL_LEVELS.get(level, ('',))[0]
+        for name, variable in first.variables.items():
+            if name in ('time', 'lat', 'lon', vertical, vertical + '_bounds'):
+                continue
+            levels = first[vertical][:].tolist() if variable.ndim == 4 else None
+
+            def blocks(name=name, levels=levels):
+                # one level at a time, filled in time step by time step
+                block = numpy.empty((len(LATITUDES), len(LONGITUDES), len(hours)), dtype='f4')
+                for position in range(len(levels) if levels else 1):
+                    index = 0
+                    for dataset in datasets:
+                        data = dataset[name][:, position] if levels else dataset[name][:]
+                        for step in numpy.ma.filled(data.astype('f4'), numpy.nan):
+                            block[:, :, index] = step
+                            index += 1
+                    yield block
+
+            header = {
+                'name': name, 'level': level, 'timestamp': timestamp, 'hours': hours,
+                'units': variable.getncattr('units') if 'units' in variable.ncattrs() else '',
+                'long_name': variable.getncattr('long_name') if 'long_name' in variable.ncattrs() else name,
+                'vertical': {'name': vertical, 'values': levels} if levels else None,
+                'shape': [len(levels) if levels else 1, len(LATITUDES), len(LONGITUDES), len(hours)],
+                'dtype': '<f4', 'lat0': float(LATITUDES[0]), 'lon0': float(LONGITUDES[0]), 'resolution': .25,
+            }
+            os.makedirs(folder, exist_ok=True)
+            write_cube(os.path.join(folder, name + '.cube'), blocks(), header)
+            written += 1
+    finally:
+        for dataset in datasets:
+            dataset.close()
+    return written
+
+
+def conversion_metrics(step, timings):
+    # the measurements of one converted step as recorded by Metrics, timings is the last thing convert_grib returns
+    fields = dict(timings, step=step)
+    for kind in ('decode', 'write'):
+        fields[kind] = {level: round(seconds, 4) for level, seconds in timings[kind].items()}
+    if 'consolidate' in fields:
+        fields['consolidate'] = round(fields['consolidate'], 4)
+    return fields
+
+
+class GribConverter:
+    """
+    Converts grib files to netcdfs (and optionally zarr) and keeps track of everything that has to happen once a step
+    is converted: logging its problems, collecting its WMS bounds, recording it in converted.json, appending it to the
+    consolidated files and deleting its grib. Steps are appended to the consolidated files in forecast order, a step
+    that converts before the ones ahead of it waits in its own netcdfs until they are done. Because the converted
+    steps are recorded, a conversion that is run again only redoes the steps that failed or never ran. A step that
+    can't be appended stops the appending for the rest of the run and fails it (see append_steps). Used by
+    grib_to_netcdf, which converts a folder of gribs, and stream_gfs, which converts gribs as they download.
+
+    steps: every step in the cycle, which sets the time index and forecast hour of each file
+    workers: with more than 1, files are converted in a pool of processes. Otherwise they convert in the caller
+    journal: a Journal to record the status of each step in
+    metrics: a Metrics to record the decode and write times of each file in
+    memory: a ceiling in MB for the memory used by converting, which limits the number of processes
+    stream: the partial ncmls serve the steps from their own netcdfs while the cycle streams in, so they are only
+        appended to the consolidated files by finish and their netcdfs are kept until publish
+    see grib_to_netcdf for ncoptions, consolidate, zarroptions, domains, and cubes
+    """
+    def __init__(self, threddspath, timestamp, forecastlevels, steps, workers=1, ncoptions=None, consolidate=False,
+                 zarroptions=None, journal=None, metrics=None, memory=None, domains=None, cubes=False, stream=False):
+        self.threddspath = threddspath
+        self.timestamp = timestamp
+        self.forecastlevels = forecastlevels
+        self.gribs = os.path.join(staging_path(threddspath, timestamp), 'gribs')
+        self.netcdfs = os.path.join(staging_path(threddspath, timestamp), 'netcdfs')
+        self.steps = list(steps)
+        self.files = [grib_filename(timestamp, step) for step in self.steps]
+        self.hours = [forecast_hour(timestamp, file) for file in self.files]
+        self.workers = workers
+        self.ncoptions = ncoptions
+        self.consolidate = consolidate
+        self.zarroptions = zarroptions
+        self.journal = journal
+        self.metrics = metrics
+        self.memory = memory
+        self.domains = read_domains(domains) if domains else {}
+        self.cubes = cubes
+        self.stream = stream
+        self.bounds = {}
+        self.failed = []
+        # the number of steps from the first that are in the consolidated files
+        self.appended = 0
+        # why appending a step to the consolidated files failed, nothing more is appended once it has
+        self.append_error = None
+        self.pool = None
+        self.start_time = time.time()
+        self.converted = read_converted(self.gribs)
+        for step, step_bounds in self.converted.items():
+            self.add_bounds(step, step_bounds)
+
+    def start(self):
+        # keep the netcdfs and zarr store when resuming from an earlier attempt that converted some steps
+        resume = bool(self.converted)
+        if resume:
+            logging.info(str(len(self.converted)) + ' steps were converted by an earlier attempt, resuming')
+        if not resume or not os.path.exists(self.netcdfs):
+            # remove anything in the folder before starting (in case there was a partial conversion)
+            if os.path.exists(self.netcdfs):
+                shutil.rmtree(self.netcdfs)
+            os.mkdir(self.netcdfs)
+            os.chmod(self.netcdfs, 0o777)
+        if self.domains:
+            new_domains(os.path.dirname(self.netcdfs), self.domains, clean=not resume)
+        if self.zarroptions:
+            zarrpath = os.path.join(os.path.dirname(self.netcdfs), 'gfs.zarr')
+            if not resume or not os.path.exists(zarrpath):
+                new_zarr_store(zarrpath, self.timestamp, self.forecastlevels, self.hours)
+            self.zarroptions = dict(self.zarroptions, path=zarrpath, ntimes=len(self.hours))
+        if self.consolidate and not self.stream:
+            # finish appending the steps an earlier attempt converted
+            self.append_steps()
+        if self.memory:
+            self.workers = conversion_workers(self.threddspath, self.workers, self.memory)
+        if self.workers > 1:
+            logging.info('converting with ' + str(self.workers) + ' processes')
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        return
+
+    def submit(self, step):
+        """
+        Starts converting a step's grib and returns a future for convert_grib's result. Without a pool the conversion
+        runs right away and the returned future is already done.
+        """
+        file = grib_filename(self.timestamp, step)
+        if self.journal:
+            self.journal.step('convert', step, 'running')
+        zarroptions = dict(self.zarroptions, index=self.steps.index(step)) if self.zarroptions else None
+        args = (os.path.join(self.gribs, file), self.netcdfs, self.timestamp, self.forecastlevels, self.ncoptions,
+                zarroptions, self.domains)
+        if self.pool:
+            return self.pool.submit(convert_grib, *args)
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(convert_grib(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def collect(self, step, future):
+        """
+        Handles the result of a finished conversion. Returns the step's bounds, or None if the step failed
+        """
+        file = grib_filename(self.timestamp, step)
+        try:
+            errors, file_bounds, timings = future.result()
+            missing = [path for path in self.step_netcdfs(step) if not os.path.exists(path)]
+            if missing:
+                raise FileNotFoundError('the conversion did not write ' + ', '.join(missing))
+        except Exception as e:
+            logging.info('  FAILED converting ' + file + ': ' + repr(e))
+            self.failed.append(file)
+            if self.journal:
+                self.journal.step('convert', step, 'failed', repr(e))
+            return None
+        for error in errors:
+            logging.info('  skipped ' + error)
+        # the step's netcdfs are all written so it never has to be converted again
+        self.converted[step] = file_bounds
+        write_converted(self.gribs, self.converted)
+        self.add_bounds(step, file_bounds)
+        os.remove(os.path.join(self.gribs, file))
+        start = time.time()
+        if self.consolidate and not self.stream:
+            self.append_steps()
+        timings['consolidate'] = time.time() - start
+        if step not in self.converted:
+            # appending it failed
+            return None
+        if self.journal:
+            self.journal.step('convert', step, 'complete')
+        if self.metrics:
+            self.metrics.record('convert', **conversion_metrics(step, timings))
+        logging.info('converted ' + file + ' (' + str(round(time.time() - self.start_time, 2)) + 's elapsed)')
+        return file_bounds
+
+    def folders(self):
+        # the global netcdfs folder and each domain's
+        return [self.netcdfs] + [os.path.join(os.path.dirname(self.netcdfs), 'domains', name) for name in self.domains]
+
+    def step_netcdfs(self, step):
+        # the paths of the netcdfs convert_grib writes for a step
+        stepfile = grib_filename(self.timestamp, step).replace('.grb', '.nc')
+        return [os.path.join(folder, level + '_' + stepfile)
+                for folder in self.folders() for level in self.forecastlevels]
+
+    def append_steps(self):
+        """
+        Appends the steps that are ready to the consolidated files (see consolidate_run). If a step can't be appended,
+        e.g. because its vertical levels aren't the ones of the steps before it, nothing else is appended for the rest
+        of the run, so the steps after it wait in their own netcdfs instead of failing one by one, and finish fails
+        the run. The step is forgotten so the next run downloads and converts it again. Its netcdfs are deleted, or
+        when streaming, where the partial ncmls still serve them, the consolidated files are deleted instead since
+        they are made again from the steps' netcdfs.
+        """
+        if self.append_error:
+            return
+        try:
+            self.consolidate_run(remove=not self.stream)
+        except Exception as e:
+            step = self.steps[self.appended]
+            self.append_error = 'appending ' + self.files[self.appended] + ' to the consolidated files: ' + repr(e)
+            logging.info('  FAILED ' + self.append_error)
+            # only delete the consolidated files if every step in them still has its netcdfs to make them again from
+            rebuild = all(os.path.exists(path) for converted in self.converted for path in self.step_netcdfs(converted))
+            self.converted.pop(step, None)
+            write_converted(self.gribs, self.converted)
+            if not self.stream:
+                paths = self.step_netcdfs(step)
+            elif rebuild:
+                paths = [os.path.join(folder, level + '.nc')
+                         for folder in self.folders() for level in self.forecastlevels]
+            else:
+                paths = []
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            if self.journal:
+                self.journal.step('convert', step, 'failed', self.append_error)
+        return
+
+    def consolidate_run(self, remove=True):
+        """
+        Appends the converted steps that come next in forecast order to the consolidated files. A step's netcdfs are
+        deleted once appended unless remove is False, so a step whose netcdfs are gone was appended by an earlier
+        attempt. Appending a step again only writes the same values to the same time index.
+        """
+        while self.appended < len(self.steps) and self.steps[self.appended] in self.converted:
+            append_step(self.folders(), self.forecastlevels, self.steps, self.appended, self.timestamp, self.ncoptions,
+                        remove)
+            self.appended += 1
+        return
+
+    def add_bounds(self, step, file_bounds):
+        hour = self.hours[self.steps.index(step)]
+        for key, stats in file_bounds.items():
+            self.bounds.setdefault(key, {})[hour] = stats
+        return
+
+    def abort(self):
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+        return
+
+    def finish(self):
+        """
+        Shuts down the pool and, if every file converted, writes the cubes and WMS bounds and finalizes the zarr store.
+        When streaming, this is where the steps are appended to the consolidated files. Returns False if any file
+        failed.
+        """
+        if self.failed:
+            if self.pool:
+                self.pool.shutdown()
+            logging.info('Conversion failed for ' + ', '.join(sorted(self.failed)) + '. Keeping their gribs to retry')
+            return False
+        if self.consolidate and self.stream:
+            self.append_steps()
+        if self.append_error:
+            if self.pool:
+                self.pool.shutdown()
+            logging.info('Consolidation failed ' + self.append_error + '. It will be downloaded and converted again by '
+                         'the next run, run with clobber to start the cycle over if its levels are the ones that are '
+                         'wrong')
+            return False
+        if not self.consolidate:
+            # the consolidated files were checked as each step was appended
+            try:
+                check_vertical_levels(self.netcdfs, self.forecastlevels)
+            except ValueError as e:
+                if self.pool:
+                    self.pool.shutdown()
+                logging.info('FAILED ' + str(e))
+                return False
+        if self.cubes:
+            self.write_cubes()
+        if self.pool:
+            self.pool.shutdown()
+        write_wmsbounds(self.bounds)
+        if self.zarroptions:
+            import zarr
+            zarr.consolidate_metadata(self.zarroptions['path'])
+            if os.path.exists(self.zarroptions['path'] + '.sync'):
+                shutil.rmtree(self.zarroptions['path'] + '.sync')
+            logging.info('Wrote the zarr store ' + self.zarroptions['path'])
+        return True
+
+    def write_cubes(self):
+        # the cubes need every time step so they are written once all the steps are converted, a level per process
+        start = time.time()
+        cubes = os.path.join(os.path.dirname(self.netcdfs), 'cubes')
+        if os.path.exists(cubes):
+            shutil.rmtree(cubes)
+        args = [(self.netcdfs, cubes, level, self.timestamp) for level in self.forecastlevels]
+        if self.pool:
+            written = sum(self.pool.map(write_level_cubes, *zip(*args)))
+        else:
+            written = sum(write_level_cubes(*arg) for arg in args)
+        logging.info('wrote ' + str(written) + ' cubes in ' + str(round(time.time() - start, 2)) + 's')
+        return
+
+
+def grib_to_netcdf(threddspath, timestamp, forecastlevels, workers=1, ncoptions=None, consolidate=False,
+                   zarroptions=None, journal=None, metrics=None, memory=None, domains=None, cubes=False):
+    """
+    Converts every grib to netcdfs. With workers > 1 the grib files are spread across a pool of processes, one file
+    per task. The output names depend only on the level and the grib's name so they are the same either way.
+    ncoptions controls compression, chunking and packing of the output, see netcdf_options.
+    With consolidate, each step is appended to one file per level (level.nc) with a time dimension as soon as it and
+    the steps before it are converted, and the single step files are deleted. Only this process writes to the
+    consolidated files.
+    With zarroptions (see zarr_options) the cycle is also written to gfs.zarr by the conversion processes.
+    memory is a ceiling in MB that limits how many of the workers are started, see conversion_workers.
+    domains is the path to a json file of regional domains (see read_domains) to also write on their own.
+    With cubes, a cube of each variable at each level is written once every step is converted, see write_cube.
+    The WMS bounds are collected from the converted data and written to bounds.js once every file is done.
+    Each grib is deleted once it is converted. Returns False if any file failed to convert, leaving its grib in place
+    so that running the conversion again only converts the steps that failed.
+    """
     logging.info('\nStarting Grib Conversions')
     # setting the environment file paths
-    gribs = os.path.join(threddspath, timestamp, 'gribs')
-    netcdfs = os.path.join(threddspath, timestamp, 'netcdfs')
+    gribs = os.path.join(staging_path(threddspath, timestamp), 'gribs')
 
     # if you already have gfs netcdfs in the netcdfs folder, quit the function
     if not os.path.exists(gribs):
         logging.info('There are no gribs to convert, you must have already run this step. Skipping conversion')
-        return
-    # otherwise, remove anything in the folder before starting (in case there was a partial conversion)
-    else:
-        shutil.rmtree(netcdfs)
-        os.mkdir(netcdfs)
-        os.chmod(netcdfs, 0o777)
+        return True
 
-    # for each grib file you downloaded, open it, convert it to a netcdf
-    files = os.listdir(gribs)
-    files = [grib for grib in files if grib.endswith('.grb')]
-    for level in forecastlevels:
-        logging.info('working on level ' + level)
-        start = time.time()
-        hour = 6
-        latitudes = [-90 + (i * .25) for i in range(721)]
-        longitudes = [-180 + (i * .25) for i in range(1440)]
-        time_dt = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
-        for file in files:
-            # create the new netcdf
-            ncname = level + '_' + file.replace('.grb', '.nc')
-            ncpath = os.path.join(netcdfs, ncname)
-            new_nc = netCDF4.Dataset(ncpath, 'w', clobber=True, format='NETCDF4', diskless=False)
-
-            data_time = time_dt + datetime.timedelta(hours=hour)
-            data_time = data_time.strftime("%Y%m%d%H")
-
-            new_nc.createDimension('time', 1)
-            new_nc.createDimension('lat', 721)
-            new_nc.createDimension('lon', 1440)
-
-            new_nc.createVariable(varname='time', datatype='f4', dimensions='time')
-            new_nc['time'].axis = 'T'
-            new_nc['time'].begin_date = data_time
-            new_nc.createVariable(varname='lat', datatype='f4', dimensions='lat')
-            new_nc['lat'].axis = 'lat'
-            new_nc.createVariable(varname='lon', datatype='f4', dimensions='lon')
-            new_nc['lon'].axis = 'lon'
-
-            # set the value of the time variable data
-            new_nc['time'][:] = [hour]
-
-            # read a file to get the lat/lon variable data
-            new_nc['lat'][:] = latitudes
-            new_nc['lon'][:] = longitudes
-
-            gribpath = os.path.join(gribs, file)
-            gribfile = pygrib.open(gribpath)
-            gribfile.seek(0)
-            filtered_grib = gribfile(typeOfLevel=level)
-            for variable in filtered_grib:
-                short = variable.shortName
-                if short not in ['time', 'lat', 'lon']:
-                    try:
-                        new_nc.createVariable(varname=short, datatype='f4', dimensions=('time', 'lat', 'lon'))
-                        new_nc[short].units = variable.units
-                        new_nc[short].long_name = variable.name
-                        new_nc[short].gfs_level = level
-                        new_nc[short].begin_date = data_time
-                        new_nc[short].axis = 'lat lon'
-
-                        # get array, flip vertical, split and concat to shift from 0-360 degrees to 180-180
-                        data = numpy.flip(variable.values, 0)
-                        data = numpy.hsplit(data, 2)
-                        data = numpy.concatenate((data[1], data[0]), axis=1)
-                        new_nc[short][:] = data
-                    except:
-                        pass
-            hour += 6
-            new_nc.close()
-            gribfile.close()
-            logging.info('  Process took ' + str(round(time.time() - start, 2)))
+    # for each grib file you downloaded, read it once and write the netcdfs for every level
+    converter = GribConverter(threddspath, timestamp, forecastlevels, FC_STEPS, workers=workers, ncoptions=ncoptions,
+                              consolidate=consolidate, zarroptions=zarroptions, journal=journal, metrics=metrics,
+                              memory=memory, domains=domains, cubes=cubes)
+    converter.start()
+    futures = {}
+    for step in FC_STEPS:
+        if step not in converter.converted:
+            futures[converter.submit(step)] = step
+    for future in concurrent.futures.as_completed(futures):
+        converter.collect(futures[future], future)
+    if not converter.finish():
+        return False
 
-    # delete the gribs now that you're done with them triggering future runs to skip the download step
+    # delete the gribs folder now that you're done with it triggering future runs to skip the download step
     shutil.rmtree(gribs)
 
     logging.info('Conversion Completed')
-    return
+    return True
+
+
+def read_converted(gribsdir):
+    # the steps that have already been converted (and had their gribs deleted) with their WMS bounds
+    path = os.path.join(gribsdir, 'converted.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        converted = json.loads(f.read())
+    # json can't have tuple keys so the bounds are saved as lists of [shortName, level, stats]
+    return {step: {(short, level): stats for short, level, stats in items} for step, items in converted.items()}
+
+
+def write_converted(gribsdir, converted):
+    path = os.path.join(gribsdir, 'converted.json')
+    saved = {step: [[short, level, stats] for (short, level), stats in items.items()]
+             for step, items in converted.items()}
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(saved))
+    os.replace(path + '.tmp', path)
+
 
+def write_catalog(threddspath, timestamp, hours, complete, partial=False):
+    """
+    Writes catalog.json describing which forecast hours of the cycle have been published, or partial_catalog.json for
+    the hours of a cycle that is still streaming
+    """
+    path = os.path.join(threddspath, 'partial_catalog.json' if partial else 'catalog.json')
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps({'timestamp': timestamp, 'hours': hours, 'complete': complete}))
+    os.replace(path + '.tmp', path)
+    os.chmod(path, 0o777)
+
+
+def stream_gfs(threddspath, timestamp, forecastlevels, connections=4, selection=None, workers=1, ncoptions=None,
+               consolidate=False, zarroptions=None, wait=0, journal=None, metrics=None, memory=None, domains=None,
+               cubes=False):
+    """
+    Downloads and converts at the same time. Each step is handed to the converter as soon as its download finishes
+    and its grib is deleted as soon as it has been converted, so only a few gribs are ever on disk. Every time the
+    run of converted steps starting from the first step gets longer, the partial ncml files and partial_catalog.json
+    are rewritten so the new forecast can be viewed before the whole cycle is done. The ncml files of the published
+    cycle aren't touched until publish. With consolidate the partial ncmls aggregate the steps' own netcdfs, which
+    are only appended to the consolidated files once every step is converted and deleted once it is published.
+    Returns False if any step failed.
+    """
+    logging.info('\nStarting the streaming download and conversion')
+    gribsdir = os.path.join(staging_path(threddspath, timestamp), 'gribs')
+    if not os.path.exists(gribsdir):
+        logging.info('There is no download folder, you must have already processed them. Skipping this stage.')
+        return True
 
-def new_ncml(threddspath, timestamp, forecastlevels):
+    files = [grib_filename(timestamp, step) for step in FC_STEPS]
+    converter = GribConverter(threddspath, timestamp, forecastlevels, FC_STEPS, workers=workers, ncoptions=ncoptions,
+                              consolidate=consolidate, zarroptions=zarroptions, journal=journal, metrics=metrics,
+                              memory=memory, domains=domains, cubes=cubes, stream=True)
+    converter.start()
+
+    # downloaded steps arrive as (step, None) and finished conversions as (step, future)
+    events = queue.Queue()
+
+    def on_download(step):
+        # called from the download threads. conversions are started on this thread because netCDF4 isn't thread
+        # safe, and without a pool the conversion runs wherever it is submitted
+        events.put((step, None))
+
+    outcome = []
+    downloader = threading.Thread(target=lambda: outcome.append(download_gfs(
+        threddspath, timestamp, connections=connections, selection=selection, on_download=on_download, wait=wait,
+        journal=journal, metrics=metrics)))
+    downloader.start()
+
+    published = 0
+    converting = 0
+    while downloader.is_alive() or converting or not events.empty():
+        try:
+            step, future = events.get(timeout=1)
+        except queue.Empty:
+            continue
+        if future is None:
+            converting += 1
+            converter.submit(step).add_done_callback(lambda done, step=step: events.put((step, done)))
+            continue
+        converting -= 1
+        if converter.collect(step, future) is None:
+            continue
+
+        # publish the steps converted so far if there are no gaps before them
+        run = 0
+        while run < len(FC_STEPS) and FC_STEPS[run] in converter.converted:
+            run += 1
+        if run > published:
+            published = run
+            new_ncml(threddspath, timestamp, forecastlevels, files=files[:run], partial=True)
+            write_catalog(threddspath, timestamp, converter.hours[:run], run == len(FC_STEPS), partial=True)
+            logging.info('published the first ' + str(run) + ' steps')
+    downloader.join()
+
+    if not outcome or not outcome[0]:
+        converter.abort()
+        return False
+    if not converter.finish():
+        return False
+    shutil.rmtree(gribsdir)
+    logging.info('Finished the streaming download and conversion')
+    return True
+
+
+def new_ncml(threddspath, timestamp, forecastlevels, files=None, partial=False):
+    """
+    Writes the ncml for each level. files limits the time steps to the netcdfs made from those grib file names.
+    partial points the ncml at the cycle while it is still in the staging folder and names it
+    <level>_partial_wms.ncml so the ncml of the published cycle is left alone. A partial ncml always aggregates the
+    steps' own netcdfs, a consolidated file is only served once it is finished and published. Each ncml is written to
+    a temporary file and renamed over the old one so thredds never reads a half written file.
+    """
     logging.info('\nWriting a new ncml file for this date')
     # create a new ncml file by filling in the template with the right dates and writing to a file
     date = datetime.datetime.strptime(timestamp, "%Y%m%d%H")
     date = date.strftime("%Y-%m-%d %H:00:00")
-    netcdfs = os.listdir(os.path.join(threddspath, timestamp, 'netcdfs'))
-    for level in forecastlevels:
-        ncml = os.path.join(threddspath, level + '_wms.ncml')
-        level_ncs = [nc for nc in netcdfs if nc.startswith(level + '_') and nc.endswith('.nc')]
-        with open(ncml, 'w') as file:
-            file.write(
-                '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">\n' +
-                '   <variable name="time" type="int" shape="time">\n' +
-                '      <attribute name="units" value="hours since ' + date + '"/>\n' +
-                '      <attribute name="_CoordinateAxisType" value="Time" />\n' +
-                '       <values start="0" increment="6" />\n' +
-                '   </variable>\n' +
-                '   <aggregation dimName="time" type="joinExisting" recheckEvery="5 minutes">\n'
-            )
-            for nc in level_ncs:
+    location = 'staging/' + timestamp if partial else timestamp
+    suffix = '_partial_wms.ncml' if partial else '_wms.ncml'
+    # the regional domains get ncml files of their own named for the domain, e.g. conus_surface_wms.ncml
+    sources = [('netcdfs', '')]
+    domains = os.path.join(threddspath, location, 'domains')
+    if os.path.exists(domains):
+        sources += [('domains/' + name, name + '_') for name in sorted(os.listdir(domains))
+                    if os.path.isdir(os.path.join(domains, name))]
+    for folder, prefix in sources:
+        netcdfs = os.listdir(os.path.join(threddspath, location, folder))
+        for level in forecastlevels:
+            ncml = os.path.join(threddspath, prefix + level + suffix)
+            # a consolidated file already has a time dimension with units so it doesn't need an aggregation
+            if level + '.nc' in netcdfs and not partial:
+                with open(ncml + '.tmp', 'w') as file:
+                    file.write(
+                        '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2" location="' +
+                        location + '/' + folder + '/' + level + '.nc">\n' +
+                        '   <variable name="time">\n' +
+                        '      <attribute name="_CoordinateAxisType" value="Time" />\n' +
+                        '   </variable>\n' +
+                        '</netcdf>'
+                    )
+                os.replace(ncml + '.tmp', ncml)
+                logging.info('wrote ncml for ' + prefix + level)
+                continue
+            level_ncs = sorted(nc for nc in netcdfs if nc.startswith(level + '_') and nc.endswith('.nc'))
+            if files is not None:
+                level_ncs = [nc for nc in level_ncs if nc.replace(level + '_', '', 1).replace('.nc', '.grb') in files]
+            with open(ncml + '.tmp', 'w') as file:
+                file.write(
+                    '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2">\n' +
+                    '   <variable name="time" type="int" shape="time">\n' +
+                    '      <attribute name="units" value="hours since ' + date + '"/>\n' +
+                    '      <attribute name="_CoordinateAxisType" value="Time" />\n' +
+                    '       <values start="0" increment="6" />\n' +
+                    '   </variable>\n' +
+                    '   <aggregation dimName="time" type="joinExisting" recheckEvery="5 minutes">\n'
+                )
+                for nc in level_ncs:
+                    file.write(
+                        '      <netcdf location="' + location + '/' + folder + '/' + nc + '"/>\n'
+                    )
                 file.write(
-                    '      <netcdf location="' + timestamp + '/netcdfs/' + nc + '"/>\n'
+                    '   </aggregation>\n' +
+                    '</netcdf>'
                 )
-            file.write(
-                '   </aggregation>\n' +
-                '</netcdf>'
-            )
-        logging.info('wrote ncml for ' + level)
+            os.replace(ncml + '.tmp', ncml)
+            logging.info('wrote ncml for ' + prefix + level)
+    return
+
+
+def publish(threddspath, timestamp, forecastlevels):
+    """
+    Moves the finished cycle out of staging, points the ncml files at it, then swaps the current symlink and
+    last_run.txt over to it. Each of these is a rename, so anything reading the data sees either the old cycle or
+    the new one. The previous cycles are left in place for cleanup to retire.
+    """
+    logging.info('\nPublishing ' + timestamp)
+    final = os.path.join(threddspath, timestamp)
+    if os.path.exists(final):
+        # republishing the same timestamp (clobber), move the old copy aside before it is replaced
+        retired = os.path.join(threddspath, 'staging', timestamp + '.old')
+        if os.path.exists(retired):
+            shutil.rmtree(retired)
+        os.rename(final, retired)
+    os.rename(staging_path(threddspath, timestamp), final)
+    os.chmod(final, 0o777)
+    new_ncml(threddspath, timestamp, forecastlevels)
+    write_catalog(threddspath, timestamp, [int(step) for step in FC_STEPS], True)
+
+    # swap the pointers the app reads
+    pointer = os.path.join(threddspath, 'current')
+    if os.path.lexists(pointer + '.tmp'):
+        os.remove(pointer + '.tmp')
+    os.symlink(timestamp, pointer + '.tmp')
+    os.replace(pointer + '.tmp', pointer)
+    timefile = os.path.join(threddspath, 'last_run.txt')
+    with open(timefile + '.tmp', 'w') as file:
+        file.write(timestamp)
+    os.replace(timefile + '.tmp', timefile)
+    logging.info('current now points to ' + timestamp)
+    remove_partial(threddspath)
+    remove_consolidated_steps(final, forecastlevels)
+    return
+
+
+def remove_partial(threddspath):
+    # deletes the partial ncml files and partial_catalog.json written while a cycle was streaming (see stream_gfs)
+    for file in os.listdir(threddspath):
+        if file.endswith('_partial_wms.ncml') or file == 'partial_catalog.json':
+            os.remove(os.path.join(threddspath, file))
     return
 
 
-def cleanup(threddspath, timestamp):
-    # delete anything that isn't the new folder of data (named for the timestamp) or the new wms.ncml file
+def remove_consolidated_steps(cyclepath, forecastlevels):
+    # deletes the netcdfs of the steps of each consolidated level, which streaming keeps for the partial ncmls
+    folders = [os.path.join(cyclepath, 'netcdfs')]
+    domains = os.path.join(cyclepath, 'domains')
+    if os.path.exists(domains):
+        folders += [os.path.join(domains, name) for name in os.listdir(domains)
+                    if os.path.isdir(os.path.join(domains, name))]
+    for folder in folders:
+        netcdfs = os.listdir(folder)
+        for level in forecastlevels:
+            if level + '.nc' not in netcdfs:
+                continue
+            for nc in netcdfs:
+                if nc.startswith(level + '_') and nc.endswith('.nc'):
+                    os.remove(os.path.join(folder, nc))
+    return
+
+
+def cleanup(threddspath, timestamp, keep=2):
+    """
+    Deletes published cycles except the current one and the keep most recent before it, which stay around so
+    requests that started on an older cycle can finish and so the current pointer can be rolled back.
+    """
     logging.info('\nGetting rid of old data folders')
-    files = os.listdir(threddspath)
-    for file in files:
+    cycles = sorted((file for file in os.listdir(threddspath)
+                     if len(file) == 10 and file.isdigit() and os.path.isdir(os.path.join(threddspath, file))),
+                    reverse=True)
+    retained = [timestamp] + [cycle for cycle in cycles if cycle < timestamp][:keep]
+    for cycle in cycles:
+        if cycle not in retained:
+            logging.info('deleting ' + cycle)
+            shutil.rmtree(os.path.join(threddspath, cycle))
+    retired = os.path.join(threddspath, 'staging', timestamp + '.old')
+    if os.path.exists(retired):
+        shutil.rmtree(retired)
+    for file in os.listdir(threddspath):
         path = os.path.join(threddspath, file)
-        # keep last_run.txt, running.txt, ncml files, and the directory for the timestamp
-        if file.endswith('.txt') or file.endswith('.log') or file.endswith('.ncml') or file == timestamp:
+        if not os.path.islink(path):
             os.chmod(path, 0o777)
-            continue
-        # delete everything else
-        if os.path.isdir(path):
-            shutil.rmtree(path)
-        else:
-            os.remove(path)
-    logging.info('Done')
+    logging.info('Kept ' + ', '.join(retained))
     return
 
 
-def workflow(threddspath='', clobber='no'):
+def workflow(threddspath='', clobber='no', connections=4, selection=None, workers=1, ncoptions=None,
+             consolidate=False, zarroptions=None, stream=False, keep=2, detect=True, wait=None, promfile=None,
+             memory=None, domains=None, cubes=False):
     """
-    Accepts environment settings then runs the workflow functions in the order they should be executed
+    Accepts environment settings then runs the workflow functions in the order they should be executed. The progress
+    of every stage and step is recorded in journal.json (see Journal) and running the workflow again after a failure
+    resumes the same cycle, redoing only the steps that failed.
+
+    connections: the number of parallel downloads (and pooled http connections) to use against nomads
+    selection: path to a json file of the variables and levels to download, e.g. selection.json. None gets all
+    workers: the number of processes used to convert gribs to netcdfs
+    ncoptions: compression, chunking and packing for the netcdfs made with netcdf_options. None writes plain float32
+    consolidate: write one netcdf per level with every time step instead of one netcdf per level per time step
+    zarroptions: also write the cycle to a zarr store, made with zarr_options. Needs the zarr package
+    stream: convert each step as soon as it downloads and publish the forecast as it grows (see stream_gfs)
+    keep: how many cycles before the current one to keep for rollback and for requests still reading them
+    detect: pick the newest cycle nomads has started posting instead of assuming a cycle is ready 6 hours later
+    wait: seconds to keep polling for steps that aren't posted yet. None waits POSTING_WAIT seconds if the detected
+        cycle is still being posted and 0 otherwise
+    promfile: where to write the prometheus metrics of the run, see Metrics. metrics.jsonl keeps every run's metrics
+    memory: a ceiling in MB for converting, fewer than workers processes are used if they wouldn't fit
+    domains: path to a json file of regional domains to also write on their own, e.g. domains.json. The app reads
+        the smallest one that covers a chart's location
+    cubes: also write each variable at each level as a cube the app can read point timeseries from, see write_cube
     """
-    runlock = os.path.join(threddspath, 'running.txt')
+    # only one workflow can run on a folder at a time. take the lock before logging so the log of a running workflow
+    # isn't truncated by one that is about to give up
+    lock = acquire_lock(threddspath)
+    if not lock:
+        return 'Workflow Aborted- another workflow is running in this folder'
 
     # enable logging to track the progress of the workflow and for debugging
     logfile = os.path.join(threddspath, 'workflow.log')
     logging.basicConfig(filename=logfile, filemode='w', level=logging.INFO, format='%(message)s')
     logging.info('Workflow initiated on ' + datetime.datetime.utcnow().strftime("%D at %R"))
 
+    # the marker files older versions used to track the state of the workflow, the journal replaces them
+    for marker in ('running.txt', 'last_run_failed.txt'):
+        if os.path.exists(os.path.join(threddspath, marker)):
+            os.remove(os.path.join(threddspath, marker))
+
+    journal = Journal(threddspath)
+    journal.start()
+    metrics = Metrics(threddspath, promfile)
+    try:
+        message = run_stages(journal, metrics, threddspath, clobber, connections, selection, workers, ncoptions,
+                             consolidate, zarroptions, stream, keep, detect, wait, memory, domains, cubes)
+    except Exception as e:
+        logging.exception('\nWorkflow failed on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+        for stage in Journal.stages:
+            if journal.state['stages'][stage]['status'] == 'running':
+                journal.stage(stage, 'failed')
+        journal.finish('failed', repr(e))
+        raise
+    finally:
+        metrics.finish(journal.state['status'])
+        release_lock(lock)
+    return message
+
+
+def run_stages(journal, metrics, threddspath, clobber, connections, selection, workers, ncoptions, consolidate,
+               zarroptions, stream, keep, detect, wait, memory, domains, cubes):
+    """
+    Runs the stages of the workflow in order, recording each in the journal. Returns the workflow's final message
+    """
+    def abort(stage, message):
+        journal.stage(stage, 'failed')
+        journal.finish('failed', message)
+        logging.info('\nWorkflow aborted on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+        return 'Workflow Aborted- ' + message
+
     # handle the clobber option
-    if clobber in ['yes', 'true']:
-        logging.info('You chose the clobber option. the timestamps and all the data folders will be overwritten')
-        timefile = os.path.join(threddspath, 'last_run.txt')
-        with open(timefile, 'w') as file:
-            file.write('clobbered')
+    clobber = clobber in ['yes', 'true', True]
+    if clobber:
+        logging.info('You chose the clobber option. the data for this timestamp will be downloaded again')
 
-    forecastlevels = ['atmosphere', 'depthBelowLandLayer', 'heightAboveGround', 'heightAboveGroundLayer',
-                      'heightAboveSea', 'hybrid', 'isothermZero', 'isobaricInPa', 'isobaricInhPa', 'maxWind', 'meanSea',
-                      'nominalTop', 'potentialVorticity', 'pressureFromGroundLayer', 'sigma', 'sigmaLayer', 'surface',
-                      'tropopause', 'unknown']
+    forecastlevels = FORECAST_LEVELS
 
     # start running the workflow
-    timestamp, redundant = solve_environment(threddspath)
+    journal.stage('environment', 'running')
+    timestamp, redundant, posted = solve_environment(threddspath, clobber=clobber, detect=detect)
+    wait = posting_wait(posted, wait)
+    journal.cycle(timestamp)
+    metrics.timestamp = timestamp
+    journal.stage('environment', 'complete')
 
     # if this has already been done for the most recent forecast, abort the workflow
     if redundant:
         logging.info('\nWorkflow aborted on ' + datetime.datetime.utcnow().strftime("%D at %R"))
-        if os.path.isfile(runlock):
-            os.remove(runlock)
+        for stage in Journal.stages[1:]:
+            journal.stage(stage, 'skipped')
+        journal.finish('complete', 'already run for most recent data')
         return 'Workflow Aborted- already run for most recent data'
 
-    # get data from the gribs
-    if not download_gfs(threddspath, timestamp):
-        logging.info('\nWorkflow aborted on ' + datetime.datetime.utcnow().strftime("%D at %R"))
-        if os.path.isfile(runlock):
-            os.remove(runlock)
-        return 'Workflow Aborted- Downloading Errors Occurred'
-    set_wmsbounds(threddspath, timestamp)
+    # download and convert at the same time, publishing steps as they finish
+    if stream:
+        journal.stage('download', 'running')
+        journal.stage('convert', 'running')
+        if not stream_gfs(threddspath, timestamp, forecastlevels, connections=connections, selection=selection,
+                          workers=workers, ncoptions=ncoptions, consolidate=consolidate, zarroptions=zarroptions,
+                          wait=wait, journal=journal, metrics=metrics, memory=memory, domains=domains,
+                          cubes=cubes):
+            downloads = journal.state['stages']['download']['steps'].values()
+            downloaded = all(step['status'] == 'complete' for step in downloads)
+            journal.stage('download', 'complete' if downloaded else 'failed')
+            return abort('convert', 'Downloading or Conversion Errors Occurred')
+        journal.stage('download', 'complete')
+        journal.stage('convert', 'complete')
 
-    # convert to netcdfs
-    grib_to_netcdf(threddspath, timestamp, forecastlevels)
-    new_ncml(threddspath, timestamp, forecastlevels)
+    else:
+        # get data from the gribs
+        journal.stage('download', 'running')
+        if not download_gfs(threddspath, timestamp, connections=connections, selection=selection, wait=wait,
+                            journal=journal, metrics=metrics):
+            return abort('download', 'Downloading Errors Occurred')
+        journal.stage('download', 'complete')
+
+        # convert to netcdfs
+        journal.stage('convert', 'running')
+        if not grib_to_netcdf(threddspath, timestamp, forecastlevels, workers=workers, ncoptions=ncoptions,
+                              consolidate=consolidate, zarroptions=zarroptions, journal=journal, metrics=metrics,
+                              memory=memory, domains=domains, cubes=cubes):
+            return abort('convert', 'Conversion Errors Occurred')
+        journal.stage('convert', 'complete')
 
     # finish things up
-    cleanup(threddspath, timestamp)
-    os.remove(runlock)
-    with open(os.path.join(threddspath, 'last_run.txt'), 'w') as file:
-        file.write(timestamp)
+    journal.stage('publish', 'running')
+    publish(threddspath, timestamp, forecastlevels)
+    journal.stage('publish', 'complete')
+    journal.stage('cleanup', 'running')
+    cleanup(threddspath, timestamp, keep=keep)
+    journal.stage('cleanup', 'complete')
 
     logging.info('\n\nGFS Workflow completed successfully on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    journal.finish('complete', 'Normal Finish')
     return 'GFS Workflow Completed- Normal Finish'
 
 
-# execute this script with the path location to store gfs data as an argument
-if __name__ == '__main__':
-    path = sys.argv[1]
+def read_workqueue(threddspath):
+    # the cycle the coordinator has prepared for the workers and the options they should use, or None
+    path = os.path.join(threddspath, 'workqueue.json')
     if not os.path.exists(path):
-        print('This path does not exist. Please check the path and try again.')
-        exit()
-    elif os.path.isfile(os.path.join(path, 'last_run_failed.txt')):
-        print('Last run failed. You need to figure out why. Deleting old data and trying again')
-        shutil.rmtree(path)
-        os.mkdir(path)
-    elif os.path.isfile(os.path.join(path, 'running.txt')):
-        print('There is a running.txt file preventing another workflow run.')
-        exit()
+        return None
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+
+def failed_attempts(units, step):
+    # the failed attempts at a step recorded in its .failed file, oldest first
+    path = os.path.join(units, step + '.failed')
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.loads(f.read())['attempts']
+
+
+def write_unit(units, step, kind, record):
+    # writes a step's .done or .failed record in one rename so the coordinator never reads half of one
+    path = os.path.join(units, step + '.' + kind)
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(record))
+    os.replace(path + '.tmp', path)
+    return
+
+
+def claim_unit(units, stale=600, skip=(), attempts=UNIT_ATTEMPTS):
+    """
+    Claims the first step that isn't done, claimed by another worker, or already failed attempts times. A claim is a
+    .claim file created with O_EXCL, which only one worker can do even when the workers are on different machines
+    sharing the folder. Workers touch their claims while they work so a claim that hasn't changed in stale seconds
+    belonged to a worker that died and is broken so the step can be claimed again. Returns the step or None if there is
+    nothing left to claim.
+    """
+    for step in FC_STEPS:
+        done = os.path.join(units, step + '.done')
+        claim = os.path.join(units, step + '.claim')
+        if step in skip or os.path.exists(done) or len(failed_attempts(units, step)) >= attempts:
+            continue
+        try:
+            if time.time() - os.path.getmtime(claim) < stale:
+                continue
+            # rename is atomic so only one of the workers that found the stale claim gets to break it
+            broken = claim + '.' + socket.gethostname() + '.' + str(os.getpid())
+            os.rename(claim, broken)
+            os.remove(broken)
+            logging.info('broke the stale claim on step ' + step)
+        except FileNotFoundError:
+            pass
+        try:
+            descriptor = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o777)
+        except FileExistsError:
+            continue
+        with os.fdopen(descriptor, 'w') as f:
+            f.write(json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'claimed': utc_stamp()}))
+        # another worker may have finished the step between the check and the claim
+        if os.path.exists(done):
+            os.remove(claim)
+            continue
+        return step
+    return None
+
+
+def run_unit(session, threddspath, timestamp, step, selection=None, ncoptions=None, domains=None, wait=0):
+    """
+    Downloads and converts one step for a worker, then records its bounds in the step's .done file for the
+    coordinator along with its download and conversion metrics. The netcdfs are written per step, the coordinator
+    consolidates them if it was asked to. wait is how many seconds to wait for the step if it isn't posted yet.
+    """
+    gribsdir = os.path.join(staging_path(threddspath, timestamp), 'gribs')
+    netcdfs = os.path.join(staging_path(threddspath, timestamp), 'netcdfs')
+    filepath = os.path.join(gribsdir, grib_filename(timestamp, step))
+    start = time.time()
+    if selection:
+        compiled, mode = read_selection(selection)
+        download_subset(session, gfs_file_url(timestamp, step), filepath, compiled, wait=wait)
+    else:
+        download_step(session, gfs_url(timestamp, step), filepath, wait=wait)
+    seconds = time.time() - start
+    logging.info('  Download of step ' + step + ' took ' + str(round(seconds, 2)))
+    nbytes = os.path.getsize(filepath)
+    errors, step_bounds, timings = convert_grib(filepath, netcdfs, timestamp, FORECAST_LEVELS, ncoptions,
+                                                domains=domains)
+    for error in errors:
+        logging.info('  skipped ' + error)
+    write_unit(os.path.join(staging_path(threddspath, timestamp), 'units'), step, 'done',
+               {'bounds': [[short, level, stats] for (short, level), stats in step_bounds.items()],
+                'host': socket.gethostname(), 'finished': utc_stamp(),
+                'download': {'step': step, 'bytes': nbytes, 'seconds': round(seconds, 3),
+                             'throughput': round(nbytes / max(seconds, 1e-6))},
+                'convert': conversion_metrics(step, timings)})
+    os.remove(filepath)
+    logging.info('  Finished step ' + step + ' in ' + str(round(time.time() - start, 2)))
+    return
+
+
+def work(threddspath, stale=600):
+    """
+    Runs a worker. Workers on any number of machines sharing threddspath claim the steps of the cycle the
+    coordinator prepared (see coordinate) one at a time, then download and convert them. A step that fails is
+    recorded in its .failed file and released for another worker to try. A worker only tries a step it failed again
+    when there is nothing else it can claim, and no step is tried more than the coordinator's attempts times. A worker
+    stops when every step is done, claimed by another worker, or out of attempts.
+    stale: seconds after which the claim of a worker that stopped touching it is considered abandoned
+    """
+    queue_info = read_workqueue(threddspath)
+    if not queue_info:
+        return 'Worker Stopped- there is no cycle waiting for workers'
+    timestamp = queue_info['timestamp']
+    units = os.path.join(staging_path(threddspath, timestamp), 'units')
+    logs = os.path.join(staging_path(threddspath, timestamp), 'logs')
+    os.makedirs(logs, exist_ok=True)
+    logfile = os.path.join(logs, 'worker_' + socket.gethostname() + '_' + str(os.getpid()) + '.log')
+    logging.basicConfig(filename=logfile, filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Worker started on ' + datetime.datetime.utcnow().strftime("%D at %R") + ' for ' + timestamp)
+
+    session = new_session(1)
+    attempts = queue_info.get('attempts', UNIT_ATTEMPTS)
+    failed = []
+    finished = 0
+    while True:
+        step = claim_unit(units, stale=stale, skip=failed, attempts=attempts)
+        if step is None and failed:
+            # nothing is left that this worker hasn't failed, so retry its failures while they have attempts left
+            step = claim_unit(units, stale=stale, attempts=attempts)
+        if step is None:
+            break
+        logging.info('claimed step ' + step)
+        claim = os.path.join(units, step + '.claim')
+        stopped = threading.Event()
+
+        def touch():
+            while not stopped.wait(stale / 10):
+                if os.path.exists(claim):
+                    os.utime(claim)
+
+        heartbeat = threading.Thread(target=touch, daemon=True)
+        heartbeat.start()
+        try:
+            run_unit(session, threddspath, timestamp, step, queue_info['selection'], queue_info['ncoptions'],
+                     queue_info.get('domains'), queue_info.get('wait', 0))
+            finished += 1
+        except Exception as e:
+            logging.info('  FAILED step ' + step + ': ' + repr(e))
+            # only the worker holding the claim writes the record, so adding to it can't lose another worker's attempt
+            tried = failed_attempts(units, step) + [
+                {'error': repr(e), 'host': socket.gethostname(), 'pid': os.getpid(), 'time': utc_stamp()}]
+            write_unit(units, step, 'failed', {'attempts': tried})
+            if step not in failed:
+                failed.append(step)
+        finally:
+            stopped.set()
+            heartbeat.join()
+            if os.path.exists(claim):
+                os.remove(claim)
+    session.close()
+    logging.info('Worker finished ' + str(finished) + ' steps, ' + str(len(failed)) + ' failed')
+    return 'Worker Finished- ' + str(finished) + ' steps converted, ' + str(len(failed)) + ' failed'
+
+
+def unit_status(units, step, attempts=UNIT_ATTEMPTS):
+    for kind, status in (('done', 'complete'), ('claim', 'running')):
+        if os.path.exists(os.path.join(units, step + '.' + kind)):
+            return status
+    # a step that failed is waiting for another attempt until it runs out of them
+    return 'failed' if len(failed_attempts(units, step)) >= attempts else 'pending'
+
+
+def coordinate(threddspath='', clobber='no', selection=None, ncoptions=None, consolidate=False, keep=2, detect=True,
+               wait=None, poll=30, timeout=21600, promfile=None, domains=None, attempts=UNIT_ATTEMPTS):
+    """
+    Runs the workflow with the downloading and converting done by workers (see work), which can be on other
+    machines sharing threddspath. The coordinator prepares the cycle and writes workqueue.json to tell the workers
+    which cycle to work on, then waits for every step to be done before writing the bounds, consolidating the
+    netcdfs (if consolidate), and publishing the cycle. Each step is tried up to attempts times by the workers. It gives
+    up when the steps that are left have all used their attempts and nothing is being worked on, or after timeout
+    seconds. Running it again resumes the same cycle with fresh attempts.
+    see workflow for the other options. selection must be a path the workers can read too
+    """
+    lock = acquire_lock(threddspath)
+    if not lock:
+        return 'Workflow Aborted- another workflow is running in this folder'
+    logfile = os.path.join(threddspath, 'workflow.log')
+    logging.basicConfig(filename=logfile, filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Coordinator initiated on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    journal = Journal(threddspath)
+    journal.start()
+    metrics = Metrics(threddspath, promfile)
     try:
-        workflow(threddspath=path)
+        journal.stage('environment', 'running')
+        timestamp, redundant, posted = solve_environment(threddspath, clobber=clobber in ['yes', 'true', True],
+                                                         detect=detect)
+        wait = posting_wait(posted, wait)
+        journal.cycle(timestamp)
+        metrics.timestamp = timestamp
+        journal.stage('environment', 'complete')
+        if redundant:
+            for stage in Journal.stages[1:]:
+                journal.stage(stage, 'skipped')
+            journal.finish('complete', 'already run for most recent data')
+            return 'Workflow Aborted- already run for most recent data'
+
+        # failures from an earlier attempt are forgotten so the workers try those steps again
+        units = os.path.join(staging_path(threddspath, timestamp), 'units')
+        os.makedirs(units, exist_ok=True)
+        os.chmod(units, 0o777)
+        for file in os.listdir(units):
+            if file.endswith('.failed'):
+                os.remove(os.path.join(units, file))
+        domains = read_domains(domains) if domains else {}
+        if domains:
+            new_domains(staging_path(threddspath, timestamp), domains, clean=False)
+        path = os.path.join(threddspath, 'workqueue.json')
+        with open(path + '.tmp', 'w') as f:
+            f.write(json.dumps({'timestamp': timestamp, 'selection': selection, 'ncoptions': ncoptions,
+                                'domains': domains, 'attempts': attempts, 'wait': wait}))
+        os.replace(path + '.tmp', path)
+        os.chmod(path, 0o777)
+        logging.info('\nWaiting for workers to convert ' + timestamp)
+
+        journal.stage('download', 'running')
+        journal.stage('convert', 'running')
+        statuses = {}
+        started = time.time()
+        while True:
+            for step in FC_STEPS:
+                status = unit_status(units, step, attempts)
+                if statuses.get(step) != status:
+                    statuses[step] = status
+                    journal.step('download', step, status)
+                    journal.step('convert', step, status)
+            remaining = [step for step in FC_STEPS if statuses[step] != 'complete']
+            if not remaining:
+                break
+            if all(statuses[step] == 'failed' for step in remaining) or time.time() - started > timeout:
+                logging.info('Workers did not finish ' + ', '.join(remaining))
+                os.remove(path)
+                journal.stage('download', 'failed')
+                journal.stage('convert', 'failed')
+                journal.finish('failed', 'Worker Errors Occurred')
+                logging.info('\nWorkflow aborted on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+                return 'Workflow Aborted- Worker Errors Occurred'
+            time.sleep(poll)
+        os.remove(path)
+        logging.info('Workers finished every step')
+
+        # collect the bounds the workers found and consolidate the steps in order
+        bounds = {}
+        netcdfs = os.path.join(staging_path(threddspath, timestamp), 'netcdfs')
+        hours = [forecast_hour(timestamp, grib_filename(timestamp, step)) for step in FC_STEPS]
+        for index, step in enumerate(FC_STEPS):
+            with open(os.path.join(units, step + '.done'), 'r') as f:
+                record = json.loads(f.read())
+            for short, level, stats in record['bounds']:
+                bounds.setdefault((short, level), {})[hours[index]] = stats
+            metrics.record('download', **record['download'])
+            metrics.record('convert', **record['convert'])
+            if consolidate:
+                folders = [netcdfs] + [os.path.join(os.path.dirname(netcdfs), 'domains', name) for name in domains]
+                append_step(folders, FORECAST_LEVELS, FC_STEPS, index, timestamp, ncoptions)
+        if not consolidate:
+            check_vertical_levels(netcdfs, FORECAST_LEVELS)
+        write_wmsbounds(bounds)
+        shutil.rmtree(os.path.join(staging_path(threddspath, timestamp), 'gribs'))
+        journal.stage('download', 'complete')
+        journal.stage('convert', 'complete')
+
+        journal.stage('publish', 'running')
+        publish(threddspath, timestamp, FORECAST_LEVELS)
+        journal.stage('publish', 'complete')
+        journal.stage('cleanup', 'running')
+        cleanup(threddspath, timestamp, keep=keep)
+        journal.stage('cleanup', 'complete')
+        logging.info('\n\nGFS Workflow completed successfully on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+        journal.finish('complete', 'Normal Finish')
+        return 'GFS Workflow Completed- Normal Finish'
     except Exception as e:
-        if os.path.exists(os.path.join(path, 'running.txt')):
-            os.remove(os.path.join(path, 'running.txt'))
-        with open(os.path.join(path, 'last_run_failed.txt'), 'w') as fail:
-            fail.writelines(str(e))
+        logging.exception('\nWorkflow failed on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+        for stage in Journal.stages:
+            if journal.state['stages'][stage]['status'] == 'running':
+                journal.stage(stage, 'failed')
+        journal.finish('failed', repr(e))
+        raise
+    finally:
+        metrics.finish(journal.state['status'])
+        release_lock(lock)
+
+
+# execute this script with the path location to store gfs data as an argument, e.g.
+# python gfsworkflow.py /path/to/gfs --stream --consolidate --compress
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download the newest GFS cycle and publish it to a THREDDS folder')
+    parser.add_argument('path', help='the gfs folder in THREDDS\' public folder')
+    # add coordinator or worker after the path to share the work between machines (see coordinate and work)
+    parser.add_argument('role', nargs='?', choices=['coordinator', 'worker'], help='share the work between machines')
+    parser.add_argument('--clobber', action='store_true', help='download the cycle again even if it is published')
+    parser.add_argument('--no-detect', dest='detect', action='store_false',
+                        help='don\'t ask nomads which cycle is posted, use the one from 6 hours ago')
+    parser.add_argument('--wait', type=int, default=None, help='seconds to wait for steps that aren\'t posted yet')
+    parser.add_argument('--connections', type=int, default=4, help='parallel downloads')
+    parser.add_argument('--selection', help='json file of the variables and levels to download, e.g. selection.json')
+    parser.add_argument('--workers', type=int, default=1, help='processes converting gribs to netcdfs')
+    parser.add_argument('--memory', type=int, default=None, help='MB the conversion processes have to fit in')
+    parser.add_argument('--stream', action='store_true', help='convert and publish each step as it downloads')
+    parser.add_argument('--keep', type=int, default=2, help='how many older cycles to keep for rollback')
+    parser.add_argument('--consolidate', action='store_true', help='write one netcdf per level with every step')
+    parser.add_argument('--compress', action='store_true', help='compress and chunk the netcdfs')
+    parser.add_argument('--chunks', help='the netcdf (time, lat, lon) chunks, e.g. 1,90,180. implies --compress')
+    parser.add_argument('--complevel', type=int, help='the zlib level of the netcdfs, 1-9. implies --compress')
+    parser.add_argument('--pack', action='store_true', help='store the netcdfs as int16. implies --compress')
+    parser.add_argument('--zarr', action='store_true', help='also write the cycle to a zarr store')
+    parser.add_argument('--zarr-chunks', help='the zarr (time, lat, lon) chunks, e.g. 1,180,360. implies --zarr')
+    parser.add_argument('--domains', help='json file of regional domains to also write, e.g. domains.json')
+    parser.add_argument('--cubes', action='store_true', help='also write the point cubes the app reads')
+    parser.add_argument('--promfile', help='where to write the prometheus metrics of the run')
+    parser.add_argument('--attempts', type=int, default=UNIT_ATTEMPTS, help='coordinator: tries per step')
+    parser.add_argument('--poll', type=int, default=30, help='coordinator: seconds between checks on the workers')
+    parser.add_argument('--timeout', type=int, default=21600, help='coordinator: seconds to wait for the workers')
+    parser.add_argument('--stale', type=int, default=600, help='worker: seconds until an idle claim is abandoned')
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        print('This path does not exist. Please check the path and try again.')
+        exit()
+    # a failed run leaves its progress in journal.json, running again resumes it and redoes only what failed
+    ncoptions = None
+    if args.compress or args.chunks or args.complevel or args.pack:
+        ncoptions = netcdf_options(chunks=args.chunks or (1, 90, 180), complevel=args.complevel or 4, pack=args.pack)
+    zarroptions = zarr_options(chunks=args.zarr_chunks or (1, 180, 360)) if args.zarr or args.zarr_chunks else None
+    if args.role == 'coordinator':
+        print(coordinate(threddspath=args.path, clobber=args.clobber, selection=args.selection, ncoptions=ncoptions,
+                         consolidate=args.consolidate, keep=args.keep, detect=args.detect, wait=args.wait,
+                         poll=args.poll, timeout=args.timeout, promfile=args.promfile, domains=args.domains,
+                         attempts=args.attempts))
+    elif args.role == 'worker':
+        print(work(threddspath=args.path, stale=args.stale))
+    else:
+        print(workflow(threddspath=args.path, clobber=args.clobber, connections=args.connections,
+                       selection=args.selection, workers=args.workers, ncoptions=ncoptions,
+                       consolidate=args.consolidate, zarroptions=zarroptions, stream=args.stream, keep=args.keep,
+                       detect=args.detect, wait=args.wait, promfile=args.promfile, memory=args.memory,
+                       domains=args.domains, cubes=args.cubes))
@@ -0,0 +1,307 @@
+import argparse
+import collections
+import datetime
+import http.server
+import random
+import re
+import struct
+import threading
+import time
+import urllib.parse
+
+import numpy
+
+
+# The messages in every synthetic grib: the idx variable and level, the grib2 discipline, category, and number, the
+# first fixed surface (type, scale factor, scaled value) followed by the second for a layer, and the offset and
+# amplitude of the values in SI units. The sigma layers share a top like the ones in the real files
+FIELDS = [
+    ('TMP', 'surface', 0, 0, 0, (1, 0, 0), 280, 30),
+    ('TMP', '2 m above ground', 0, 0, 0, (103, 0, 2), 278, 30),
+    ('RH', '2 m above ground', 0, 1, 1, (103, 0, 2), 30, 70),
+    ('UGRD', '10 m above ground', 0, 2, 2, (103, 0, 10), -15, 30),
+    ('VGRD', '10 m above ground', 0, 2, 3, (103, 0, 10), -15, 30),
+    ('GUST', 'surface', 0, 2, 22, (1, 0, 0), 0, 30),
+    ('TMP', '850 mb', 0, 0, 0, (100, 0, 85000), 260, 40),
+    ('TMP', '500 mb', 0, 0, 0, (100, 0, 50000), 230, 40),
+    ('HGT', '500 mb', 0, 3, 5, (100, 0, 50000), 5000, 900),
+    ('UGRD', '500 mb', 0, 2, 2, (100, 0, 50000), -40, 80),
+    ('VGRD', '500 mb', 0, 2, 3, (100, 0, 50000), -40, 80),
+    ('TMP', 'tropopause', 0, 0, 0, (7, 0, 0), 200, 30),
+    ('UGRD', 'max wind', 0, 2, 2, (6, 0, 0), -60, 120),
+    ('HGT', '0C isotherm', 0, 3, 5, (4, 0, 0), 0, 5000),
+    ('PRMSL', 'mean sea level', 0, 3, 1, (101, 0, 0), 98000, 5000),
+    ('TCDC', 'entire atmosphere', 0, 6, 1, (10, 0, 0), 0, 100),
+    ('APCP', 'surface', 0, 1, 8, (1, 0, 0), 0, 50),
+    ('TSOIL', '0-0.1 m below ground', 2, 3, 18, (106, 0, 0, 106, 1, 1), 270, 40),
+    ('TSOIL', '0.1-0.4 m below ground', 2, 3, 18, (106, 1, 1, 106, 1, 4), 275, 30),
+    ('RH', '0.44-1 sigma layer', 0, 1, 1, (104, 2, 44, 104, 0, 1), 30, 70),
+    ('RH', '0.44-0.72 sigma layer', 0, 1, 1, (104, 2, 44, 104, 2, 72), 20, 70),
+]
+
+FILTER_PATH = '/cgi-bin/filter_gfs_0p25.pl'
+FILE_PATH = re.compile(r'/pub/data/nccf/com/gfs/prod/gfs\.(\d{8})/(\d{2})/atmos/'
+                       r'gfs\.t\d{2}z\.pgrb2\.0p25\.f(\d{3})(\.idx)?')
+
+
+def sign_magnitude(value, size):
+    # grib2 stores negative integers with the sign in the highest bit instead of as two's complement
+    return (abs(value) | (1 << (size * 8 - 1)) if value < 0 else value).to_bytes(size, 'big')
+
+
+def grib2_message(values, discipline, category, number, surface, timestamp, step, accumulation=False):
+    """
+    Encodes one field on the GFS 0.25 degree grid as a GRIB2 message with simple packing. values is a 721x1440
+    array ordered like the GFS files, north to south starting at 0 degrees east. With accumulation the message
+    describes a total since the previous 6 hours like APCP does.
+    """
+    run = datetime.datetime.strptime(timestamp, '%Y%m%d%H')
+    section1 = struct.pack('>IBHHBBBHBBBBBBB', 21, 1, 7, 0, 2, 1, 1, run.year, run.month, run.day, run.hour, 0, 0,
+                           0, 1)
+    grid = (struct.pack('>BBIBIBI', 6, 0, 0, 0, 0, 0, 0) + struct.pack('>IIII', 1440, 721, 0, 0) +
+            sign_magnitude(90000000, 4) + struct.pack('>IB', 0, 48) + sign_magnitude(-90000000, 4) +
+            struct.pack('>IIIB', 359750000, 250000, 250000, 0))
+    section3 = struct.pack('>IBBIBBH', 14 + len(grid), 3, 0, 721 * 1440, 0, 0, 0) + grid
+
+    # accumulations are described from the start of the 6 hour period they cover
+    start = step - 6 if accumulation else step
+    product = struct.pack('>BBBBBHBBI', category, number, 2, 0, 96, 0, 0, 1, max(start, 0))
+    second = surface[3:] or (255, 0, 0)
+    product += struct.pack('>BB', surface[0], surface[1]) + surface[2].to_bytes(4, 'big')
+    product += struct.pack('>BB', second[0], second[1]) + second[2].to_bytes(4, 'big')
+    template = 0
+    if accumulation:
+        template = 8
+        end = run + datetime.timedelta(hours=step)
+        product += struct.pack('>HBBBBBBI', end.year, end.month, end.day, end.hour, 0, 0, 1, 0)
+        product += struct.pack('>BBBIBI', 1, 2, 1, step - max(start, 0), 1, 0)
+    section4 = struct.pack('>IBHH', 9 + len(product), 4, 0, template) + product
+
+    # simple packing into 16 bits: value = (reference + packed * 2 ** binary) / 10 ** decimal
+    decimal = 2
+    scaled = numpy.asarray(values, dtype='f8').ravel() * 10 ** decimal
+    reference = numpy.float32(numpy.floor(scaled.min()))
+    spread = float(scaled.max() - reference)
+    binary = max(0, int(numpy.ceil(numpy.log2(spread / 65535)))) if spread > 0 else 0
+    packed = numpy.clip(numpy.rint((scaled - reference) / 2 ** binary), 0, 65535).astype('>u2').tobytes()
+    section5 = (struct.pack('>IBIH', 21, 5, 721 * 1440, 0) + struct.pack('>f', reference) +
+                sign_magnitude(binary, 2) + sign_magnitude(decimal, 2) + struct.pack('>BB', 16, 0))
+    section6 = struct.pack('>IBB', 6, 6, 255)
+    section7 = struct.pack('>IB', 5 + len(packed), 7) + packed
+
+    body = section1 + section3 + section4 + section5 + section6 + section7 + b'7777'
+    return b'GRIB' + struct.pack('>HBBQ', 0, discipline, 2, 16 + len(body)) + body
+
+
+def synthetic_step(timestamp, step, fields=None, seed=0):
+    """
+    Makes the grib and .idx inventory for one forecast step. The values are smooth fields that change with the step
+    plus some noise so they compress about as well as real data. Returns the grib bytes and the list of
+    (offset, var, level) of each message.
+    """
+    fields = fields or FIELDS
+    rng = numpy.random.default_rng(seed + step)
+    lat = numpy.radians(numpy.linspace(90, -90, 721))[:, None]
+    lon = numpy.radians(numpy.arange(1440) * .25)[None, :]
+    pattern = (numpy.cos(lat) * (1 + .3 * numpy.sin(2 * lon + step / 24)) + 1) / 2.6
+    grib = bytearray()
+    inventory = []
+    for var, level, discipline, category, number, surface, offset, amplitude in fields:
+        values = offset + amplitude * pattern + amplitude * .02 * rng.standard_normal(pattern.shape)
+        inventory.append((len(grib), var, level))
+        grib += grib2_message(values, discipline, category, number, surface, timestamp, step,
+                              accumulation=var == 'APCP')
+    return bytes(grib), inventory
+
+
+def idx_text(timestamp, step, inventory):
+    lines = []
+    for i, (offset, var, level) in enumerate(inventory):
+        if var == 'APCP':
+            forecast = str(max(step - 6, 0)) + '-' + str(step) + ' hour acc fcst'
+        else:
+            forecast = str(step) + ' hour fcst'
+        lines.append(str(i + 1) + ':' + str(offset) + ':d=' + timestamp + ':' + var + ':' + level + ':' + forecast +
+                     ':')
+    return '\n'.join(lines) + '\n'
+
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers requests like nomads does for the urls the workflow uses: the grib filter script and the raw files and
+    .idx inventories on the file server, including Range requests. The behavior comes from the server's settings,
+    see serve.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond(head=False)
+
+    def log_message(self, format, *args):
+        if self.server.settings['verbose']:
+            super().log_message(format, *args)
+
+    def respond(self, head):
+        settings = self.server.settings
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path, self.headers.get('Range')))
+        time.sleep(settings['latency'])
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == FILTER_PATH and 'file' in query and 'dir' in query:
+            match = re.search(r'f(\d{3})$', query['file'][0])
+            cycle = re.search(r'gfs\.(\d{8})/(\d{2})', query['dir'][0])
+            if not match or not cycle:
+                return self.error(404)
+            timestamp, step, idx = cycle.group(1) + cycle.group(2), int(match.group(1)), False
+        else:
+            match = FILE_PATH.fullmatch(url.path)
+            if not match:
+                return self.error(404)
+            timestamp, step, idx = match.group(1) + match.group(2), int(match.group(3)), bool(match.group(4))
+        if step in settings['missing']:
+            return self.error(404)
+        with self.server.lock:
+            if self.server.rng.random() < settings['error_rate']:
+                return self.error(500)
+
+        grib, inventory = self.server.step(timestamp, step)
+        if idx:
+            return self.send(200, idx_text(timestamp, step, inventory).encode(), 'text/plain', head=head)
+        if url.path == FILTER_PATH:
+            if 'all_var' not in query or 'all_lev' not in query:
+                grib = self.filtered(grib, inventory, query)
+            return self.send(200, grib, 'application/octet-stream', head=head)
+        return self.ranges(grib, head)
+
+    def filtered(self, grib, inventory, query):
+        # the filter script takes var_TMP=on and lev_2_m_above_ground=on style arguments
+        variables = {key[4:] for key in query if key.startswith('var_')}
+        levels = {key[4:] for key in query if key.startswith('lev_')}
+        ends = [offset for offset, var, level in inventory[1:]] + [len(grib)]
+        parts = []
+        for (offset, var, level), end in zip(inventory, ends):
+            if ('all_var' in query or var in variables) and ('all_lev' in query or level.replace(' ', '_') in levels):
+                parts.append(grib[offset:end])
+        return b''.join(parts)
+
+    def ranges(self, grib, head):
+        header = self.headers.get('Range')
+        if not header:
+            return self.send(200, grib, 'application/octet-stream', head=head)
+        spans = []
+        for part in header.split('=', 1)[1].split(','):
+            first, last = part.strip().split('-')
+            first = int(first)
+            last = min(int(last), len(grib) - 1) if last else len(grib) - 1
+            if first >= len(grib):
+                return self.error(416)
+            spans.append((first, last))
+        if len(spans) == 1:
+            first, last = spans[0]
+            return self.send(206, grib[first:last + 1], 'application/octet-stream', head=head,
+                             headers={'Content-Range': 'bytes ' + str(first) + '-' + str(last) + '/' + str(len(grib))})
+        boundary = 'standin' + str(random.getrandbits(32))
+        body = b''
+        for first, last in spans:
+            body += ('--' + boundary + '\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes ' +
+                     str(first) + '-' + str(last) + '/' + str(len(grib)) + '\r\n\r\n').encode()
+            body += grib[first:last + 1] + b'\r\n'
+        body += ('--' + boundary + '--\r\n').encode()
+        return self.send(206, body, 'multipart/byteranges; boundary=' + boundary, head=head)
+
+    def error(self, code):
+        return self.send(code, (str(code) + '\n').encode(), 'text/plain')
+
+    def send(self, code, body, content_type, head=False, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if head:
+            return
+        # write in chunks so the bandwidth limit applies to each connection like a slow server would
+        bandwidth = self.server.settings['bandwidth']
+        chunk = 65536
+        for start in range(0, len(body), chunk):
+            try:
+                self.wfile.write(body[start:start + chunk])
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            if bandwidth:
+                time.sleep(min(chunk, len(body) - start) / bandwidth)
+        return
+
+
+class StandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings):
+        super().__init__(address, StandinHandler)
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.rng = random.Random(settings['seed'])
+        self.cache = collections.OrderedDict()
+        # the method, path, and Range header of every request, for tests to check what the workflow asked for
+        self.requests = []
+
+    def step(self, timestamp, step):
+        # the gribs are made once and a few are kept, the workflow asks for the idx and the grib of the same step
+        key = (timestamp, step)
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = synthetic_step(timestamp, step, self.settings['fields'], self.settings['seed'])
+                while len(self.cache) > self.settings['cache']:
+                    self.cache.popitem(last=False)
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+    @property
+    def url(self):
+        return 'http://' + self.server_address[0] + ':' + str(self.server_address[1])
+
+
+def serve(port=0, host='127.0.0.1', latency=0, bandwidth=None, error_rate=0, missing=(), fields=None, seed=0,
+          cache=8, verbose=False):
+    """
+    Starts a stand-in for nomads on a background thread and returns the server. Point the workflow at it with the
+    GFS_NOMADS_URL environment variable (or gfsworkflow.NOMADS) set to server.url. Call server.shutdown() to stop it.
+
+    port: 0 picks a free port
+    latency: seconds to wait before answering each request
+    bandwidth: bytes per second sent on each connection, None for as fast as possible
+    error_rate: the chance (0 to 1) that a request gets a 500 error
+    missing: forecast steps (ints) that haven't been posted and get a 404, like a cycle that is still being made
+    fields: the messages to put in each grib, see FIELDS
+    cache: how many steps to keep in memory
+    """
+    settings = {'latency': latency, 'bandwidth': bandwidth, 'error_rate': error_rate, 'missing': set(missing),
+                'fields': fields or FIELDS, 'seed': seed, 'cache': cache, 'verbose': verbose}
+    server = StandinServer((host, port), settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# run this script to start a stand-in server, see serve for what the options do
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic GFS gribs the way nomads does')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second per connection')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--missing', default='', help='steps to answer with 404, e.g. 162,168')
+    args = parser.parse_args()
+    server = serve(port=args.port, latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate,
+                   missing=[int(step) for step in args.missing.split(',') if step], verbose=True)
+    print('Serving synthetic gfs data at ' + server.url + ', use GFS_NOMADS_URL=' + server.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+# the workflow is a folder of scripts, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gfsworkflow  # noqa: E402
+import nomads_standin  # noqa: E402
+
+# The cycle the tests download unless they ask for another
+TIMESTAMP = '2024010100'
+# The forecast steps of every test cycle, a short cycle keeps the tests quick
+STEPS = ['006', '012']
+
+
+@pytest.fixture
+def standin():
+    # a new stand-in for each test so its request log and injected errors start empty
+    server = nomads_standin.serve()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def run_workflow(standin, tmp_path, monkeypatch):
+    """
+    Runs the workflow against the stand-in in a temporary thredds folder. Call it with the cycle's timestamp and the
+    workflow's options, it returns the workflow's message. The folder is run_workflow.threddspath.
+    """
+    threddspath = tmp_path / 'gfs'
+    threddspath.mkdir()
+    monkeypatch.setattr(gfsworkflow, 'NOMADS', standin.url)
+    monkeypatch.setattr(gfsworkflow, 'FC_STEPS', list(STEPS))
+    monkeypatch.setattr(gfsworkflow, 'BOUNDS_FILE', str(tmp_path / 'bounds.js'))
+
+    def run(timestamp=TIMESTAMP, **options):
+        # the stand-in serves any cycle, detect picks the one the test asked for
+        monkeypatch.setattr(gfsworkflow, 'detect_cycle', lambda *args, **kwargs: (timestamp, list(STEPS)))
+        return gfsworkflow.workflow(threddspath=str(threddspath), detect=True, **options)
+
+    run.threddspath = str(threddspath)
+    return run
@@ -0,0 +1,328 @@
+import json
+import os
+
+import netCDF4
+import numpy
+import pytest
+
+import gfsworkflow
+import nomads_standin
+from conftest import TIMESTAMP
+
+HOURS = ['2024010106', '2024010112']
+
+
+def step_netcdf(threddspath, level, hour=HOURS[0]):
+    return os.path.join(threddspath, TIMESTAMP, 'netcdfs', level + '_' + hour + '.nc')
+
+
+def synthetic_grib(folder, step, fields=None):
+    # writes the stand-in's grib for a step to folder and returns its path
+    grib, inventory = nomads_standin.synthetic_step(TIMESTAMP, step, fields)
+    path = os.path.join(str(folder), gfsworkflow.grib_filename(TIMESTAMP, '%03d' % step))
+    with open(path, 'wb') as f:
+        f.write(grib)
+    return path
+
+
+def test_every_level_gets_a_netcdf_for_each_step(run_workflow):
+    assert run_workflow() == 'GFS Workflow Completed- Normal Finish'
+    path = run_workflow.threddspath
+    netcdfs = os.path.join(path, TIMESTAMP, 'netcdfs')
+    assert sorted(os.listdir(netcdfs)) == sorted(
+        level + '_' + hour + '.nc' for level in gfsworkflow.FORECAST_LEVELS for hour in HOURS)
+
+    # every message of the grib is written to the netcdf of its level as (time, lat, lon)
+    with netCDF4.Dataset(step_netcdf(path, 'surface')) as dataset:
+        assert {'t', 'gust', 'tp'} <= set(dataset.variables)
+        assert dataset['t'].dimensions == ('time', 'lat', 'lon')
+        assert dataset['t'].shape == (1, 721, 1440)
+        assert dataset['time'][:].tolist() == [6]
+    with netCDF4.Dataset(step_netcdf(path, 'meanSea', HOURS[1])) as dataset:
+        assert dataset['prmsl'].shape == (1, 721, 1440)
+        assert dataset['time'][:].tolist() == [12]
+    # levels without any messages still get an empty file so every level has an ncml
+    with netCDF4.Dataset(step_netcdf(path, 'hybrid')) as dataset:
+        assert set(dataset.variables) == {'time', 'lat', 'lon'}
+
+
+def test_bounds_file(run_workflow):
+    assert run_workflow() == 'GFS Workflow Completed- Normal Finish'
+    with open(gfsworkflow.BOUNDS_FILE) as f:
+        lines = f.read().splitlines()
+    assert lines[0].startswith('const bounds = ') and lines[1].startswith('const levelbounds = ')
+    bounds = json.loads(lines[0].replace('const bounds = ', '').rstrip(';'))
+    levelbounds = json.loads(lines[1].replace('const levelbounds = ', '').rstrip(';'))
+
+    # bounds has the range of each variable across every level and step
+    minimum, maximum = (int(value) for value in bounds['t'].split(','))
+    assert minimum < maximum
+    # levelbounds has the range of each level, a robust range, and the range at each step
+    assert set(levelbounds['t']) == {'surface', 'isobaricInhPa', 'tropopause'}
+    surface = levelbounds['t']['surface']
+    low, high = (float(value) for value in surface['range'].split(','))
+    robust_low, robust_high = (float(value) for value in surface['robust'].split(','))
+    assert low <= robust_low < robust_high <= high
+    assert set(surface['steps']) == {'6', '12'}
+    assert minimum <= low and high <= maximum + 1
+    assert set(levelbounds['r']) == {'sigmaLayer'}
+
+
+def test_packed_netcdfs_are_chunked_compressed_and_close_to_the_floats(tmp_path):
+    grib = synthetic_grib(tmp_path, 6)
+    plain, packed = tmp_path / 'plain', tmp_path / 'packed'
+    for folder, ncoptions in ((plain, None), (packed, gfsworkflow.netcdf_options(chunks='1,90,180', pack=True))):
+        folder.mkdir()
+        errors, bounds, timings = gfsworkflow.convert_grib(
+            grib, str(folder), TIMESTAMP, ['surface', 'isobaricInhPa'], ncoptions)
+        assert errors == []
+
+    name = 'surface_2024010106.nc'
+    with netCDF4.Dataset(plain / name) as floats, netCDF4.Dataset(packed / name) as dataset:
+        assert dataset['t'].dtype == numpy.int16
+        assert dataset['t'].chunking() == [1, 90, 180]
+        assert dataset['t'].filters()['zlib'] and dataset['t'].filters()['shuffle']
+        assert floats['t'].dtype == numpy.float32 and floats['t'].chunking() == 'contiguous'
+        # unpacking is off by at most half a step of the packing
+        numpy.testing.assert_allclose(dataset['t'][:], floats['t'][:], rtol=0, atol=dataset['t'].scale_factor * .51)
+    assert os.path.getsize(packed / name) < os.path.getsize(plain / name) / 2
+
+    # a variable at several levels is compressed and chunked a level at a time but stays float32
+    name = 'isobaricInhPa_2024010106.nc'
+    with netCDF4.Dataset(plain / name) as floats, netCDF4.Dataset(packed / name) as dataset:
+        assert dataset['t'].dtype == numpy.float32
+        assert dataset['t'].chunking() == [1, 1, 90, 180]
+        numpy.testing.assert_array_equal(dataset['t'][:], floats['t'][:])
+
+
+def test_consolidated_levels(run_workflow, tmp_path):
+    options = {'workers': 2, 'consolidate': True, 'ncoptions': gfsworkflow.netcdf_options()}
+    assert run_workflow(**options) == 'GFS Workflow Completed- Normal Finish'
+    netcdfs = os.path.join(run_workflow.threddspath, TIMESTAMP, 'netcdfs')
+    assert sorted(os.listdir(netcdfs)) == sorted(level + '.nc' for level in gfsworkflow.FORECAST_LEVELS)
+    with open(os.path.join(run_workflow.threddspath, 'surface_wms.ncml')) as f:
+        assert 'location="' + TIMESTAMP + '/netcdfs/surface.nc"' in f.read()
+
+    # every step is in one file per level with a time dimension in forecast order
+    single = tmp_path / 'single'
+    single.mkdir()
+    gfsworkflow.convert_grib(synthetic_grib(tmp_path, 12), str(single), TIMESTAMP, ['surface'])
+    with netCDF4.Dataset(os.path.join(netcdfs, 'surface.nc')) as dataset, \
+            netCDF4.Dataset(single / 'surface_2024010112.nc') as step:
+        assert dataset.dimensions['time'].isunlimited()
+        assert dataset['time'][:].tolist() == [6, 12]
+        assert dataset['time'].units == 'hours since 2024-01-01 00:00:00'
+        assert dataset['t'].shape == (2, 721, 1440)
+        assert not numpy.ma.is_masked(dataset['t'][:])
+        numpy.testing.assert_array_equal(dataset['t'][1], step['t'][0])
+    # both layers of each step are kept in the consolidated file
+    with netCDF4.Dataset(os.path.join(netcdfs, 'sigmaLayer.nc')) as dataset:
+        assert dataset['r'].shape == (2, 2, 721, 1440)
+        assert not numpy.ma.is_masked(dataset['r'][:])
+        numpy.testing.assert_allclose(dataset['sigma_bounds'][:], [[.44, .72], [.44, 1]])
+
+
+def test_zarr_store_has_every_step(run_workflow):
+    zarr = pytest.importorskip('zarr')
+    # with 2 steps per time chunk the conversion processes write to the same chunks
+    zarroptions = gfsworkflow.zarr_options(chunks='2,180,360')
+    assert run_workflow(workers=2, zarroptions=zarroptions) == 'GFS Workflow Completed- Normal Finish'
+    store = os.path.join(run_workflow.threddspath, TIMESTAMP, 'gfs.zarr')
+    assert os.path.exists(os.path.join(store, '.zmetadata'))
+    assert not os.path.exists(store + '.sync')
+
+    root = zarr.open_consolidated(store, mode='r')
+    assert root['surface/time'][:].tolist() == [6, 12]
+    assert root['surface/time'].attrs['units'] == 'hours since 2024-01-01 00:00:00'
+    surface = root['surface/t']
+    assert surface.shape == (2, 721, 1440)
+    assert surface.chunks == (2, 180, 360)
+    assert surface.attrs['_ARRAY_DIMENSIONS'] == ['time', 'lat', 'lon']
+    # neither process's writes were lost
+    assert not numpy.isnan(surface[:]).any()
+    for index, hour in enumerate(HOURS):
+        with netCDF4.Dataset(step_netcdf(run_workflow.threddspath, 'surface', hour)) as dataset:
+            numpy.testing.assert_array_equal(surface[index], dataset['t'][0])
+
+    # a variable at several levels gets its vertical coordinate
+    isobaric = root['isobaricInhPa/t']
+    assert isobaric.shape == (2, 2, 721, 1440)
+    assert isobaric.attrs['_ARRAY_DIMENSIONS'] == ['time', 'pressure', 'lat', 'lon']
+    assert root['isobaricInhPa/pressure'][:].tolist() == [500, 850]
+    assert not numpy.isnan(isobaric[:]).any()
+
+
+def test_consolidated_files_only_have_the_steps_in_order(run_workflow, standin):
+    options = {'workers': 2, 'consolidate': True, 'stream': True}
+    staged = os.path.join(gfsworkflow.staging_path(run_workflow.threddspath, TIMESTAMP), 'netcdfs')
+
+    # without the first step the second waits in its own netcdf and nothing is published
+    standin.settings['missing'] = {6}
+    assert run_workflow(**options).startswith('Workflow Aborted')
+    assert not os.path.exists(os.path.join(staged, 'surface.nc'))
+    assert os.path.exists(os.path.join(staged, 'surface_2024010112.nc'))
+    assert not os.path.exists(os.path.join(run_workflow.threddspath, 'surface_partial_wms.ncml'))
+
+    # the second step is appended after the first once it arrives
+    standin.settings['missing'] = set()
+    assert run_workflow(**options) == 'GFS Workflow Completed- Normal Finish'
+    with netCDF4.Dataset(os.path.join(run_workflow.threddspath, TIMESTAMP, 'netcdfs', 'surface.nc')) as dataset:
+        assert dataset['time'][:].tolist() == [6, 12]
+        assert not numpy.ma.is_masked(dataset['t'][:])
+
+
+def test_a_step_that_cant_be_appended_fails_the_run(run_workflow, standin, monkeypatch):
+    staged = gfsworkflow.staging_path(run_workflow.threddspath, TIMESTAMP)
+    synthetic_step = nomads_standin.synthetic_step
+
+    # the second step has no 850 mb temperature so its isobaric levels aren't the ones of the first
+    def without_850mb(timestamp, step, fields=None, seed=0):
+        if step == 12:
+            fields = [field for field in nomads_standin.FIELDS if field[1] != '850 mb']
+        return synthetic_step(timestamp, step, fields, seed)
+
+    monkeypatch.setattr(nomads_standin, 'synthetic_step', without_850mb)
+    assert run_workflow(consolidate=True) == 'Workflow Aborted- Conversion Errors Occurred'
+    # it is forgotten so the next run downloads and converts it again
+    assert list(gfsworkflow.read_converted(os.path.join(staged, 'gribs'))) == ['006']
+    assert not os.path.exists(os.path.join(staged, 'netcdfs', 'isobaricInhPa_2024010112.nc'))
+    with netCDF4.Dataset(os.path.join(staged, 'netcdfs', 'isobaricInhPa.nc')) as dataset:
+        assert dataset['time'][:].tolist() == [6]
+    with open(os.path.join(run_workflow.threddspath, 'journal.json')) as f:
+        steps = json.loads(f.read())['stages']['convert']['steps']
+    assert steps['006']['status'] == 'complete'
+    assert steps['012']['status'] == 'failed' and 'appending' in steps['012']['error']
+
+    # once the data is right again the run picks up from the first step
+    standin.requests.clear()
+    monkeypatch.setattr(nomads_standin, 'synthetic_step', synthetic_step)
+    standin.cache.clear()
+    assert run_workflow(consolidate=True) == 'GFS Workflow Completed- Normal Finish'
+    assert not [path for method, path, byterange in standin.requests if 'f006' in path]
+    with netCDF4.Dataset(os.path.join(run_workflow.threddspath, TIMESTAMP, 'netcdfs', 'isobaricInhPa.nc')) as dataset:
+        assert dataset['time'][:].tolist() == [6, 12]
+        assert not numpy.ma.is_masked(dataset['t'][:])
+
+
+def test_variables_at_several_levels_get_a_vertical_dimension(run_workflow):
+    assert run_workflow() == 'GFS Workflow Completed- Normal Finish'
+    path = run_workflow.threddspath
+    with netCDF4.Dataset(step_netcdf(path, 'isobaricInhPa')) as dataset:
+        assert dataset['t'].dimensions == ('time', 'pressure', 'lat', 'lon')
+        assert dataset['t'].shape == (1, 2, 721, 1440)
+        assert dataset['pressure'][:].tolist() == [500, 850]
+        assert dataset['pressure'].units == 'hPa'
+        assert dataset['pressure'].positive == 'down'
+        assert not numpy.array_equal(dataset['t'][0, 0], dataset['t'][0, 1])
+        # a variable at only one of the levels keeps its (time, lat, lon) shape and says its level
+        assert dataset['gh'].shape == (1, 721, 1440)
+        assert dataset['gh'].pressure == 500
+    with netCDF4.Dataset(step_netcdf(path, 'heightAboveGround')) as dataset:
+        assert dataset['2t'].height == 2
+
+    # layers that share a surface are both kept, known by the middle of the layer and bounded by their surfaces
+    with netCDF4.Dataset(step_netcdf(path, 'sigmaLayer')) as dataset:
+        assert dataset['r'].shape == (1, 2, 721, 1440)
+        assert dataset['sigma'][:].tolist() == pytest.approx([.58, .72])
+        assert dataset['sigma'].bounds == 'sigma_bounds'
+        numpy.testing.assert_allclose(dataset['sigma_bounds'][:], [[.44, .72], [.44, 1]])
+        assert not numpy.array_equal(dataset['r'][0, 0], dataset['r'][0, 1])
+    with netCDF4.Dataset(step_netcdf(path, 'depthBelowLandLayer')) as dataset:
+        numpy.testing.assert_allclose(dataset['depth_bounds'][:], [[0, .1], [.1, .4]])
+
+
+def test_steps_with_different_levels_are_rejected(tmp_path):
+    netcdfs = tmp_path / 'netcdfs'
+    netcdfs.mkdir()
+    # the second step has no 850 mb temperature so it has one isobaric level instead of two
+    fields = [field for field in nomads_standin.FIELDS if field[1] != '850 mb']
+    for step, step_fields in ((6, None), (12, fields)):
+        errors, bounds, timings = gfsworkflow.convert_grib(
+            synthetic_grib(tmp_path, step, step_fields), str(netcdfs), TIMESTAMP, ['isobaricInhPa'])
+        assert errors == []
+
+    with pytest.raises(ValueError, match='isobaricInhPa_2024010112.nc'):
+        gfsworkflow.check_vertical_levels(str(netcdfs), ['isobaricInhPa'])
+    first, second = (str(netcdfs / ('isobaricInhPa_' + hour + '.nc')) for hour in HOURS)
+    gfsworkflow.append_to_consolidated(str(netcdfs), 'isobaricInhPa', first, 0, [6, 12], TIMESTAMP)
+    with pytest.raises(ValueError, match='are not the levels'):
+        gfsworkflow.append_to_consolidated(str(netcdfs), 'isobaricInhPa', second, 1, [6, 12], TIMESTAMP)
+
+
+def test_derived_variables(run_workflow):
+    assert run_workflow() == 'GFS Workflow Completed- Normal Finish'
+    path = run_workflow.threddspath
+    with netCDF4.Dataset(step_netcdf(path, 'heightAboveGround')) as dataset:
+        assert dataset['10si'].derived_from == '10u 10v'
+        assert dataset['10si'].height == 10
+        numpy.testing.assert_allclose(dataset['10si'][:], numpy.hypot(dataset['10u'][:], dataset['10v'][:]),
+                                      rtol=1e-6)
+        direction = dataset['10wdir'][:]
+        assert direction.min() >= 0 and direction.max() <= 360
+    # a derived variable at one of several levels says its level like the variables it comes from
+    with netCDF4.Dataset(step_netcdf(path, 'isobaricInhPa')) as dataset:
+        assert dataset['ws'].pressure == 500
+        numpy.testing.assert_allclose(dataset['ws'][:], numpy.hypot(dataset['u'][:], dataset['v'][:]), rtol=1e-6)
+    # the 6 hour total of the first step is the whole total
+    with netCDF4.Dataset(step_netcdf(path, 'surface')) as dataset:
+        assert dataset['tp6'].derived_from == 'tp_6h'
+        numpy.testing.assert_array_equal(dataset['tp6'][:], dataset['tp'][:])
+
+
+def test_regional_domains(run_workflow, tmp_path):
+    domains = tmp_path / 'domains.json'
+    domains.write_text(json.dumps({'conus': [-125, -66, 24, 50]}))
+    assert run_workflow(domains=str(domains), consolidate=True) == 'GFS Workflow Completed- Normal Finish'
+    path = run_workflow.threddspath
+    folder = os.path.join(path, TIMESTAMP, 'domains')
+
+    # the app finds the domains and the cells they cover in domains.json
+    with open(os.path.join(folder, 'domains.json')) as f:
+        assert json.loads(f.read()) == {'conus': [-125, -66, 24, 50]}
+    assert sorted(os.listdir(os.path.join(folder, 'conus'))) == sorted(
+        level + '.nc' for level in gfsworkflow.FORECAST_LEVELS)
+    with open(os.path.join(path, 'conus_surface_wms.ncml')) as f:
+        assert 'location="' + TIMESTAMP + '/domains/conus/surface.nc"' in f.read()
+
+    # each domain is the cells of the global grid inside it
+    with netCDF4.Dataset(os.path.join(folder, 'conus', 'surface.nc')) as domain, \
+            netCDF4.Dataset(os.path.join(path, TIMESTAMP, 'netcdfs', 'surface.nc')) as world:
+        assert domain['time'][:].tolist() == [6, 12]
+        assert domain['lat'][0] == 24 and domain['lat'][-1] == 50
+        assert domain['lon'][0] == -125 and domain['lon'][-1] == -66
+        assert domain['t'].shape == (2, 105, 237)
+        rows = slice(int((24 + 90) * 4), int((50 + 90) * 4) + 1)
+        columns = slice(int((-125 + 180) * 4), int((-66 + 180) * 4) + 1)
+        numpy.testing.assert_array_equal(domain['t'][:], world['t'][:, rows, columns])
+    with netCDF4.Dataset(os.path.join(folder, 'conus', 'isobaricInhPa.nc')) as domain:
+        assert domain['t'].shape == (2, 2, 105, 237)
+
+
+def test_cubes_are_time_major(run_workflow):
+    assert run_workflow(cubes=True) == 'GFS Workflow Completed- Normal Finish'
+    path = run_workflow.threddspath
+    cubes = os.path.join(path, TIMESTAMP, 'cubes')
+
+    def read_cube(level, name):
+        with open(os.path.join(cubes, level, name + '.cube'), 'rb') as f:
+            header = f.read(gfsworkflow.CUBE_HEADER)
+        assert header.startswith(b'GFSCUBE1')
+        header = json.loads(header[8:].decode())
+        values = numpy.memmap(os.path.join(cubes, level, name + '.cube'), dtype=header['dtype'], mode='r',
+                              offset=gfsworkflow.CUBE_HEADER, shape=tuple(header['shape']))
+        return header, values
+
+    header, cube = read_cube('surface', 't')
+    assert header['hours'] == [6, 12] and header['timestamp'] == TIMESTAMP
+    assert header['shape'] == [1, 721, 1440, 2]
+    assert header['vertical'] is None
+    # the timeseries of a cell is the values of every step next to each other
+    for index, hour in enumerate(HOURS):
+        with netCDF4.Dataset(step_netcdf(path, 'surface', hour)) as dataset:
+            numpy.testing.assert_array_equal(cube[0, :, :, index], dataset['t'][0])
+
+    header, cube = read_cube('isobaricInhPa', 't')
+    assert header['vertical'] == {'name': 'pressure', 'values': [500, 850]}
+    assert header['shape'] == [2, 721, 1440, 2]
+    with netCDF4.Dataset(step_netcdf(path, 'isobaricInhPa', HOURS[1])) as dataset:
+        numpy.testing.assert_array_equal(cube[1, :, :, 1], dataset['t'][0, 1])
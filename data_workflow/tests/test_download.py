@@ -0,0 +1,144 @@
+import datetime
+import json
+import logging
+import os
+import re
+
+import netCDF4
+import pytest
+import requests
+
+import gfsworkflow
+import nomads_standin
+from conftest import STEPS, TIMESTAMP
+
+
+def gribs_folder(threddspath):
+    return os.path.join(gfsworkflow.staging_path(threddspath, TIMESTAMP), 'gribs')
+
+
+def test_manifest_resumes_after_a_missing_step(run_workflow, standin):
+    # 012 isn't posted yet, 006 downloads and is recorded in the manifest
+    standin.settings['missing'] = {12}
+    assert run_workflow() == 'Workflow Aborted- Downloading Errors Occurred'
+    with open(os.path.join(gribs_folder(run_workflow.threddspath), 'manifest.json')) as f:
+        manifest = json.loads(f.read())
+    assert manifest['006']['status'] == 'complete'
+    assert manifest['012']['status'] == 'pending'
+    with open(os.path.join(run_workflow.threddspath, 'journal.json')) as f:
+        journal = json.loads(f.read())
+    assert journal['status'] == 'failed'
+    assert journal['stages']['download']['steps']['012']['status'] == 'failed'
+
+    # once it is posted only 012 is downloaded, 006 is verified against its checksum instead
+    standin.settings['missing'] = set()
+    standin.requests.clear()
+    assert run_workflow() == 'GFS Workflow Completed- Normal Finish'
+    paths = [path for method, path, byte_range in standin.requests]
+    assert not any('f006' in path for path in paths)
+    assert any('f012' in path for path in paths)
+    assert gfsworkflow.current_cycle(run_workflow.threddspath) == TIMESTAMP
+
+
+def test_part_file_resumes_with_a_range_request(standin, tmp_path, monkeypatch):
+    monkeypatch.setattr(gfsworkflow, 'NOMADS', standin.url)
+    grib, inventory = nomads_standin.synthetic_step(TIMESTAMP, 6)
+    filepath = str(tmp_path / gfsworkflow.grib_filename(TIMESTAMP, '006'))
+    half = len(grib) // 2
+    with open(filepath + '.part', 'wb') as f:
+        f.write(grib[:half])
+    url = gfsworkflow.gfs_file_url(TIMESTAMP, '006')
+    session = gfsworkflow.new_session(1)
+
+    # a 404 gives up right away without touching what was already downloaded
+    standin.settings['missing'] = {6}
+    with pytest.raises(requests.HTTPError):
+        gfsworkflow.download_step(session, url, filepath, wait=0)
+    assert os.path.getsize(filepath + '.part') == half
+
+    # the rest is asked for with a Range header and appended
+    standin.settings['missing'] = set()
+    standin.requests.clear()
+    size, checksum = gfsworkflow.download_step(session, url, filepath, wait=0)
+    assert standin.requests[-1][2] == 'bytes=' + str(half) + '-'
+    assert size == len(grib)
+    with open(filepath, 'rb') as f:
+        assert f.read() == grib
+    assert checksum == gfsworkflow.file_checksum(filepath)
+    assert not os.path.exists(filepath + '.part')
+
+
+def test_selection_downloads_only_the_selected_ranges(run_workflow, standin, tmp_path):
+    selection = tmp_path / 'selection.json'
+    selection.write_text(json.dumps({'TMP': ['2 m above ground', '\\d+ mb'], 'RH': ['0.44-1 sigma layer']}))
+    assert run_workflow(selection=str(selection)) == 'GFS Workflow Completed- Normal Finish'
+
+    # the .idx of each step is read and the gribs are only requested by byte range
+    idx = [path for method, path, byte_range in standin.requests if path.endswith('.idx')]
+    gribs = [(path, byte_range) for method, path, byte_range in standin.requests if not path.endswith('.idx')]
+    assert len(idx) == 2
+    assert len(gribs) == 2
+    assert all(byte_range for path, byte_range in gribs)
+    # TMP at 850 and 500 mb are next to each other in the grib so they are one range
+    assert all(len(byte_range.split(',')) == 3 for path, byte_range in gribs)
+
+    netcdfs = os.path.join(run_workflow.threddspath, TIMESTAMP, 'netcdfs')
+    ncs = {level: os.path.join(netcdfs, level + '_2024010106.nc')
+           for level in ('heightAboveGround', 'isobaricInhPa', 'sigmaLayer', 'surface')}
+    with netCDF4.Dataset(ncs['heightAboveGround']) as dataset:
+        assert set(dataset.variables) == {'time', 'lat', 'lon', '2t'}
+    with netCDF4.Dataset(ncs['isobaricInhPa']) as dataset:
+        assert dataset['t'].shape == (1, 2, 721, 1440)
+        assert dataset['pressure'][:].tolist() == [500, 850]
+    with netCDF4.Dataset(ncs['sigmaLayer']) as dataset:
+        assert dataset['r'].ndim == 3
+        assert dataset['r'].sigma_bounds.tolist() == pytest.approx([.44, 1])
+    with netCDF4.Dataset(ncs['surface']) as dataset:
+        assert set(dataset.variables) == {'time', 'lat', 'lon'}
+
+
+def test_select_ranges_merges_neighbors(standin, monkeypatch):
+    monkeypatch.setattr(gfsworkflow, 'NOMADS', standin.url)
+    grib, inventory = nomads_standin.synthetic_step(TIMESTAMP, 6)
+    parsed = gfsworkflow.read_idx(requests.Session(), gfsworkflow.gfs_file_url(TIMESTAMP, '006') + '.idx')
+    assert [message['start'] for message in parsed] == [offset for offset, var, level in inventory]
+    # TMP at 850 and 500 mb are neighbors, HGT at 500 mb comes next
+    selection = {'TMP': [re.compile('\\d+ mb')]}
+    assert gfsworkflow.select_ranges(parsed, selection) == [[inventory[6][0], inventory[8][0] - 1]]
+    # the last message runs to the end of the file
+    selection = {'RH': [re.compile('.* sigma layer')]}
+    assert gfsworkflow.select_ranges(parsed, selection) == [[inventory[-2][0], None]]
+
+
+def test_detect_cycle_finds_the_steps_nomads_has_posted(standin, monkeypatch):
+    monkeypatch.setattr(gfsworkflow, 'NOMADS', standin.url)
+    monkeypatch.setattr(gfsworkflow, 'FC_STEPS', ['006', '012', '018'])
+    # the stand-in serves every cycle so the newest one is the one for the current synoptic hour
+    now = datetime.datetime.utcnow()
+    newest = now.replace(hour=now.hour - now.hour % 6).strftime('%Y%m%d%H')
+    standin.settings['missing'] = {12}
+    assert gfsworkflow.detect_cycle() == (newest, ['006'])
+    standin.settings['missing'] = {6, 12, 18}
+    assert gfsworkflow.detect_cycle() == (None, [])
+
+
+def test_a_cycle_that_is_still_being_posted_is_waited_for(standin, tmp_path, monkeypatch, caplog):
+    threddspath = tmp_path / 'gfs'
+    threddspath.mkdir()
+    monkeypatch.setattr(gfsworkflow, 'NOMADS', standin.url)
+    monkeypatch.setattr(gfsworkflow, 'FC_STEPS', list(STEPS))
+    monkeypatch.setattr(gfsworkflow, 'BOUNDS_FILE', str(tmp_path / 'bounds.js'))
+    standin.settings['missing'] = {12}
+    slept = []
+
+    def sleep(seconds):
+        # 012 is posted while the workflow waits for it
+        if seconds:
+            slept.append(seconds)
+            standin.settings['missing'] = set()
+
+    monkeypatch.setattr(gfsworkflow.time, 'sleep', sleep)
+    caplog.set_level(logging.INFO)
+    assert gfsworkflow.workflow(str(threddspath)) == 'GFS Workflow Completed- Normal Finish'
+    assert slept == [60]
+    assert 'waiting up to ' + str(gfsworkflow.POSTING_WAIT) + ' seconds' in caplog.text
@@ -0,0 +1,72 @@
+import json
+import os
+
+import gfsworkflow
+
+from conftest import TIMESTAMP
+
+
+def read_prom(path):
+    # the samples of a prometheus text file as {name{labels}: value}
+    with open(path) as f:
+        return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+                for line in f.read().splitlines() if line and not line.startswith('#')}
+
+
+def test_metrics_of_a_run(run_workflow, tmp_path):
+    promfile = str(tmp_path / 'gfs_workflow.prom')
+    assert run_workflow(promfile=promfile) == 'GFS Workflow Completed- Normal Finish'
+    assert not os.path.exists(promfile + '.tmp')
+    samples = read_prom(promfile)
+    assert samples['gfs_workflow_success'] == 1
+    assert samples['gfs_workflow_cycle'] == int(TIMESTAMP)
+    assert samples['gfs_workflow_steps_converted'] == 2
+    assert samples['gfs_workflow_downloaded_bytes'] > 0
+    assert samples['gfs_workflow_download_throughput_bytes_per_second{step="006"}'] > 0
+    assert 'gfs_workflow_download_throughput_bytes_per_second{step="012"}' in samples
+    assert 'gfs_workflow_decode_seconds{level="surface"}' in samples
+    assert 'gfs_workflow_write_seconds{level="isobaricInhPa"}' in samples
+    assert samples['gfs_workflow_messages_converted'] > 0
+    assert samples['gfs_workflow_peak_rss_bytes'] > 0
+    with open(promfile) as f:
+        assert '# TYPE gfs_workflow_success gauge' in f.read().splitlines()
+
+    # every download and conversion is a line of metrics.jsonl, followed by the summary of the run
+    with open(os.path.join(run_workflow.threddspath, 'metrics.jsonl')) as f:
+        lines = [json.loads(line) for line in f.read().splitlines()]
+    assert sorted(line['step'] for line in lines if line['kind'] == 'download') == ['006', '012']
+    assert sorted(line['step'] for line in lines if line['kind'] == 'convert') == ['006', '012']
+    summary = lines[-1]
+    assert summary['kind'] == 'run' and summary['status'] == 'complete' and summary['cycle'] == TIMESTAMP
+    assert summary['bytes'] == samples['gfs_workflow_downloaded_bytes']
+
+
+def test_metrics_of_a_failed_run(run_workflow, standin, tmp_path):
+    promfile = str(tmp_path / 'gfs_workflow.prom')
+    standin.settings['missing'] = {12}
+    assert run_workflow(promfile=promfile).startswith('Workflow Aborted')
+    samples = read_prom(promfile)
+    assert samples['gfs_workflow_success'] == 0
+    assert samples['gfs_workflow_steps_converted'] == 0
+    assert 'gfs_workflow_download_throughput_bytes_per_second{step="012"}' not in samples
+
+
+def test_measured_worker_memory(tmp_path):
+    metrics = tmp_path / 'metrics.jsonl'
+    assert gfsworkflow.measured_worker_memory(str(tmp_path)) is None
+    lines = [{'kind': 'convert', 'rss': 300}, {'kind': 'download', 'bytes': 5}, {'kind': 'convert', 'rss': 200}]
+    metrics.write_text(''.join(json.dumps(line) + '\n' for line in lines))
+    # the first line counts when the whole file is read
+    assert gfsworkflow.measured_worker_memory(str(tmp_path)) == 300
+    # but not when the read starts partway into it
+    tail = len(metrics.read_text()) - 10
+    assert gfsworkflow.measured_worker_memory(str(tmp_path), tail=tail) == 200
+
+
+def test_conversion_workers_fit_under_the_memory_ceiling(tmp_path):
+    assert gfsworkflow.conversion_workers(str(tmp_path), 4, 10 ** 6) == 4
+    # always at least one, even if it doesn't fit
+    assert gfsworkflow.conversion_workers(str(tmp_path), 4, 1) == 1
+    # the measured memory of the recent conversions is used instead of WORKER_MEMORY
+    (tmp_path / 'metrics.jsonl').write_text(json.dumps({'kind': 'convert', 'rss': 10 ** 12}) + '\n')
+    assert gfsworkflow.conversion_workers(str(tmp_path), 4, 10 ** 6) == 1
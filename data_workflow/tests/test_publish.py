@@ -0,0 +1,86 @@
+import json
+import os
+
+import gfsworkflow
+from conftest import TIMESTAMP
+
+LATER = '2024010106'
+
+
+def read_text(*path):
+    with open(os.path.join(*path)) as f:
+        return f.read()
+
+
+def test_publish_points_at_the_new_cycle_and_keeps_the_recent_ones(run_workflow):
+    path = run_workflow.threddspath
+    cycles = [TIMESTAMP, LATER, '2024010112']
+    for cycle in cycles:
+        assert run_workflow(cycle, keep=1) == 'GFS Workflow Completed- Normal Finish'
+        # the cycle is moved out of staging and the pointers the app reads are swapped over to it
+        assert not os.path.exists(gfsworkflow.staging_path(path, cycle))
+        assert os.readlink(os.path.join(path, 'current')) == cycle
+        assert read_text(path, 'last_run.txt') == cycle
+        assert 'location="' + cycle + '/netcdfs/surface_' in read_text(path, 'surface_wms.ncml')
+        assert json.loads(read_text(path, 'catalog.json'))['timestamp'] == cycle
+        assert not [file for file in os.listdir(path) if file.endswith('.tmp')]
+
+    # the current cycle and the one before it are kept, the rest are deleted
+    assert sorted(file for file in os.listdir(path) if file.isdigit()) == cycles[1:]
+    # running again for the same cycle does nothing
+    assert run_workflow(cycles[-1]) == 'Workflow Aborted- already run for most recent data'
+
+
+def test_clobber_replaces_the_published_cycle(run_workflow):
+    path = run_workflow.threddspath
+    assert run_workflow() == 'GFS Workflow Completed- Normal Finish'
+    marker = os.path.join(path, TIMESTAMP, 'marker')
+    open(marker, 'w').close()
+    assert run_workflow(clobber='yes') == 'GFS Workflow Completed- Normal Finish'
+    assert os.readlink(os.path.join(path, 'current')) == TIMESTAMP
+    assert not os.path.exists(marker)
+    assert not os.path.exists(os.path.join(path, 'staging', TIMESTAMP + '.old'))
+
+
+def test_streaming_only_publishes_a_finished_cycle(run_workflow, standin):
+    path = run_workflow.threddspath
+    assert run_workflow() == 'GFS Workflow Completed- Normal Finish'
+
+    # the next cycle is streamed but its last step never arrives
+    standin.settings['missing'] = {12}
+    message = run_workflow(LATER, stream=True)
+    assert message == 'Workflow Aborted- Downloading or Conversion Errors Occurred'
+    # the served ncmls and pointers stay on the published cycle
+    assert os.readlink(os.path.join(path, 'current')) == TIMESTAMP
+    assert read_text(path, 'last_run.txt') == TIMESTAMP
+    assert 'location="' + TIMESTAMP + '/' in read_text(path, 'surface_wms.ncml')
+    # the steps that did arrive are in the partial ncmls and catalog
+    partial = read_text(path, 'surface_partial_wms.ncml')
+    assert 'location="staging/' + LATER + '/netcdfs/surface_2024010112.nc"' in partial
+    catalog = json.loads(read_text(path, 'partial_catalog.json'))
+    assert catalog['timestamp'] == LATER and not catalog['complete']
+
+    # once it finishes it is published and the partial files are removed
+    standin.settings['missing'] = set()
+    assert run_workflow(LATER, stream=True) == 'GFS Workflow Completed- Normal Finish'
+    assert os.readlink(os.path.join(path, 'current')) == LATER
+    assert 'location="' + LATER + '/' in read_text(path, 'surface_wms.ncml')
+    assert not os.path.exists(os.path.join(path, 'surface_partial_wms.ncml'))
+    assert not os.path.exists(os.path.join(path, 'partial_catalog.json'))
+
+
+def test_streaming_serves_the_steps_until_the_consolidated_files_are_published(run_workflow, standin):
+    path = run_workflow.threddspath
+    staged = os.path.join(gfsworkflow.staging_path(path, TIMESTAMP), 'netcdfs')
+    standin.settings['missing'] = {12}
+    assert run_workflow(stream=True, consolidate=True).startswith('Workflow Aborted')
+    # the first step is served from its own netcdf, nothing is appended while the cycle is streaming
+    partial = read_text(path, 'surface_partial_wms.ncml')
+    assert 'location="staging/' + TIMESTAMP + '/netcdfs/surface_2024010106.nc"' in partial
+    assert not os.path.exists(os.path.join(staged, 'surface.nc'))
+
+    standin.settings['missing'] = set()
+    assert run_workflow(stream=True, consolidate=True) == 'GFS Workflow Completed- Normal Finish'
+    assert 'location="' + TIMESTAMP + '/netcdfs/surface.nc"' in read_text(path, 'surface_wms.ncml')
+    assert sorted(os.listdir(os.path.join(path, TIMESTAMP, 'netcdfs'))) == sorted(
+        level + '.nc' for level in gfsworkflow.FORECAST_LEVELS)
@@ -0,0 +1,84 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import netCDF4
+
+import gfsworkflow
+from conftest import TIMESTAMP
+
+# a worker in a process of its own, like one started with "python gfsworkflow.py /path/to/gfs worker"
+WORKER = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import gfsworkflow
+gfsworkflow.NOMADS = sys.argv[3]
+gfsworkflow.FC_STEPS = sys.argv[4].split(',')
+print(gfsworkflow.work(sys.argv[2]))
+'''
+
+
+def test_workers_retry_a_failed_step_until_it_runs_out_of_attempts(tmp_path, monkeypatch):
+    units = os.path.join(gfsworkflow.staging_path(str(tmp_path), TIMESTAMP), 'units')
+    os.makedirs(units)
+    (tmp_path / 'workqueue.json').write_text(json.dumps(
+        {'timestamp': TIMESTAMP, 'selection': None, 'ncoptions': None, 'domains': {}, 'attempts': 3}))
+    monkeypatch.setattr(gfsworkflow, 'FC_STEPS', ['006', '012'])
+    calls = []
+
+    def run_unit(session, threddspath, timestamp, step, *args):
+        calls.append(step)
+        if step == '006':
+            raise OSError('step 006 is corrupt')
+        gfsworkflow.write_unit(units, step, 'done', {})
+
+    monkeypatch.setattr(gfsworkflow, 'run_unit', run_unit)
+    assert gfsworkflow.work(str(tmp_path)) == 'Worker Finished- 1 steps converted, 1 failed'
+    # the failed step is only tried again once there is nothing else to do, and no more than the attempts
+    assert calls == ['006', '012', '006', '006']
+    attempts = gfsworkflow.failed_attempts(units, '006')
+    assert len(attempts) == 3 and 'step 006 is corrupt' in attempts[-1]['error']
+    assert gfsworkflow.unit_status(units, '006', 3) == 'failed'
+    assert gfsworkflow.unit_status(units, '006', 4) == 'pending'
+    assert gfsworkflow.unit_status(units, '012', 3) == 'complete'
+    assert not [file for file in os.listdir(units) if file.endswith('.claim')]
+
+
+def test_workers_in_separate_processes_share_a_cycle(standin, tmp_path, monkeypatch):
+    path = str(tmp_path)
+    steps = ['006', '012', '018', '024']
+    monkeypatch.setattr(gfsworkflow, 'NOMADS', standin.url)
+    monkeypatch.setattr(gfsworkflow, 'FC_STEPS', steps)
+    monkeypatch.setattr(gfsworkflow, 'BOUNDS_FILE', str(tmp_path / 'bounds.js'))
+    monkeypatch.setattr(gfsworkflow, 'detect_cycle', lambda *args, **kwargs: (TIMESTAMP, steps))
+    outcome = []
+    coordinator = threading.Thread(target=lambda: outcome.append(
+        gfsworkflow.coordinate(path, consolidate=True, detect=True, poll=.2, timeout=600)))
+    coordinator.start()
+    while not os.path.exists(os.path.join(path, 'workqueue.json')):
+        assert coordinator.is_alive()
+        time.sleep(.1)
+
+    folder = os.path.dirname(os.path.abspath(gfsworkflow.__file__))
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER, folder, path, standin.url, ','.join(steps)],
+                                stdout=subprocess.PIPE, universal_newlines=True) for _ in range(2)]
+    finished = [worker.communicate(timeout=600)[0].strip() for worker in workers]
+    coordinator.join(timeout=600)
+    assert outcome == ['GFS Workflow Completed- Normal Finish']
+    # every step was claimed and converted by exactly one of the workers
+    assert sum(int(message.split('- ')[1].split()[0]) for message in finished) == len(steps)
+    logs = os.path.join(path, TIMESTAMP, 'logs')
+    assert len(os.listdir(logs)) == 2
+    claimed = []
+    for log in os.listdir(logs):
+        with open(os.path.join(logs, log)) as f:
+            claimed += [line.split()[-1] for line in f.read().splitlines() if line.startswith('claimed step')]
+    assert sorted(claimed) == steps
+    # and the coordinator consolidated them in order
+    with netCDF4.Dataset(os.path.join(path, TIMESTAMP, 'netcdfs', 'surface.nc')) as dataset:
+        assert dataset['time'][:].tolist() == [6, 12, 18, 24]
+    assert sorted(os.listdir(os.path.join(path, TIMESTAMP, 'netcdfs'))) == sorted(
+        level + '.nc' for level in gfsworkflow.FORECAST_LEVELS)
@@ -9,6 +9,8 @@ from django.http import JsonResponse
 
 from .charts import newchart
 from .options import variable_levels
+from .utilities import responses
+from .regions import boundary_index, boundary
 from .app import Gfs as App
 
 
@@ -19,7 +21,28 @@ def getchart(request):
     """
     data = ast.literal_eval(request.body.decode('utf-8'))
     data['instance_id'] = request.META['HTTP_COOKIE'].split('instance_id=')[1][0:9]
-    return JsonResponse(newchart(data))
+    return JsonResponse(responses.get(data, newchart))
+
+
+def getboundary(request):
+    """
+    The stored boundary of a country or world region for the map, or of every world region if no name is given, so
+    the map doesn't load them from the Living Atlas
+    """
+    name = request.GET.get('name', '')
+    try:
+        tolerance = float(request.GET.get('tolerance', .05))
+    except ValueError:
+        tolerance = .05
+    places = boundary_index()['places']
+    if name:
+        names = [name] if name in places else []
+    else:
+        names = [place for place in places if places[place]['layer'] == 'regions']
+    features = []
+    for place in names:
+        features += boundary(place, tolerance)['features']
+    return JsonResponse({'type': 'FeatureCollection', 'features': features})
 
 
 def get_levels_for_variable(request):
@@ -6,8 +6,9 @@ from rest_framework.decorators import api_view, authentication_classes
 
 from .app import Gfs as App
 from .charts import newchart
-from .options import gfs_variables, gfs_levels, variable_levels, worldregions, countries
-from .utilities import get_gfsdate, new_id
+from .options import gfs_variables, gfs_levels, variable_levels
+from .utilities import get_gfsdate, new_id, responses
+from .regions import boundary_index
 
 
 class TimeSeries:
@@ -20,6 +21,8 @@ class TimeSeries:
             self.data['variable'] = parameters['variable']
             self.data['level'] = parameters['level']
             self.data['location'] = json.loads(parameters.getlist('location')[0])
+            self.data['vertical'] = parameters.get('vertical')
+            self.data['profile'] = parameters.get('profile', '').lower() == 'true'
             self.validate()
         except KeyError as e:
             self.error = 'Missing parameter: ' + str(e).replace('"', '').replace("'", '')
@@ -65,17 +68,26 @@ class TimeSeries:
             self.error = 'Invalid level selection for given variable, please try again'
             return
 
+        # validate vertical argument
+        if self.data['vertical'] is not None:
+            try:
+                float(self.data['vertical'])
+            except ValueError:
+                self.error = 'Invalid vertical level, give the number of the level in the units of the variable'
+                return
+
         # validate location argument
         if len(self.data['location']) == 1:
-            self.data['loc_type'] = 'VectorGeometry'
             self.data['location'] = self.data['location'][0]
-            if self.data['location'] in worldregions():
-                self.data['vectordata'] = 'esri-regions-' + self.data['location']
-            elif self.data['location'] in countries():
-                self.data['vectordata'] = 'esri-countries-' + self.data['location']
-            else:
+            try:
+                places = boundary_index()['places']
+            except OSError:
+                self.error = 'The country and region boundaries are not available, try again later'
+                return
+            if self.data['location'] not in places:
                 self.error = 'Country/Region name not recognized. Check your spelling/capitalization'
                 return
+            self.data['loc_type'] = 'esri-' + self.data['location']
         elif len(self.data['location']) == 2:
             self.data['loc_type'] = 'Point'
             if not self.validate_points():
@@ -99,9 +111,14 @@ class TimeSeries:
 @api_view(['GET'])
 @authentication_classes((TokenAuthentication, SessionAuthentication,))
 def helpme(request):
+    try:
+        places = boundary_index()['places']
+    except OSError:
+        places = {}
     return JsonResponse({
         'documentation_website': App.docslink,
         'required_arguments': ['variable', 'level', 'location'],
+        'optional_arguments': ['vertical', 'profile'],
         'time': 'The most recent available GFS data is from ' + get_gfsdate(),
         'variable': {
             'Description': 'The abbreviated name of a variable used by NASA in the GLDAS data files.',
@@ -111,13 +128,22 @@ def helpme(request):
             'Description': 'The abbreviated name of a measurement level corresponding to the variable choice.',
             'Options': gfs_levels(),
         },
+        'vertical': {
+            'Description': 'For a variable at several levels of the chosen level type, the level to use, e.g. 500 for '
+                           '500 hPa, or the middle of a layer, e.g. 0.58 for the 0.44-0.72 sigma layer. The first '
+                           'level is used if not given.',
+        },
+        'profile': {
+            'Description': 'true to get the values at every level of a Point for each time step instead of a '
+                           'timeseries, for a variable at several levels.',
+        },
         'location': {
             'Description': 'Available locations are points, bounding boxes, countries, or world regions',
             'Point': 'To get values at a point, provide a list in the form: [longitude, latitude]',
             'Bounding Box': 'To get values in a bounding box, provide a list in the form: '
                             '[min_longitude, max_longitude, min_latitude, max_latitude]',
-            'Regions': [i[0] for i in worldregions() if i[1] != '' and i[1] != 'none'],
-            'Countries': countries(),
+            'Regions': sorted(name for name, place in places.items() if place['layer'] == 'regions'),
+            'Countries': sorted(name for name, place in places.items() if place['layer'] == 'countries'),
         },
     })
 
@@ -137,6 +163,12 @@ def varlevels(request):
 def timeseries(request):
     ts = TimeSeries(request.GET)
     if ts.isValid:
-        return JsonResponse(newchart(ts.data))
+        return JsonResponse(responses.get(ts.data, newchart))
     else:
         return JsonResponse({'Error': ts.error})
+
+
+@api_view(['GET'])
+@authentication_classes((TokenAuthentication, SessionAuthentication,))
+def cachestats(request):
+    return JsonResponse(responses.stats())
@@ -54,6 +54,11 @@ class Gfs(TethysAppBase):
                 url='gfs/ajax/getChart',
                 controller='gfs.ajax.getchart',
             ),
+            urlmap(
+                name='getBoundary',
+                url='gfs/ajax/getBoundary',
+                controller='gfs.ajax.getboundary',
+            ),
             urlmap(
                 name='uploadShapefile',
                 url='gfs/ajax/uploadShapefile',
@@ -81,6 +86,11 @@ class Gfs(TethysAppBase):
                 url='gfs/api/timeseries',
                 controller='gfs.api.timeseries',
             ),
+            urlmap(
+                name='cachestats',
+                url='gfs/api/cacheStats',
+                controller='gfs.api.cachestats',
+            ),
         )
         return url_maps
 
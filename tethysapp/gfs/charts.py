@@ -8,14 +8,215 @@ import os
 import glob
 import json
 import shutil
+import datetime
 
-import netCDF4 as nc
+import numpy as np
+import pandas as pd
 import geomatics as gm
 
 from .options import gfs_variables
-from .utilities import get_gfsdate
+from .utilities import get_gfsdate, datasets
+from .regions import region_weights, weights_extent, GRID_LAT0, GRID_LON0, GRID_RESOLUTION
 from .app import Gfs as App
 
+# The size in bytes of the header at the start of a cube written by the workflow (see data_workflow's write_cube)
+CUBE_HEADER = 4096
+
+
+def consolidated_times(dataset):
+    # the time variable of a consolidated file is in hours since the forecast's start
+    start = datetime.datetime.strptime(dataset['time'].units.replace('hours since ', ''), '%Y-%m-%d %H:%M:%S')
+    return [start + datetime.timedelta(hours=int(hour)) for hour in dataset['time'][:]]
+
+
+def nearest_cell(dataset, coords):
+    # the (lat, lon) index of the grid cell nearest to a (lon, lat) point
+    lon = int(np.abs(dataset['lon'][:] - float(coords[0])).argmin())
+    lat = int(np.abs(dataset['lat'][:] - float(coords[1])).argmin())
+    return lat, lon
+
+
+def vertical_index(dataset, variable, vertical=None):
+    # the position of the level nearest to vertical in a (time, vertical, lat, lon) variable, the first if not given
+    values = dataset[dataset[variable].dimensions[1]][:]
+    return int(np.abs(values - float(vertical)).argmin()) if vertical is not None else 0
+
+
+def read_cells(files, variable, cells, date_pattern=False):
+    """
+    Reads variable[:, *cells] from a consolidated netcdf (files is [path] and date_pattern is False) or from the
+    netcdf for each time step, whose times come from their names. Returns the times and the values with time first.
+    """
+    if not date_pattern:
+        with datasets.open(files[0]) as dataset:
+            return consolidated_times(dataset), dataset[variable][(slice(None),) + tuple(cells)]
+    times = []
+    values = []
+    for file in files:
+        with datasets.open(file) as dataset:
+            values.append(dataset[variable][(0,) + tuple(cells)])
+        times.append(datetime.datetime.strptime(os.path.basename(file), date_pattern))
+    return times, np.ma.stack(values)
+
+
+def vertical_profile(files, variable, coords, date_pattern=False):
+    """
+    Reads every level of a variable with a vertical dimension at the cell nearest to a point for each time step.
+    The cell and the levels come from the first file since they are the same in all of them, then each file is one
+    read of the column. Returns the levels, their units, and a DataFrame with a datetime column and one per level.
+    """
+    with datasets.open(files[0]) as dataset:
+        lat, lon = nearest_cell(dataset, coords)
+        vertical = dataset[variable].dimensions[1]
+        levels = dataset[vertical][:].tolist()
+        units = dataset[vertical].units
+    times, values = read_cells(files, variable, (slice(None), lat, lon), date_pattern)
+    profile = pd.DataFrame(np.ma.filled(values.astype(float), np.nan), columns=levels)
+    profile.insert(0, 'datetime', pd.to_datetime(times))
+    return levels, units, profile
+
+
+def cell_timeseries(files, variable, loc_type, coords, vertical=None, date_pattern=False):
+    """
+    The timeseries at a point or the average in a bounding box, at one level if the variable has a vertical dimension.
+    Returns that level (None without a vertical dimension) and the timeseries.
+    """
+    with datasets.open(files[0]) as dataset:
+        if dataset[variable].ndim == 4:
+            position = vertical_index(dataset, variable, vertical)
+            level = float(dataset[dataset[variable].dimensions[1]][position])
+            cells = (position,)
+        else:
+            level = None
+            cells = ()
+        if loc_type == 'Point':
+            cells += nearest_cell(dataset, coords)
+        else:
+            corners = [nearest_cell(dataset, corner) for corner in coords]
+            lats = sorted(corner[0] for corner in corners)
+            lons = sorted(corner[1] for corner in corners)
+            cells += (slice(lats[0], lats[1] + 1), slice(lons[0], lons[1] + 1))
+    times, values = read_cells(files, variable, cells, date_pattern)
+    values = np.ma.filled(values.reshape(values.shape[0], -1).mean(axis=1).astype(float), np.nan)
+    return level, pd.DataFrame({'datetime': pd.to_datetime(times), 'values': values})
+
+
+def region_timeseries(files, variable, weights, vertical=None, date_pattern=False):
+    """
+    The area weighted average in a region at each time step, at one level if the variable has a vertical dimension.
+    weights is the rows, columns, and weights of the region's cells on the global grid (see regions.area_weights).
+    Only the window of cells around the region is read from each file and then averaged with one dot product, leaving
+    out missing values. Returns the level (None without a vertical dimension) and the timeseries.
+    """
+    rows, cols, weights = weights
+    with datasets.open(files[0]) as dataset:
+        # a regional domain's grid starts part way into the global grid
+        rows = rows - int(round((float(dataset['lat'][0]) - GRID_LAT0) / GRID_RESOLUTION))
+        cols = cols - int(round((float(dataset['lon'][0]) - GRID_LON0) / GRID_RESOLUTION))
+        window = (slice(int(rows.min()), int(rows.max()) + 1), slice(int(cols.min()), int(cols.max()) + 1))
+        if dataset[variable].ndim == 4:
+            position = vertical_index(dataset, variable, vertical)
+            level = float(dataset[dataset[variable].dimensions[1]][position])
+            window = (position,) + window
+        else:
+            level = None
+    times, values = read_cells(files, variable, window, date_pattern)
+    values = np.ma.filled(values.astype(float), np.nan)[:, rows - rows.min(), cols - cols.min()]
+    found = ~np.isnan(values)
+    with np.errstate(invalid='ignore'):
+        values = np.where(found, values, 0) @ weights / (found @ weights)
+    return level, pd.DataFrame({'datetime': pd.to_datetime(times), 'values': values})
+
+
+def read_cube_header(path):
+    # the json header at the start of a cube
+    with open(path, 'rb') as f:
+        header = f.read(CUBE_HEADER)
+    if not header.startswith(b'GFSCUBE1'):
+        raise ValueError(path + ' is not a cube')
+    return json.loads(header[8:].decode())
+
+
+def cube_cell(header, coords):
+    # the (lat, lon) index of the cell nearest to a (lon, lat) point, computed from the regular grid of a cube
+    lat = int(round((float(coords[1]) - header['lat0']) / header['resolution']))
+    lon = int(round((float(coords[0]) - header['lon0']) / header['resolution']))
+    return min(max(lat, 0), header['shape'][1] - 1), lon % header['shape'][2]
+
+
+def cube_timeseries(path, loc_type, coords, vertical=None):
+    """
+    The timeseries at a point or the average in a bounding box from a cube. The values of a cell are stored together
+    so the memory mapped cube only reads the few pages holding the cells. Returns the level of the values (None if
+    the variable has no vertical dimension), the units, and the timeseries.
+    """
+    header = read_cube_header(path)
+    cube = np.memmap(path, dtype=header['dtype'], mode='r', offset=CUBE_HEADER, shape=tuple(header['shape']))
+    position = 0
+    level = None
+    if header['vertical']:
+        levels = np.array(header['vertical']['values'])
+        position = int(np.abs(levels - float(vertical)).argmin()) if vertical is not None else 0
+        level = float(levels[position])
+    if loc_type == 'Point':
+        values = np.array(cube[(position,) + cube_cell(header, coords)], dtype=float)
+    else:
+        corners = [cube_cell(header, corner) for corner in coords]
+        lats = sorted(corner[0] for corner in corners)
+        lons = sorted(corner[1] for corner in corners)
+        box = cube[position, lats[0]:lats[1] + 1, lons[0]:lons[1] + 1]
+        values = np.nanmean(box.reshape(-1, box.shape[-1]), axis=0).astype(float)
+    del cube
+    start = datetime.datetime.strptime(header['timestamp'], '%Y%m%d%H')
+    times = [start + datetime.timedelta(hours=hour) for hour in header['hours']]
+    return level, header['units'], pd.DataFrame({'datetime': pd.to_datetime(times), 'values': values})
+
+
+def chart_response(meta, timeseries):
+    dates = timeseries['datetime'].dt.strftime('%Y-%m-%d %H')
+    dates = dates.tolist()
+
+    return {
+        'meta': meta,
+        'timeseries': list(zip(dates, timeseries.values[:, 1])),
+    }
+
+
+def geojson_extent(geojson):
+    # the [west, east, south, north] of every coordinate in a geojson
+    def positions(item):
+        if isinstance(item, dict):
+            for key in ('features', 'geometry', 'geometries', 'coordinates'):
+                if key in item:
+                    yield from positions(item[key])
+        elif item and isinstance(item[0], (str, int, float)):
+            # the coordinates of a chart request can be strings
+            yield item
+        else:
+            for value in item:
+                yield from positions(value)
+    lons, lats = zip(*((float(position[0]), float(position[1])) for position in positions(geojson)))
+    return [min(lons), max(lons), min(lats), max(lats)]
+
+
+def chart_folder(cyclepath, extent):
+    """
+    The folder of netcdfs to read a chart from: the smallest of the regional domains the workflow wrote (listed in the
+    cycle's domains/domains.json) that contains the [west, east, south, north] extent of the chart's location, or the
+    global netcdfs if none do or the extent isn't known
+    """
+    domainsfile = os.path.join(cyclepath, 'domains', 'domains.json')
+    if extent is None or not os.path.exists(domainsfile):
+        return os.path.join(cyclepath, 'netcdfs')
+    with open(domainsfile, 'r') as f:
+        domains = json.loads(f.read())
+    west, east, south, north = extent
+    fits = [((bounds[1] - bounds[0]) * (bounds[3] - bounds[2]), name) for name, bounds in domains.items()
+            if bounds[0] <= west and east <= bounds[1] and bounds[2] <= south and north <= bounds[3]]
+    if not fits:
+        return os.path.join(cyclepath, 'netcdfs')
+    return os.path.join(cyclepath, 'domains', min(fits)[1])
+
 
 def newchart(data):
     """
@@ -36,32 +237,61 @@ def newchart(data):
         shutil.rmtree(user_workspace)
     os.mkdir(user_workspace)
     date_pattern = data['level'] + '_%Y%m%d%H.nc'
+    cyclepath = os.path.join(App.get_custom_setting('thredds_path'), get_gfsdate())
 
-    # list the netcdfs to be processed
-    path = App.get_custom_setting('thredds_path')
-    timestamp = get_gfsdate()
-    path = os.path.join(path, timestamp, 'netcdfs')
-    files = [n for n in os.listdir(path) if n.startswith(data['level']) and n.endswith('.nc')]
-    files = [os.path.join(path, file) for file in files]
-    files.sort()
+    # points and bounding boxes come from the variable's cube instead of the netcdfs if the workflow wrote cubes
+    cube = os.path.join(cyclepath, 'cubes', data['level'], data['variable'] + '.cube')
+    if data['loc_type'] in ('Point', 'Polygon') and not data.get('profile') and os.path.exists(cube):
+        coords = data['coords'] if data['loc_type'] == 'Point' else (data['coords'][0][0], data['coords'][0][2])
+        level, meta['units'], timeseries = cube_timeseries(cube, data['loc_type'], coords, data.get('vertical'))
+        if level is not None:
+            meta['vertical'] = level
+        meta['seriesmsg'] = 'At a Point' if data['loc_type'] == 'Point' else 'In a Bounding Box'
+        return chart_response(meta, timeseries)
 
-    meta['units'] = nc.Dataset(files[0], 'r')[data['variable']].__dict__['units']
-
-    # get the timeseries, units, and message based on location type
+    # the extent of the location picks the smallest regional domain that has it, if the workflow wrote any
+    extent = None
     if data['loc_type'] == 'Point':
-        timeseries = gm.timeseries.point(files, data['variable'], data['coords'], ('lon', 'lat'),
-                                         strp=date_pattern)
-        meta['seriesmsg'] = 'At a Point'
-
+        extent = [float(data['coords'][0])] * 2 + [float(data['coords'][1])] * 2
     elif data['loc_type'] == 'Polygon':
-        coords = data['coords'][0]
-        coords = (
-            (float(coords[0][0]), float(coords[0][1]),),
-            (float(coords[2][0]), float(coords[2][1]),),
-        )
-        timeseries = gm.timeseries.bounding_box(files, data['variable'], coords[0], coords[1],
-                                                ('lon', 'lat'), strp=date_pattern)
-        meta['seriesmsg'] = 'In a Bounding Box'
+        extent = geojson_extent({'coordinates': data['coords']})
+    elif data['loc_type'].startswith('esri-'):
+        weights = region_weights(data['loc_type'].replace('esri-', ''))
+        extent = weights_extent(*weights[:2])
+
+    # list the netcdfs to be processed, the workflow may have written one consolidated file for the level instead
+    path = chart_folder(cyclepath, extent)
+    files = datasets.files(path, data['level'])
+    if files[0].endswith(os.sep + data['level'] + '.nc'):
+        date_pattern = False
+
+    with datasets.open(files[0]) as dataset:
+        meta['units'] = dataset[data['variable']].__dict__['units']
+        vertical = dataset[data['variable']].ndim == 4
+
+    # a variable at several levels gives the values at every level of a point, or the timeseries at one level
+    if vertical and data.get('profile') and data['loc_type'] == 'Point':
+        levels, meta['vertical_units'], profile = vertical_profile(files, data['variable'], data['coords'],
+                                                                   date_pattern)
+        meta['seriesmsg'] = 'Vertical Profile At a Point'
+        return {
+            'meta': meta,
+            'levels': levels,
+            'profile': list(zip(profile['datetime'].dt.strftime('%Y-%m-%d %H').tolist(),
+                                profile.values[:, 1:].tolist())),
+        }
+    elif vertical and data['loc_type'] not in ('Point', 'Polygon') and not data['loc_type'].startswith('esri-'):
+        meta['seriesmsg'] = 'Only points, bounding boxes, and regions are available for variables with several levels'
+        return {'meta': meta, 'timeseries': []}
+
+    # get the timeseries, units, and message based on location type
+    elif data['loc_type'] in ('Point', 'Polygon'):
+        coords = data['coords'] if data['loc_type'] == 'Point' else (data['coords'][0][0], data['coords'][0][2])
+        level, timeseries = cell_timeseries(files, data['variable'], data['loc_type'], coords, data.get('vertical'),
+                                            date_pattern)
+        if level is not None:
+            meta['vertical'] = level
+        meta['seriesmsg'] = 'At a Point' if data['loc_type'] == 'Point' else 'In a Bounding Box'
 
     elif data['loc_type'] == 'Shapefile':
         shp = [i for i in os.listdir(user_workspace) if i.endswith('.shp')]
@@ -81,18 +311,9 @@ def newchart(data):
 
     elif data['loc_type'].startswith('esri-'):
         esri_location = data['loc_type'].replace('esri-', '')
-        geojson = gm.data.get_livingatlas_geojson(esri_location)
-        shp = os.path.join(user_workspace, 'tmp.geojson')
-        with open(shp, 'w') as tmp:
-            tmp.write(json.dumps(geojson))
-        timeseries = gm.timeseries.polygons(files, data['variable'], shp, ('lon', 'lat'), strp=date_pattern)
-        os.remove(shp)
+        level, timeseries = region_timeseries(files, data['variable'], weights, data.get('vertical'), date_pattern)
+        if level is not None:
+            meta['vertical'] = level
         meta['seriesmsg'] = 'Within ' + esri_location
 
-    dates = timeseries['datetime'].dt.strftime('%Y-%m-%d %H')
-    dates = dates.tolist()
-
-    return {
-        'meta': meta,
-        'timeseries': list(zip(dates, timeseries.values[:, 1])),
-    }
+    return chart_response(meta, timeseries)
@@ -1,3 +1,7 @@
+import datetime
+import json
+import os
+
 from django.shortcuts import render
 from django.http import JsonResponse
 from tethys_sdk.gizmos import SelectInput, RangeSlider
@@ -133,17 +137,26 @@ def home(request):
 
 @login_required()
 def checkworkflowstatus(request):
+    """
+    Returns the workflow's journal: the status of the run and of each of its stages and steps. A run whose heartbeat
+    stopped is reported as stalled
+    """
     threddspath = os.path.join(App.get_custom_setting('thredds_path'))
-    fail = os.path.join(threddspath, 'last_run_failed.txt')
-    run = os.path.join(threddspath, 'running.txt')
+    journal = os.path.join(threddspath, 'journal.json')
     last = os.path.join(threddspath, 'last_run.txt')
-    if os.path.isfile(last):
+    if os.path.isfile(journal):
+        with open(journal, 'r') as f:
+            progress = json.loads(f.read())
+        if progress['status'] == 'running':
+            heartbeat = datetime.datetime.strptime(progress['heartbeat'], '%Y-%m-%dT%H:%M:%SZ')
+            if (datetime.datetime.utcnow() - heartbeat).total_seconds() > 3 * progress['interval']:
+                progress['status'] = 'stalled'
+        for stage in progress['stages'].values():
+            stage['done'] = len([step for step in stage['steps'].values() if step['status'] == 'complete'])
+            stage['total'] = len(stage['steps'])
+        return JsonResponse(progress)
+    elif os.path.isfile(last):
         with open(last, 'r') as f:
             return JsonResponse({'succeeded': f.readlines()})
-    elif os.path.isfile(run):
-        return JsonResponse({'running': 'running'})
-    elif os.path.isfile(fail):
-        with open(fail, 'r') as f:
-            return JsonResponse({'failed': f.readlines()})
     else:
         return JsonResponse({'unknown': 'no indicator files were found'})
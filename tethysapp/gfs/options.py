@@ -37,6 +37,11 @@ def gfs_variables():
         ('10 metre U wind component', '10u'), ('10 metre V wind component', '10v'),
         ('100 metre U wind component', '100u'), ('100 metre V wind component', '100v'),
         ('5-wave geopotential height', '5wavh'),
+
+        # computed by the workflow while converting, see DERIVED_VARIABLES in gfsworkflow.py
+        ('10 metre wind speed', '10si'), ('10 metre wind direction', '10wdir'), ('100 metre wind speed', '100si'),
+        ('100 metre wind direction', '100wdir'), ('Wind speed', 'ws'), ('Wind direction', 'wdir'),
+        ('6 hour total precipitation', 'tp6'),
     ]
 
 
@@ -130,6 +135,20 @@ def variable_levels():
               ('Tropopause', 'tropopause'), ('Unknown', 'unknown')],
         'pres': [('At A Height Above Ground', 'heightAboveGround'), ('Max Wind', 'maxWind'),
                  ('Potential Vorticity', 'potentialVorticity'), ('Tropopause', 'tropopause'), ('Unknown', 'unknown')],
+        '10si': [('At A Height Above Ground', 'heightAboveGround')],
+        '10wdir': [('At A Height Above Ground', 'heightAboveGround')],
+        '100si': [('At A Height Above Ground', 'heightAboveGround')],
+        '100wdir': [('At A Height Above Ground', 'heightAboveGround')],
+        'ws': [('At A Height Above Ground', 'heightAboveGround'), ('At A Height Above the Sea', 'heightAboveSea'),
+               ('Isobaric (hPa)', 'isobaricInhPa'), ('Max Wind', 'maxWind'),
+               ('Potential Vorticity', 'potentialVorticity'),
+               ('Pressure From Ground Layer', 'pressureFromGroundLayer'), ('Sigma', 'sigma'),
+               ('Tropopause', 'tropopause'), ('Unknown', 'unknown')],
+        'wdir': [('At A Height Above Ground', 'heightAboveGround'), ('At A Height Above the Sea', 'heightAboveSea'),
+                 ('Isobaric (hPa)', 'isobaricInhPa'), ('Max Wind', 'maxWind'),
+                 ('Potential Vorticity', 'potentialVorticity'),
+                 ('Pressure From Ground Layer', 'pressureFromGroundLayer'), ('Sigma', 'sigma'),
+                 ('Tropopause', 'tropopause'), ('Unknown', 'unknown')],
         '100u': [('At A Height Above Ground', 'heightAboveGround')],
         '100v': [('At A Height Above Ground', 'heightAboveGround')],
         'hlcy': [('At A Height Above Ground Layer', 'heightAboveGroundLayer')],
@@ -144,7 +163,8 @@ def variable_levels():
                ('Isobaric (hPa)', 'isobaricInhPa'), ('Max Wind', 'maxWind'),
                ('Potential Vorticity', 'potentialVorticity'), ('Tropopause', 'tropopause'),
                ('Unknown', 'unknown')],
-        'r': [('Isothermal (0 Celcius)', 'isothermZero'), ('Isobaric (hPa)', 'isobaricInhPa'),
+        'r': [('At A Height Above Ground', 'heightAboveGround'), ('Isothermal (0 Celcius)', 'isothermZero'),
+              ('Isobaric (hPa)', 'isobaricInhPa'),
               ('Pressure From Ground Layer', 'pressureFromGroundLayer'), ('Sigma', 'sigma'),
               ('Sigma Layer', 'sigmaLayer'), ('Unknown', 'unknown')],
         'absv': [('Isobaric (Pa)', 'isobaricInPa'), ('Isobaric (hPa)', 'isobaricInhPa')],
@@ -167,6 +187,7 @@ def variable_levels():
         'sdwe': [('Surface', 'surface')], 'sde': [('Surface', 'surface')], 'pevpr': [('Surface', 'surface')],
         'cpofp': [('Surface', 'surface')], 'cprat': [('Surface', 'surface')], 'prate': [('Surface', 'surface')],
         'tp': [('Surface', 'surface')], 'acpcp': [('Surface', 'surface')], 'watr': [('Surface', 'surface')],
+        'tp6': [('Surface', 'surface')],
         'csnow': [('Surface', 'surface')], 'cicep': [('Surface', 'surface')], 'cfrzr': [('Surface', 'surface')],
         'crain': [('Surface', 'surface')], 'lhtfl': [('Surface', 'surface')], 'shtfl': [('Surface', 'surface')],
         'gflux': [('Surface', 'surface')], 'uflx': [('Surface', 'surface')], 'vflx': [('Surface', 'surface')],
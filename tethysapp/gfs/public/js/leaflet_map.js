@@ -37,10 +37,18 @@ function basemaps() {
 }
 
 ////////////////////////////////////////////////////////////////////////  GLDAS LAYERS
+function layerBounds(layer, level) {
+    // use the range for this variable at this level when the workflow recorded one
+    if (typeof levelbounds !== 'undefined' && levelbounds[layer] && levelbounds[layer][level]) {
+        return levelbounds[layer][level]['range']
+    }
+    return bounds[layer]
+}
+
 function newWMS() {
     let layer = $("#variables").val();
     let wmsurl = threddsbase + $("#levels").val() + '_wms.ncml';
-    let cs_rng = bounds[layer];
+    let cs_rng = layerBounds(layer, $("#levels").val());
     if ($("#use_csrange").is(":checked")) {
         cs_rng = String($("#cs_min").val()) + ',' + String($("#cs_max").val())
     }
@@ -78,49 +86,38 @@ function styleGeoJSON() {
     user_geojson.setStyle(style);
 }
 
-////////////////////////////////////////////////////////////////////////  ESRI LIVING ATLAS LAYERS (FEATURE SERVER)
+////////////////////////////////////////////////////////////////////////  ESRI LIVING ATLAS LAYERS (STORED BY THE APP)
+function boundaryLayer(name, tolerance, onEachFeature) {
+    // the boundaries are downloaded from the living atlas once and served by the app, the layer fills in when they load
+    let layer = L.geoJSON(null, {style: getStyle, onEachFeature: onEachFeature});
+    $.ajax({
+        url: URL_getBoundary,
+        async: true,
+        data: {name: name, tolerance: tolerance},
+        dataType: 'json',
+        method: 'GET',
+        success: function (result) {
+            layer.addData(result);
+            if (layer.getLayers().length > 0) {mapObj.flyToBounds(layer.getBounds())}
+        },
+    });
+    return layer;
+}
 function regionsESRI() {
     let region = $("#regions").val();
-
-    let where = '1=1';
-    if (region !== '') {
-        where = "REGION = '" + region + "'"
-    }
-    let params = {
-        url: 'https://services.arcgis.com/P3ePLMYs2RVChkJx/ArcGIS/rest/services/World_Regions/FeatureServer/0',
-        style: getStyle,
-        outSR: 4326,
-        where: where,
-        onEachFeature: function (feature, layer) {
-            let place = feature.properties.REGION;
-            layer.bindPopup('<a class="btn btn-default" role="button" onclick="getShapeChart(' + "'esri-" + place + "'" + ')">Get timeseries for ' + place + '</a>');
-        },
-    };
-    if (region !== '') {params['where'] = "REGION = '" + region + "'"}
-    let layer = L.esri.featureLayer(params);
-    layer.addTo(mapObj);
-    layer.query().where(where).bounds(function(error, latLngBounds, response){
-        mapObj.flyToBounds(latLngBounds)
+    let layer = boundaryLayer(region, region === '' ? 0.05 : 0.01, function (feature, layer) {
+        let place = feature.properties.REGION;
+        layer.bindPopup('<a class="btn btn-default" role="button" onclick="getShapeChart(' + "'esri-" + place + "'" + ')">Get timeseries for ' + place + '</a>');
     });
+    layer.addTo(mapObj);
     return layer;
 }
 function countriesESRI() {
     let region = $("#countries").val();
-    let where = "NAME='" + region + "'";
-    let params = {
-        url: 'https://services.arcgis.com/P3ePLMYs2RVChkJx/ArcGIS/rest/services/World__Countries_Generalized_analysis_trim/FeatureServer/0',
-        style: getStyle,
-        outSR: 4326,
-        where: where,
-        onEachFeature: function (feature, layer) {
-            layer.bindPopup('<a class="btn btn-default" role="button" onclick="getShapeChart(' + "'esri-" + region + "'" + ')">Get timeseries for ' + region + '</a>');
-        },
-    };
-    let layer = L.esri.featureLayer(params);
-    layer.addTo(mapObj);
-    layer.query().where(where).bounds(function(error, latLngBounds, response){
-        mapObj.flyToBounds(latLngBounds)
+    let layer = boundaryLayer(region, 0.01, function (feature, layer) {
+        layer.bindPopup('<a class="btn btn-default" role="button" onclick="getShapeChart(' + "'esri-" + region + "'" + ')">Get timeseries for ' + region + '</a>');
     });
+    layer.addTo(mapObj);
     return layer;
 }
 
@@ -162,7 +159,7 @@ let legend = L.control({position: 'bottomright'});
 legend.onAdd = function () {
     let layer = $("#variables").val();
     let wmsurl = threddsbase + $("#levels").val() + '_wms.ncml';
-    let cs_rng = bounds[layer];
+    let cs_rng = layerBounds(layer, $("#levels").val());
     if ($("#use_csrange").is(":checked")) {
         cs_rng = String($("#cs_min").val()) + ',' + String($("#cs_max").val())
     }
@@ -0,0 +1,286 @@
+import os
+import json
+import shutil
+import logging
+import datetime
+import functools
+import urllib.parse
+
+import numpy as np
+import requests
+
+from .app import Gfs as App
+
+# The Living Atlas layers the boundaries are downloaded from and the attribute with each place's name
+BOUNDARY_LAYERS = {
+    'regions': ('https://services.arcgis.com/P3ePLMYs2RVChkJx/ArcGIS/rest/services/World_Regions/FeatureServer/0',
+                'REGION'),
+    'countries': ('https://services.arcgis.com/P3ePLMYs2RVChkJx/ArcGIS/rest/services/'
+                  'World__Countries_Generalized_analysis_trim/FeatureServer/0', 'NAME'),
+}
+# Change the version when the layers or the simplification change so the boundaries and weights are made again
+BOUNDARIES_VERSION = 1
+# The tolerances in degrees each boundary is simplified to, 0 keeps it as downloaded
+BOUNDARY_TOLERANCES = (0, .01, .05, .2)
+# The tolerance of the boundaries the area weights are computed from, well under the size of a grid cell
+WEIGHTS_TOLERANCE = .01
+
+# The global 0.25 degree grid the workflow writes, the latitude and longitude of the first cell and the grid's shape.
+# The countries and world regions of the ESRI Living Atlas are stored as the cells of this grid they cover.
+GRID_LAT0 = -90
+GRID_LON0 = -180
+GRID_RESOLUTION = .25
+GRID_SHAPE = (721, 1440)
+
+
+def polygon_rings(item):
+    # every ring of every polygon in a geojson as an (n, 2) array of longitude, latitude
+    if isinstance(item, dict):
+        for key in ('features', 'geometry', 'geometries', 'coordinates'):
+            if key in item:
+                yield from polygon_rings(item[key])
+    elif item and isinstance(item[0], (list, tuple)) and item[0] and isinstance(item[0][0], (int, float)):
+        yield np.array(item, dtype=float)[:, :2]
+    elif isinstance(item, (list, tuple)):
+        for value in item:
+            yield from polygon_rings(value)
+
+
+def rasterize(rings):
+    """
+    The cells of the grid whose centers are inside the rings by the even-odd rule, so holes are left out. Each row
+    of the grid is a scan line: the longitudes where it crosses an edge are sorted and the cells between every other
+    pair of them are inside.
+    """
+    inside = np.zeros(GRID_SHAPE, dtype=bool)
+    rings = list(rings)
+    if not rings:
+        return inside
+    start = np.concatenate([ring for ring in rings])
+    end = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    lats = GRID_LAT0 + GRID_RESOLUTION * np.arange(GRID_SHAPE[0])
+    lons = GRID_LON0 + GRID_RESOLUTION * np.arange(GRID_SHAPE[1])
+    rows = np.nonzero((lats >= min(start[:, 1].min(), end[:, 1].min())) &
+                      (lats <= max(start[:, 1].max(), end[:, 1].max())))[0]
+    for row in rows:
+        lat = lats[row]
+        crosses = (start[:, 1] <= lat) != (end[:, 1] <= lat)
+        if not crosses.any():
+            continue
+        x0, y0 = start[crosses, 0], start[crosses, 1]
+        x1, y1 = end[crosses, 0], end[crosses, 1]
+        xs = np.sort(x0 + (lat - y0) * (x1 - x0) / (y1 - y0))
+        toggles = np.zeros(GRID_SHAPE[1] + 1, dtype=int)
+        np.add.at(toggles, np.searchsorted(lons, xs), 1)
+        inside[row] = np.cumsum(toggles)[:-1] % 2 == 1
+    return inside
+
+
+def area_weights(geojson):
+    """
+    The rows, columns, and weights of the cells in a geojson's polygons, a row of a sparse matrix that averages a
+    grid over the polygons with one dot product. Each cell is weighted by the cosine of its latitude, which is
+    proportional to its area, and the weights add up to 1. Places smaller than a cell, like small islands, use the
+    cells nearest to their boundary.
+    """
+    features = geojson.get('features', [geojson]) if isinstance(geojson, dict) else [geojson]
+    inside = np.zeros(GRID_SHAPE, dtype=bool)
+    for feature in features:
+        inside |= rasterize(polygon_rings(feature))
+    rows, cols = np.nonzero(inside)
+    if not len(rows):
+        points = np.concatenate(list(polygon_rings(geojson)))
+        cells = np.unique(np.stack((
+            np.clip(np.round((points[:, 1] - GRID_LAT0) / GRID_RESOLUTION), 0, GRID_SHAPE[0] - 1),
+            np.round((points[:, 0] - GRID_LON0) / GRID_RESOLUTION) % GRID_SHAPE[1],
+        ), axis=1).astype(int), axis=0)
+        rows, cols = cells[:, 0], cells[:, 1]
+    weights = np.cos(np.radians(GRID_LAT0 + GRID_RESOLUTION * rows))
+    return rows.astype('i4'), cols.astype('i4'), weights / weights.sum()
+
+
+def weights_path(name):
+    return os.path.join(App.get_app_workspace().path, 'regions', 'v' + str(BOUNDARIES_VERSION),
+                        urllib.parse.quote(name, safe='') + '.npz')
+
+
+def region_weights(name):
+    """
+    The rows, columns, and weights (see area_weights) of a country or world region. They are computed from the
+    region's stored boundary (see boundary) the first time and read from the app workspace afterward.
+    """
+    path = weights_path(name)
+    if not os.path.exists(path):
+        rows, cols, weights = area_weights(boundary(name, WEIGHTS_TOLERANCE))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # saved to a temporary name and renamed so other processes never read half a file
+        tmp = path + '.' + str(os.getpid()) + '.npz'
+        np.savez(tmp, rows=rows, cols=cols, weights=weights)
+        os.replace(tmp, path)
+        return rows, cols, weights
+    with np.load(path) as stored:
+        return stored['rows'], stored['cols'], stored['weights']
+
+
+def weights_extent(rows, cols):
+    # the [west, east, south, north] of the centers of the cells
+    return [GRID_LON0 + GRID_RESOLUTION * float(cols.min()), GRID_LON0 + GRID_RESOLUTION * float(cols.max()),
+            GRID_LAT0 + GRID_RESOLUTION * float(rows.min()), GRID_LAT0 + GRID_RESOLUTION * float(rows.max())]
+
+
+def build_region_weights():
+    """
+    Computes the weights of every country and world region the app lists ahead of time so no chart has to. Returns
+    the names that failed.
+    """
+    failed = []
+    for name in boundary_index()['places']:
+        try:
+            region_weights(name)
+        except Exception as e:
+            logging.exception(e)
+            failed.append(name)
+    return failed
+
+
+def simplify_ring(ring, tolerance):
+    """
+    Simplifies a closed ring with the Douglas-Peucker algorithm, keeping every point farther than tolerance from the
+    line through the points kept around it. Returns None if fewer than 4 points are left, e.g. a small island.
+    """
+    if tolerance <= 0 or len(ring) <= 4:
+        return ring
+    keep = np.zeros(len(ring), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(ring) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        segment = ring[last] - ring[first]
+        points = ring[first + 1:last] - ring[first]
+        length = np.hypot(segment[0], segment[1])
+        if length:
+            distances = np.abs(segment[0] * points[:, 1] - segment[1] * points[:, 0]) / length
+        else:
+            # the first and last points of a ring are the same point
+            distances = np.hypot(points[:, 0], points[:, 1])
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            stack += [(first, first + 1 + farthest), (first + 1 + farthest, last)]
+            keep[first + 1 + farthest] = True
+    return ring[keep] if keep.sum() >= 4 else None
+
+
+def simplify_polygons(polygons, tolerance):
+    # a list of polygons (lists of rings, the outline then any holes) simplified, leaving out polygons that vanish
+    simplified = []
+    for polygon in polygons:
+        rings = [simplify_ring(ring, tolerance) for ring in polygon]
+        if rings[0] is not None:
+            simplified.append([np.round(ring, 5).tolist() for ring in rings if ring is not None])
+    return simplified
+
+
+def download_layer(url, field):
+    """
+    Downloads every feature of a Living Atlas layer, a page of features at a time, as a dictionary of each place's
+    name and its polygons as lists of (n, 2) arrays of longitude, latitude
+    """
+    places = {}
+    offset = 0
+    while True:
+        response = requests.get(url + '/query', timeout=120, params={
+            'where': '1=1', 'outFields': field, 'outSR': 4326, 'f': 'geojson', 'resultOffset': offset})
+        response.raise_for_status()
+        page = response.json()
+        for feature in page.get('features', []):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+                continue
+            polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+            places.setdefault(feature['properties'][field], []).extend(
+                [np.array(ring, dtype=float)[:, :2] for ring in polygon] for polygon in polygons)
+        offset += len(page.get('features', []))
+        exceeded = page.get('exceededTransferLimit') or page.get('properties', {}).get('exceededTransferLimit')
+        if not exceeded or not page.get('features'):
+            return places
+
+
+def boundaries_path():
+    return os.path.join(App.get_app_workspace().path, 'boundaries', 'v' + str(BOUNDARIES_VERSION))
+
+
+def build_boundaries():
+    """
+    Downloads the countries and world regions from the Living Atlas once and stores each place's boundary at every
+    BOUNDARY_TOLERANCES as a geojson in the app workspace, along with index.json which lists each place with its
+    layer and [west, east, south, north] extent. The store is written to a temporary folder and renamed when it is
+    complete so the app never reads part of one. A name in both layers (Antarctica) is kept as a region.
+    """
+    path = boundaries_path()
+    tmp = path + '.' + str(os.getpid())
+    index = {
+        'version': BOUNDARIES_VERSION,
+        'downloaded': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'tolerances': BOUNDARY_TOLERANCES,
+        'places': {},
+    }
+    for tolerance in BOUNDARY_TOLERANCES:
+        os.makedirs(os.path.join(tmp, str(tolerance)), exist_ok=True)
+    for layer, (url, field) in BOUNDARY_LAYERS.items():
+        logging.info('Downloading the ' + layer + ' boundaries from the Living Atlas')
+        for name, polygons in download_layer(url, field).items():
+            if name in index['places']:
+                continue
+            points = np.concatenate([ring for polygon in polygons for ring in polygon])
+            index['places'][name] = {
+                'layer': layer,
+                'extent': [float(points[:, 0].min()), float(points[:, 0].max()),
+                           float(points[:, 1].min()), float(points[:, 1].max())],
+            }
+            for tolerance in BOUNDARY_TOLERANCES:
+                # a place too small to survive a tolerance keeps its coarsest boundary that does
+                polygons = simplify_polygons(polygons, tolerance) or polygons
+                geojson = {'type': 'FeatureCollection', 'features': [{
+                    'type': 'Feature',
+                    'properties': {field: name},
+                    'geometry': {'type': 'MultiPolygon', 'coordinates': [
+                        [np.asarray(ring).tolist() for ring in polygon] for polygon in polygons]},
+                }]}
+                with open(os.path.join(tmp, str(tolerance), urllib.parse.quote(name, safe='') + '.json'), 'w') as f:
+                    f.write(json.dumps(geojson))
+                polygons = [[np.asarray(ring) for ring in polygon] for polygon in polygons]
+    with open(os.path.join(tmp, 'index.json'), 'w') as f:
+        f.write(json.dumps(index))
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another process finished the store first
+        shutil.rmtree(tmp)
+    return
+
+
+@functools.lru_cache(maxsize=1)
+def boundary_index():
+    """
+    The index of the stored boundaries (see build_boundaries), which downloads them the first time it's needed.
+    Read once per process, don't change it.
+    """
+    path = os.path.join(boundaries_path(), 'index.json')
+    if not os.path.exists(path):
+        build_boundaries()
+    with open(path, 'r') as f:
+        return json.loads(f.read())
+
+
+def boundary(name, tolerance=0):
+    """
+    The stored geojson of the boundary of a country or world region, simplified to the stored tolerance nearest to
+    tolerance. Raises KeyError if the place isn't in the index.
+    """
+    if name not in boundary_index()['places']:
+        raise KeyError(name)
+    tolerance = min(BOUNDARY_TOLERANCES, key=lambda stored: abs(stored - float(tolerance)))
+    with open(os.path.join(boundaries_path(), str(tolerance), urllib.parse.quote(name, safe='') + '.json'), 'r') as f:
+        return json.loads(f.read())
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import netCDF4
+from tethys_sdk.testing import TethysTestCase
+
+from .. import utilities
+
+# Run with: "tethys test -f tethys_apps.tethysapp.gfs.tests.test_caches"
+
+
+def publish(thredds, timestamp):
+    # what the workflow does to publish a cycle, see publish in gfsworkflow.py
+    netcdfs = os.path.join(thredds, timestamp, 'netcdfs')
+    os.makedirs(netcdfs)
+    for hour in ('06', '12'):
+        with netCDF4.Dataset(os.path.join(netcdfs, 'surface_' + timestamp[:8] + hour + '.nc'), 'w') as dataset:
+            dataset.createDimension('time', 1)
+            dataset.createVariable('time', 'i4', ('time',))[:] = [int(hour)]
+    os.symlink(timestamp, os.path.join(thredds, 'current.tmp'))
+    os.replace(os.path.join(thredds, 'current.tmp'), os.path.join(thredds, 'current'))
+    with open(os.path.join(thredds, 'last_run.txt'), 'w') as file:
+        file.write(timestamp)
+    return netcdfs
+
+
+class CacheTestCase(TethysTestCase):
+    def set_up(self):
+        self.thredds = tempfile.mkdtemp()
+        self.workspace = tempfile.mkdtemp()
+        self.patches = [
+            mock.patch.object(utilities.App, 'get_custom_setting', return_value=self.thredds),
+            mock.patch.object(utilities.App, 'get_app_workspace', return_value=mock.Mock(path=self.workspace)),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tear_down(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.thredds)
+        shutil.rmtree(self.workspace)
+
+    def test_datasets_are_closed_when_a_cycle_is_published(self):
+        datasets = utilities.DatasetCache()
+        netcdfs = publish(self.thredds, '2024010100')
+        self.assertEqual(utilities.get_gfsdate(), '2024010100')
+        files = datasets.files(netcdfs, 'surface')
+        self.assertEqual([os.path.basename(file) for file in files], ['surface_2024010106.nc', 'surface_2024010112.nc'])
+        with datasets.open(files[0]) as dataset:
+            first = dataset
+        # the same dataset is used until the cycle changes
+        with datasets.open(files[0]) as dataset:
+            self.assertIs(dataset, first)
+        self.assertTrue(first.isopen())
+
+        newer = publish(self.thredds, '2024010106')
+        self.assertEqual(os.path.dirname(datasets.files(newer, 'surface')[0]), newer)
+        self.assertFalse(first.isopen())
+        self.assertEqual(len(datasets.datasets), 0)
+
+    def test_least_recently_used_datasets_are_closed(self):
+        datasets = utilities.DatasetCache(size=1)
+        first, second = datasets.files(publish(self.thredds, '2024010100'), 'surface')
+        with datasets.open(first) as dataset:
+            opened = dataset
+        with datasets.open(second):
+            pass
+        self.assertFalse(opened.isopen())
+
+    def test_responses_are_forgotten_when_a_cycle_is_published(self):
+        publish(self.thredds, '2024010100')
+        data = {'loc_type': 'Point', 'coords': ['-100', 40], 'variable': 't', 'level': 'surface'}
+        compute = mock.Mock(side_effect=lambda request: {'values': [1, 2]})
+        responses = utilities.ResponseCache()
+        self.assertEqual(responses.get(data, compute), {'values': [1, 2]})
+        # the same place written another way is the same request
+        self.assertEqual(responses.get(dict(data, coords=[-100.0, '40']), compute), {'values': [1, 2]})
+        # another process of the server finds the response on disk
+        self.assertEqual(utilities.ResponseCache().get(data, compute), {'values': [1, 2]})
+        self.assertEqual(compute.call_count, 1)
+        self.assertEqual(responses.counts, {'memory_hits': 1, 'disk_hits': 0, 'misses': 1})
+
+        publish(self.thredds, '2024010106')
+        responses.get(data, compute)
+        self.assertEqual(compute.call_count, 2)
+        # only the folder of the new cycle is left
+        folders = os.listdir(os.path.join(self.workspace, 'responses'))
+        self.assertEqual(len(folders), 1)
+        self.assertTrue(folders[0].startswith('2024010106_'))
+
+    def test_uploaded_shapes_are_not_cached(self):
+        publish(self.thredds, '2024010100')
+        data = {'loc_type': 'GeoJSON', 'vectordata': 'upload', 'variable': 't', 'level': 'surface'}
+        compute = mock.Mock(return_value={'values': []})
+        responses = utilities.ResponseCache()
+        responses.get(data, compute)
+        responses.get(data, compute)
+        self.assertEqual(compute.call_count, 2)
@@ -0,0 +1,88 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from tethys_sdk.testing import TethysTestCase
+
+from .. import charts
+
+# Run with: "tethys test -f tethys_apps.tethysapp.gfs.tests.test_charts"
+
+
+def write_cube(path, values, levels=None):
+    # a cube like the workflow writes (see write_cube in gfsworkflow.py) of a 1 degree grid starting at 0, 0
+    header = {'name': 't', 'level': 'isobaricInhPa' if levels else 'surface', 'timestamp': '2024010100',
+              'hours': [6, 12, 18], 'units': 'K', 'long_name': 'Temperature',
+              'vertical': {'name': 'pressure', 'values': levels} if levels else None,
+              'shape': list(values.shape), 'dtype': '<f4', 'lat0': 0, 'lon0': 0, 'resolution': 1}
+    with open(path, 'wb') as f:
+        f.write((b'GFSCUBE1' + json.dumps(header).encode()).ljust(charts.CUBE_HEADER))
+        values.astype('<f4').tofile(f)
+
+
+class ChartTestCase(TethysTestCase):
+    def set_up(self):
+        self.cyclepath = tempfile.mkdtemp()
+
+    def tear_down(self):
+        shutil.rmtree(self.cyclepath)
+
+    def test_geojson_extent(self):
+        # bounding boxes come from the map as numbers and from the api as strings
+        box = [[['-100.5', '40'], ['-99', '40'], ['-99', '41.25'], ['-100.5', '41.25'], ['-100.5', '40']]]
+        self.assertEqual(charts.geojson_extent({'coordinates': box}), [-100.5, -99, 40, 41.25])
+        collection = {'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [10, -5]}},
+            {'type': 'Feature',
+             'geometry': {'type': 'MultiPolygon', 'coordinates': [[[[12.5, -6], [11, 3], [12, 1]]]]}},
+        ]}
+        self.assertEqual(charts.geojson_extent(collection), [10, 12.5, -6, 3])
+
+    def test_chart_folder_is_the_smallest_domain_with_the_location(self):
+        netcdfs = os.path.join(self.cyclepath, 'netcdfs')
+        # without domains every chart reads the global files
+        self.assertEqual(charts.chart_folder(self.cyclepath, [-100, -100, 40, 40]), netcdfs)
+
+        os.makedirs(os.path.join(self.cyclepath, 'domains'))
+        with open(os.path.join(self.cyclepath, 'domains', 'domains.json'), 'w') as f:
+            f.write(json.dumps({'americas': [-170, -30, -60, 75], 'conus': [-125, -66, 24, 50]}))
+        self.assertEqual(charts.chart_folder(self.cyclepath, [-100, -100, 40, 40]),
+                         os.path.join(self.cyclepath, 'domains', 'conus'))
+        self.assertEqual(charts.chart_folder(self.cyclepath, [-130, -100, 40, 60]),
+                         os.path.join(self.cyclepath, 'domains', 'americas'))
+        self.assertEqual(charts.chart_folder(self.cyclepath, [10, 12, 40, 41]), netcdfs)
+        self.assertEqual(charts.chart_folder(self.cyclepath, None), netcdfs)
+
+    def test_cube_timeseries(self):
+        # (level, lat, lon, time) values that say where they are
+        level, lat, lon, time = np.meshgrid(np.arange(2), np.arange(4), np.arange(5), np.arange(3), indexing='ij')
+        values = 1000 * level + 100 * lat + 10 * lon + time
+        cube = os.path.join(self.cyclepath, 't.cube')
+        write_cube(cube, values, levels=[500, 850])
+
+        level, units, timeseries = charts.cube_timeseries(cube, 'Point', ['2.2', '1.9'], vertical='850')
+        self.assertEqual((level, units), (850, 'K'))
+        self.assertEqual(timeseries['values'].tolist(), [1220, 1221, 1222])
+        self.assertEqual(timeseries['datetime'].dt.strftime('%Y-%m-%d %H').tolist(),
+                         ['2024-01-01 06', '2024-01-01 12', '2024-01-01 18'])
+        # without a level the first one is used
+        level, units, timeseries = charts.cube_timeseries(cube, 'Point', [4, 3])
+        self.assertEqual(level, 500)
+        self.assertEqual(timeseries['values'].tolist(), [340, 341, 342])
+        # a bounding box is the average of the cells in it, from any two opposite corners
+        level, units, timeseries = charts.cube_timeseries(cube, 'Polygon', [[3, 2], [1, 0]], vertical=500)
+        self.assertEqual(timeseries['values'].tolist(), [120, 121, 122])
+
+    def test_cube_without_levels(self):
+        values = np.arange(1 * 4 * 5 * 3, dtype=float).reshape(1, 4, 5, 3)
+        values[0, 1, 1, 1] = np.nan
+        cube = os.path.join(self.cyclepath, 't.cube')
+        write_cube(cube, values)
+        level, units, timeseries = charts.cube_timeseries(cube, 'Point', [1, 1], vertical=500)
+        self.assertIsNone(level)
+        self.assertTrue(np.isnan(timeseries['values'][1]))
+        # missing values are left out of the average
+        level, units, timeseries = charts.cube_timeseries(cube, 'Polygon', [[1, 1], [2, 1]])
+        self.assertEqual(timeseries['values'].tolist()[1], values[0, 1, 2, 1])
@@ -0,0 +1,72 @@
+import shutil
+import tempfile
+from unittest import mock
+
+import numpy as np
+from tethys_sdk.testing import TethysTestCase
+
+from .. import regions
+
+# Run with: "tethys test -f tethys_apps.tethysapp.gfs.tests.test_regions"
+
+
+def cell(lat, lon):
+    # the row and column of the grid cell centered on a latitude and longitude
+    return (int((lat - regions.GRID_LAT0) / regions.GRID_RESOLUTION),
+            int((lon - regions.GRID_LON0) / regions.GRID_RESOLUTION))
+
+
+def square(west, south, east, north):
+    return [[west, south], [east, south], [east, north], [west, north], [west, south]]
+
+
+# a 10 degree square with a 2 degree hole in the middle, like a country around a lake or another country
+HOLED = {'type': 'Feature', 'properties': {},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(0, 0, 10, 10), square(4, 4, 6, 6)]}}
+
+
+class RegionWeightsTestCase(TethysTestCase):
+    def set_up(self):
+        self.workspace = tempfile.mkdtemp()
+
+    def tear_down(self):
+        shutil.rmtree(self.workspace)
+
+    def test_holes_are_left_out(self):
+        inside = regions.rasterize(regions.polygon_rings(HOLED))
+        self.assertTrue(inside[cell(2, 2)])
+        self.assertTrue(inside[cell(5, 2)])
+        self.assertFalse(inside[cell(5, 5)])
+        self.assertFalse(inside[cell(5, 12)])
+
+        rows, cols, weights = regions.area_weights({'type': 'FeatureCollection', 'features': [HOLED]})
+        self.assertAlmostEqual(weights.sum(), 1)
+        self.assertNotIn(cell(5, 5), set(zip(rows.tolist(), cols.tolist())))
+        # centers on a west or south edge are inside and those on an east or north edge aren't, so the square has
+        # 40 by 40 cells and the hole takes 8 by 8 of them
+        self.assertEqual(len(rows), 40 * 40 - 8 * 8)
+
+    def test_cells_are_weighted_by_area(self):
+        geojson = {'type': 'Polygon', 'coordinates': [square(0, 0, 1, 60)]}
+        rows, cols, weights = regions.area_weights(geojson)
+        equator = weights[rows == cell(.25, 0)[0]][0]
+        north = weights[rows == cell(59.75, 0)[0]][0]
+        self.assertAlmostEqual(north / equator, np.cos(np.radians(59.75)) / np.cos(np.radians(.25)))
+
+    def test_places_smaller_than_a_cell_use_the_nearest_cells(self):
+        # an island between the centers of the cells, none of which are inside it
+        geojson = {'type': 'MultiPolygon', 'coordinates': [[square(.05, .05, .1, .1)]]}
+        rows, cols, weights = regions.area_weights(geojson)
+        self.assertEqual(list(zip(rows.tolist(), cols.tolist())), [cell(0, 0)])
+        self.assertEqual(weights.tolist(), [1])
+
+    def test_region_weights_are_computed_once(self):
+        workspace = mock.Mock(path=self.workspace)
+        with mock.patch.object(regions.App, 'get_app_workspace', return_value=workspace), \
+                mock.patch.object(regions, 'boundary', return_value=HOLED) as boundary:
+            first = regions.region_weights('Lake Country')
+            second = regions.region_weights('Lake Country')
+        boundary.assert_called_once_with('Lake Country', regions.WEIGHTS_TOLERANCE)
+        for computed, stored in zip(first, second):
+            np.testing.assert_array_equal(computed, stored)
+        self.assertEqual(regions.weights_extent(first[0], first[1]), [0, 9.75, 0, 9.75])
@@ -3,10 +3,28 @@ import random
 from .app import Gfs as App
 import os
 import datetime
+import json
+import shutil
+import hashlib
+import threading
+import contextlib
+import collections
+
+import netCDF4 as nc
+
+# The most netcdfs the app keeps open between requests, a forecast has 28 time steps of each level
+OPEN_DATASETS = 128
+
+# The most chart responses each process keeps in memory, the rest are only kept on disk
+CACHED_RESPONSES = 256
 
 
 def get_gfsdate():
     thredds = App.get_custom_setting("thredds_path")
+    # the workflow swaps this symlink to a new cycle in one step, read it once and use that timestamp everywhere
+    pointer = os.path.join(thredds, 'current')
+    if os.path.islink(pointer):
+        return os.path.basename(os.readlink(pointer))
     file = os.path.join(thredds, 'last_run.txt')
     if os.path.exists(file):
         with open(os.path.join(thredds, 'last_run.txt'), 'r') as file:
@@ -28,3 +46,189 @@ def currentgfs():
 
 def new_id(length=10):
     return ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for i in range(length))
+
+
+def cycle_version():
+    # changes whenever the workflow publishes a cycle, it swaps the current symlink and rewrites last_run.txt
+    thredds = App.get_custom_setting("thredds_path")
+    pointer = os.path.join(thredds, 'current')
+    last_run = os.path.join(thredds, 'last_run.txt')
+    stat = os.stat(last_run) if os.path.exists(last_run) else None
+    return (
+        os.readlink(pointer) if os.path.islink(pointer) else None,
+        (stat.st_mtime_ns, stat.st_size) if stat else None,
+    )
+
+
+class DatasetCache:
+    """
+    Keeps the netcdfs that charts read open between requests so a chart doesn't list a folder and open every time
+    step's file again. Datasets are kept by (cycle, level, file) and the least recently used one is closed once more
+    than size are open. Everything is closed and forgotten when a new cycle is published. netCDF4 isn't thread safe
+    so one request reads at a time.
+    """
+    def __init__(self, size=OPEN_DATASETS):
+        self.size = size
+        self.lock = threading.RLock()
+        self.datasets = collections.OrderedDict()
+        self.listings = {}
+        self.version = None
+
+    def refresh(self):
+        # close everything from the last cycle if the workflow published a new one, returns the current cycle
+        version = cycle_version()
+        if version != self.version:
+            self.clear()
+            self.version = version
+        return get_gfsdate()
+
+    def clear(self):
+        with self.lock:
+            for dataset in self.datasets.values():
+                dataset.close()
+            self.datasets.clear()
+            self.listings.clear()
+        return
+
+    def files(self, folder, level):
+        """
+        The files of a level in a folder of netcdfs: the consolidated file if the workflow wrote one, otherwise the
+        file of each time step in order. The listing is kept until a new cycle is published.
+        """
+        with self.lock:
+            key = (self.refresh(), level, folder)
+            if key not in self.listings:
+                consolidated = os.path.join(folder, level + '.nc')
+                if os.path.exists(consolidated):
+                    self.listings[key] = [consolidated]
+                else:
+                    files = [n for n in os.listdir(folder) if n.startswith(level + '_') and n.endswith('.nc')]
+                    self.listings[key] = sorted(os.path.join(folder, file) for file in files)
+            return self.listings[key]
+
+    @contextlib.contextmanager
+    def open(self, path):
+        """
+        Use as with datasets.open(path) as dataset: to read a netcdf the workflow wrote, named level.nc or
+        level_YYYYMMDDHH.nc. The dataset stays open after the with block so don't close it.
+        """
+        with self.lock:
+            key = (self.refresh(), os.path.basename(path).split('_')[0].replace('.nc', ''), path)
+            if key in self.datasets:
+                self.datasets.move_to_end(key)
+            else:
+                self.datasets[key] = nc.Dataset(path, 'r')
+                while len(self.datasets) > self.size:
+                    self.datasets.popitem(last=False)[1].close()
+            yield self.datasets[key]
+
+
+datasets = DatasetCache()
+
+
+def geometry_hash(data):
+    """
+    A hash of the location of a chart request that is the same however the coordinates were written, e.g. '45' and
+    45.0, or None for uploaded shapefiles and geojsons which can change between requests with the same name
+    """
+    if data['loc_type'] in ('Shapefile', 'GeoJSON'):
+        return None
+
+    def canonical(item):
+        if isinstance(item, (list, tuple)):
+            return [canonical(value) for value in item]
+        return round(float(item), 6)
+    geometry = {
+        'loc_type': data['loc_type'],
+        'coords': canonical(data['coords']) if data['loc_type'] in ('Point', 'Polygon') else None,
+        'vectordata': data.get('vectordata'),
+        'vertical': float(data['vertical']) if data.get('vertical') is not None else None,
+        'profile': bool(data.get('profile')),
+    }
+    return hashlib.sha1(json.dumps(geometry, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Remembers the chart responses made for the published cycle, by cycle, variable, level, and geometry_hash. Each
+    process keeps the size most recently used in memory and every response is also written to a folder in the app
+    workspace so the other processes of the server can use it. Both are emptied when a new cycle is published.
+    Counts the hits of each tier and the misses of this process, see stats.
+    """
+    def __init__(self, size=CACHED_RESPONSES):
+        self.size = size
+        self.lock = threading.Lock()
+        self.responses = collections.OrderedDict()
+        self.version = None
+        self.counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def folder(self):
+        return os.path.join(App.get_app_workspace().path, 'responses')
+
+    def refresh(self):
+        """
+        Forgets the responses of the last cycle if the workflow published a new one. The disk folder is named for the
+        cycle and when it was published so a cycle published again starts empty. Returns the folder of this cycle.
+        """
+        version = cycle_version()
+        cycle = get_gfsdate() + '_' + str(version[1][0] if version[1] else 0)
+        if version != self.version:
+            self.responses.clear()
+            self.version = version
+            if os.path.exists(self.folder()):
+                for old in os.listdir(self.folder()):
+                    if old != cycle:
+                        shutil.rmtree(os.path.join(self.folder(), old), ignore_errors=True)
+        return os.path.join(self.folder(), cycle)
+
+    def get(self, data, compute):
+        """
+        The response to a chart request, from memory, then disk, and otherwise from compute(data) which is then kept
+        """
+        location = geometry_hash(data)
+        if location is None:
+            return compute(data)
+        with self.lock:
+            folder = self.refresh()
+            key = (os.path.basename(folder), data['variable'], data['level'], location)
+            path = os.path.join(folder, '_'.join(key[1:]) + '.json')
+            if key in self.responses:
+                self.responses.move_to_end(key)
+                self.counts['memory_hits'] += 1
+                return self.responses[key]
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                response = json.loads(f.read())
+            count = 'disk_hits'
+        else:
+            response = compute(data)
+            count = 'misses'
+            os.makedirs(folder, exist_ok=True)
+            # written to a temporary file and renamed so other processes never read half a response
+            tmp = path + '.' + str(os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(json.dumps(response))
+            os.replace(tmp, path)
+        with self.lock:
+            self.counts[count] += 1
+            self.responses[key] = response
+            while len(self.responses) > self.size:
+                self.responses.popitem(last=False)
+        return response
+
+    def stats(self):
+        with self.lock:
+            folder = self.refresh()
+            counts = dict(self.counts)
+        files = os.listdir(folder) if os.path.exists(folder) else []
+        requests = sum(counts.values())
+        return dict(
+            counts,
+            hit_rate=round((counts['memory_hits'] + counts['disk_hits']) / requests, 3) if requests else 0,
+            memory_entries=len(self.responses),
+            disk_entries=len([file for file in files if file.endswith('.json')]),
+            cycle=os.path.basename(folder),
+        )
+
+
+responses = ResponseCache()